@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+
+# Reddiator benchmark file
+# Module name: benchmarks-bench_async_client
+# Version: 1.0
+
+# Description: Compares N commands served one after the other with the blocking client, against
+# N concurrent commands served by the async client, both against a local fake Reddit server.
+#
+# Usage: ./benchmarks/bench_async_client.py [N] [latency in seconds]
+
+import os, sys, asyncio
+
+from time import perf_counter
+
+from fake_reddit import FakeReddit
+
+def main(n, latency):
+	fake_reddit = FakeReddit(latency = latency).start()
+
+	os.environ['REDDIT_WWW_URL'] = fake_reddit.url
+	os.environ['REDDIT_OAUTH_URL'] = fake_reddit.url
+	os.environ.setdefault('REDDIT_MAX_REQUESTS_IN_FLIGHT', str(n))
+	for var in ['REDDIT_CLIENT_ID', 'REDDIT_CLIENT_SECRET', 'REDDIT_REFRESH_TOKEN', 'REDDIT_USER_AGENT']:
+		os.environ.setdefault(var, 'benchmark')
+
+	sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+	from utils import reddit
+
+	# Fetch the token once, so that both runs only measure the listing requests
+	reddit.get_access_token()
+
+	start = perf_counter()
+	for i in range(n):
+		reddit.get_random_post_from_subreddit(f'sub{i}')
+	blocking = perf_counter() - start
+
+	async def run_concurrently():
+		await asyncio.gather(*[reddit.get_random_post_from_subreddit_async(f'sub{i}') for i in range(n)])
+
+	start = perf_counter()
+	asyncio.run(run_concurrently())
+	concurrent = perf_counter() - start
+
+	fake_reddit.stop()
+
+	print(f'{n} commands, {latency * 1000:.0f} ms per Reddit round-trip, at most {reddit.MAX_REQUESTS_IN_FLIGHT} requests in flight')
+	print(f'blocking client : {blocking:.3f} s ({blocking / latency:.1f} round-trips)')
+	print(f'async client    : {concurrent:.3f} s ({concurrent / latency:.1f} round-trips)')
+	for host, stats in reddit.get_connection_stats().items():
+		print(f'{host + " session":15} : {stats["requests"]} requests, {stats["opened"]} connections opened, {stats["reused"]} reused')
+
+if __name__ == '__main__':
+	n = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+	latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+	main(n, latency)
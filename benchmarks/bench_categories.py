@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+
+# Reddiator benchmark file
+# Module name: benchmarks-bench_categories
+# Version: 1.0
+
+# Description: Compares the list command searches (-search, -cat_search, -e) scanning all the categories
+# as they used to, against the category index, over a synthetic categories file.
+#
+# Usage: ./benchmarks/bench_categories.py [number of subreddits] [subreddits per category]
+
+import os, sys, tempfile
+
+from random import Random
+
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.categories import load_categories, CategoryIndex
+
+WORDS = ['cat', 'dog', 'meme', 'art', 'pic', 'funny', 'earth', 'porn', 'gif', 'history', 'space', 'food', 'music', 'game', 'news', 'aww']
+
+def write_categories_file(filename, subreddits, per_category):
+	random = Random(42)
+	with open(filename, 'w') as f:
+		for i in range(subreddits // per_category):
+			subs = [random.choice(WORDS).capitalize() + random.choice(WORDS) + str(random.randint(0, 99999)) for j in range(per_category)]
+			f.write(f'{random.choice(WORDS)}_{i}:' + ','.join(subs) + '\n')
+
+def previous_search(categories, string):
+	return [cat for cat in categories.keys() if any([string in sub.lower() for sub in categories[cat]['subreddits']])]
+
+def previous_cat_search(categories, string):
+	return [cat for cat in categories.keys() if string in cat]
+
+def previous_exclude(categories, category, excluded):
+	excluded_list = [sub.lower() for sub in excluded.split(',')]
+	return [sub for sub in categories[category]['subreddits'] if sub.lower() not in excluded_list]
+
+def measure(name, func, iterations = 20):
+	start = perf_counter()
+	for i in range(iterations):
+		result = func()
+	print(f'{name:36} {(perf_counter() - start) / iterations * 1000:9.3f} ms ({len(result)} results)')
+
+def main(subreddits, per_category):
+	with tempfile.TemporaryDirectory() as directory:
+		filename = os.path.join(directory, 'categories')
+		write_categories_file(filename, subreddits, per_category)
+		categories = load_categories(filename)
+
+		start = perf_counter()
+		index = CategoryIndex.load(filename)
+		print(f'{subreddits} subreddits in {len(categories)} categories, index built in {perf_counter() - start:.2f}s')
+
+	category = next(iter(categories.keys()))
+	excluded = ','.join(categories[category]['subreddits'][:3])
+
+	for string in ['memegif12', 'earth', 'ar']:
+		measure(f'-search {string} (scan)', lambda: previous_search(categories, string))
+		measure(f'-search {string} (index)', lambda: index.search_subreddits(string))
+	for string in ['_123', 'history_1']:
+		measure(f'-cat_search {string} (scan)', lambda: previous_cat_search(categories, string))
+		measure(f'-cat_search {string} (index)', lambda: index.search_categories(string))
+	measure('-e (lowercase per call)', lambda: previous_exclude(categories, category, excluded), 1000)
+	measure('-e (index)', lambda: index.subreddits(category, [sub.lower() for sub in excluded.split(',')]), 1000)
+
+if __name__ == '__main__':
+	subreddits = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+	per_category = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+	main(subreddits, per_category)
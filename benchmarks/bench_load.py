@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+
+# Reddiator benchmark file
+# Module name: benchmarks-bench_load
+# Version: 1.0
+
+# Description: Load test of the whole bot: a trace of Discord messages (recorded or generated) is replayed into
+# on_message at a target rate, against the fake Reddit server (latency, error mix, rate limit) and fake Discord
+# channels. Reports the throughput, the latency percentiles, and the requests sent to Reddit and Discord.
+#
+# Usage: ./benchmarks/bench_load.py [options]
+#  -n <messages>      number of messages of the generated trace (default 500)
+#  -r <rate>          messages per second replayed (default 50, 0 for as fast as possible)
+#  -c <channels>      number of channels of the generated trace (default 10)
+#  -l <latency>       latency of the fake Reddit server, in seconds (default 0.05)
+#  -j <jitter>        random latency added to each Reddit request, in seconds (default 0.02)
+#  -q <quota>         rate limit of the fake Reddit server, in requests per 10 minutes (default none)
+#  -t <trace>         replays this trace file ('<channel> <message>' per line) instead of a generated one
+#  -w <trace>         writes the generated trace to this file
+#  -o <results>       appends the results as a JSON line to this file, to compare runs
+
+import os, sys, getopt, json, asyncio, logging, tempfile
+
+from random import Random
+
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fake_reddit import FakeReddit
+from fake_discord import TraceReplayer, load_trace
+
+SUBREDDITS = [f'sub{i}' for i in range(40)]
+ERROR_SUBREDDITS = {'banned': ['bannedsub'], 'private': ['privatesub'], 'quarantined': ['quarantinedsub'], 'missing': ['missingsub'], 'empty': ['emptysub']}
+NSFW_SUBREDDITS = ['nsfwsub']
+CATEGORIES = {f'cat{i}': SUBREDDITS[i * 8:(i + 1) * 8] + ['bannedsub'] for i in range(5)}
+CHAT = ['lol', 'gg', 'did anyone see the game last night?', 'brb', 'r/funny is the best']
+
+
+def generate_trace(count, channels, seed = 42):
+	rng = Random(seed)
+	all_subreddits = SUBREDDITS * 4 + sum(ERROR_SUBREDDITS.values(), []) + NSFW_SUBREDDITS
+	trace = []
+	for _ in range(count):
+		channel = f'channel{rng.randrange(channels)}'
+		sub = rng.choice(all_subreddits)
+		draw = rng.random()
+		if draw < 0.35:
+			content = f'r! rand {sub}'
+		elif draw < 0.60:
+			content = f'r! top {sub} {rng.choice([10, 25, 50])} {rng.choice(["all", "week", "day"])}'
+		elif draw < 0.75:
+			content = f'r! list {rng.choice(list(CATEGORIES))}'
+		elif draw < 0.80:
+			content = f'r! vote {sub} 3 {rng.choice(["all", "month"])} {rng.choice(["top", "random"])}'
+		elif draw < 0.85:
+			content = 'r! help'
+		elif draw < 0.90:
+			content = 'r! frobnicate now'
+		else:
+			content = rng.choice(CHAT)
+		trace.append((channel, content))
+	return trace
+
+def percentile(values, p):
+	if len(values) == 0:
+		return 0.0
+	values = sorted(values)
+	return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+def summarize(values):
+	return {'count': len(values), 'p50': percentile(values, 50), 'p95': percentile(values, 95), 'p99': percentile(values, 99), 'max': max(values) if values else 0.0}
+
+def command_name(content):
+	chunks = content.split(' ')
+	return chunks[1] if content.startswith('r! ') and len(chunks) > 1 else 'chat'
+
+def main(messages, rate, channels, latency, jitter, quota, trace_filename, write_filename, output_filename):
+	fake = FakeReddit(latency = latency, jitter = jitter, nsfw_subreddits = NSFW_SUBREDDITS,
+		banned_subreddits = ERROR_SUBREDDITS['banned'], private_subreddits = ERROR_SUBREDDITS['private'],
+		quarantined_subreddits = ERROR_SUBREDDITS['quarantined'], missing_subreddits = ERROR_SUBREDDITS['missing'],
+		empty_subreddits = ERROR_SUBREDDITS['empty'], ratelimit = (quota, 600) if quota > 0 else None).start()
+
+	# the bot reads its configuration when it's imported
+	os.environ.update({'REDDIT_WWW_URL': fake.url, 'REDDIT_OAUTH_URL': fake.url, 'REDDIT_CLIENT_ID': 'bench',
+		'REDDIT_CLIENT_SECRET': 'bench', 'REDDIT_REFRESH_TOKEN': 'bench'})
+	if quota == 0:
+		# no quota announced by the server: the rate-limit governor must not be the bottleneck
+		os.environ.setdefault('REDDIT_RATE_LIMIT_RATE', '1000')
+		os.environ.setdefault('REDDIT_RATE_LIMIT_BURST', '1000')
+	import reddiator
+	from utils.logs import setup_logging
+	# not connected: the handlers only need the client to recognize the bot's own messages
+	reddiator.client = reddiator.build_client()
+	from utils.metrics import METRICS
+
+	directory = tempfile.mkdtemp()
+	setup_logging(os.path.join(directory, 'bench_load.log'), logging.INFO)
+	categories_filename = os.path.join(directory, 'categories')
+	with open(categories_filename, 'w') as f:
+		for name, subreddits in CATEGORIES.items():
+			f.write(f'{name}:{",".join(subreddits)}\n')
+	reddiator.CATEGORY_STORE.filename = categories_filename
+	reddiator.CATEGORY_STORE.load()
+
+	if trace_filename is not None:
+		trace = load_trace(trace_filename)
+	else:
+		trace = generate_trace(messages, channels)
+		if write_filename is not None:
+			with open(write_filename, 'w') as f:
+				f.write(''.join([f'{channel} {content}\n' for channel, content in trace]))
+
+	# Discord's actual limit: 5 messages per 5 seconds per channel
+	replayer = TraceReplayer(trace, latency = 0.05, limit = 5, period = 5.0)
+
+	async def run():
+		latencies, duration = await replayer.replay(reddiator.on_message, rate)
+		await reddiator.OUTBOX.flush()
+		return latencies, duration
+
+	latencies, duration = asyncio.run(run())
+
+	per_command = {}
+	for content, seconds in latencies:
+		per_command.setdefault(command_name(content), []).append(seconds)
+	snapshot = METRICS.snapshot()
+	errors = {dict(labels)['code']: value for (name, labels), value in snapshot['counters'].items() if name == 'command_errors'}
+	outbox = reddiator.OUTBOX.stats()
+	results = {'time': time(), 'messages': len(trace), 'rate': rate, 'latency': latency, 'jitter': jitter, 'quota': quota,
+		'duration': duration, 'throughput': len(trace) / duration,
+		'on_message': summarize([seconds for _, seconds in latencies]),
+		'commands': {name: summarize(values) for name, values in sorted(per_command.items())},
+		'errors': errors, 'reddit_requests': fake.request_count, 'reddit_endpoints': fake.endpoint_counts,
+		'reddit_throttled': fake.throttled_count, 'discord_api_calls': replayer.api_calls(), 'discord_rate_limited': replayer.rate_limited(),
+		'delivery': outbox['latency']}
+	fake.stop()
+
+	print(f'{results["messages"]} messages in {duration:.2f} s: {results["throughput"]:.1f} messages/s (target {rate if rate > 0 else "max"})')
+	print(f'on_message latency  : p50 {results["on_message"]["p50"] * 1000:7.1f} ms, p95 {results["on_message"]["p95"] * 1000:7.1f} ms, p99 {results["on_message"]["p99"] * 1000:7.1f} ms')
+	for name, stats in results['commands'].items():
+		print(f'  {name:10} n={stats["count"]:<5} p50 {stats["p50"] * 1000:7.1f} ms, p95 {stats["p95"] * 1000:7.1f} ms, p99 {stats["p99"] * 1000:7.1f} ms')
+	print(f'delivery to Discord : p50 {results["delivery"]["p50"] * 1000:7.1f} ms, p99 {results["delivery"]["p99"] * 1000:7.1f} ms')
+	print(f'Reddit requests     : {results["reddit_requests"]} ({results["reddit_throttled"]} throttled) {results["reddit_endpoints"]}')
+	print(f'Discord API calls   : {results["discord_api_calls"]} ({results["discord_rate_limited"]} rate limited)')
+	print(f'errors by code      : {results["errors"]}')
+
+	if output_filename is not None:
+		with open(output_filename, 'a') as f:
+			f.write(json.dumps(results) + '\n')
+
+if __name__ == '__main__':
+	opts, args = getopt.getopt(sys.argv[1:], 'n:r:c:l:j:q:t:w:o:')
+	options = dict(opts)
+	main(messages = int(options.get('-n', '500')), rate = float(options.get('-r', '50')), channels = int(options.get('-c', '10')),
+		latency = float(options.get('-l', '0.05')), jitter = float(options.get('-j', '0.02')), quota = int(options.get('-q', '0')),
+		trace_filename = options.get('-t'), write_filename = options.get('-w'), output_filename = options.get('-o'))
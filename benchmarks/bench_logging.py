@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+
+# Reddiator benchmark file
+# Module name: benchmarks-bench_logging
+# Version: 1.0
+
+# Description: Measures the time spent in the thread that logs (i.e. the event loop of the bot), with the previous
+# logging (logger looked up on every call, f-strings, synchronous file handler) and with the queued pipeline,
+# for enabled and for filtered messages.
+#
+# Usage: ./benchmarks/bench_logging.py [messages]
+
+import os, sys, logging, tempfile
+
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.logs import get_logger, setup_logging, stop_logging, INFO
+
+SUBREDDIT = 'EarthPorn'
+POSTS = list(range(50))
+
+
+def previous_log(msg):
+	logger = logging.getLogger('bench')
+	logger.log(21, '\t' + msg)
+
+LOGGER = get_logger('bench')
+
+def custom_info_log(msg, *args):
+	LOGGER.log(INFO, '\t' + msg, *args)
+
+def run_previous(count):
+	start = perf_counter()
+	for i in range(count):
+		previous_log(f'Successfully fetched {len(POSTS)} links from the top posts of {SUBREDDIT} ({i})')
+	return perf_counter() - start
+
+def run_queued(count):
+	start = perf_counter()
+	for i in range(count):
+		custom_info_log('Successfully fetched %s links from the top posts of %s (%s)', len(POSTS), SUBREDDIT, i)
+	return perf_counter() - start
+
+def reset_root():
+	root = logging.getLogger()
+	for handler in root.handlers:
+		handler.close()
+	root.handlers = []
+
+def main(count):
+	directory = tempfile.mkdtemp()
+	for level, label in [(INFO, 'enabled'), (logging.WARNING, 'filtered')]:
+		reset_root()
+		logging.basicConfig(filename = os.path.join(directory, 'previous.log'), filemode = 'a',
+			format = '%(asctime)s,%(msecs)d %(name)s %(levelname)s\t %(message)s', level = level)
+		previous = run_previous(count)
+
+		reset_root()
+		listener = setup_logging(os.path.join(directory, 'queued.log'), level)
+		queued = run_queued(count)
+		stop_logging(listener)
+
+		print(f'{label:8} previous : {previous / count * 1e6:6.2f} us per message in the logging thread')
+		print(f'{label:8} queued   : {queued / count * 1e6:6.2f} us per message in the logging thread')
+
+if __name__ == '__main__':
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+
+# Reddiator benchmark file
+# Module name: benchmarks-bench_metadata
+# Version: 1.0
+
+# Description: Metadata (NSFW status, availability) of the subreddits of a category set on the fake Reddit server,
+# requested one subreddit at a time and with the bulk lookup, both starting from an empty cache.
+# Reports the requests and the time each needed, and checks that both give the same result for every subreddit.
+#
+# Usage: ./benchmarks/bench_metadata.py [subreddits] [latency]
+
+import os, sys, logging, tempfile
+
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fake_reddit import FakeReddit
+
+
+def main(count, latency):
+	subreddits = [f'sub{i}' for i in range(count)]
+	# a category set as it usually ages: some NSFW subreddits, a few dead ones of every kind
+	fake = FakeReddit(latency = latency, nsfw_subreddits = subreddits[::7], banned_subreddits = subreddits[1::50],
+		private_subreddits = subreddits[2::50], quarantined_subreddits = subreddits[3::100], missing_subreddits = subreddits[4::50]).start()
+	os.environ.update({'REDDIT_WWW_URL': fake.url, 'REDDIT_OAUTH_URL': fake.url, 'REDDIT_CLIENT_ID': 'bench',
+		'REDDIT_CLIENT_SECRET': 'bench', 'REDDIT_REFRESH_TOKEN': 'bench', 'REDDIT_RATE_LIMIT_RATE': '1000', 'REDDIT_RATE_LIMIT_BURST': '1000',
+		'SUBREDDIT_CACHE_SIZE': str(2 * count)})
+	from utils.logs import setup_logging
+	from utils.reddit import SUBREDDIT_CACHE, get_access_token, get_subreddits_metadata, request_subreddit_about, PRIORITY_BACKGROUND
+
+	setup_logging(os.path.join(tempfile.mkdtemp(), 'bench_metadata.log'), logging.INFO)
+	get_access_token()
+
+	results = {}
+	for name, lookup in [('one by one', lambda: {sub: request_subreddit_about(sub, PRIORITY_BACKGROUND) for sub in subreddits}),
+			('bulk', lambda: get_subreddits_metadata(subreddits, PRIORITY_BACKGROUND))]:
+		SUBREDDIT_CACHE.clear()
+		requests = fake.request_count
+		start = perf_counter()
+		results[name] = lookup()
+		elapsed = perf_counter() - start
+		print(f'{name:10} : {fake.request_count - requests:5} requests, {elapsed * 1000:8.1f} ms for {count} subreddits')
+
+	errors = {}
+	for metadata in results['bulk'].values():
+		errors[metadata.get('error')] = errors.get(metadata.get('error'), 0) + 1
+	assert results['bulk'] == results['one by one'], 'the bulk lookup differs from the one by one lookup'
+	print(f'same metadata for all the subreddits: {errors.pop(None)} live, unavailable by code {dict(sorted(errors.items()))}')
+	fake.stop()
+
+if __name__ == '__main__':
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000, float(sys.argv[2]) if len(sys.argv) > 2 else 0.05)
@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+
+# Reddiator benchmark file
+# Module name: benchmarks-bench_outbox
+# Version: 1.0
+
+# Description: Sends bursts of messages to fake Discord channels enforcing the per-channel rate limit,
+# directly from the handlers (retrying on 429 like the library does) and through the outbox.
+#
+# Usage: ./benchmarks/bench_outbox.py [channels] [messages per channel]
+
+import os, sys, asyncio
+
+from time import perf_counter
+
+from fake_discord import FakeChannel
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.outbox import Outbox
+
+
+async def send_directly(channel, content):
+	while True:
+		try:
+			return await channel.send(content)
+		except Exception as e:
+			await asyncio.sleep(e.retry_after)
+
+async def run_direct(channels, count):
+	await asyncio.gather(*[send_directly(channel, f'message {i}') for channel in channels for i in range(count)])
+
+async def run_outbox(channels, count):
+	outbox = Outbox()
+	handlers_done = perf_counter()
+	for channel in channels:
+		for i in range(count):
+			outbox.send(channel, f'message {i}')
+	handlers_done = perf_counter() - handlers_done
+	await outbox.flush()
+	return outbox, handlers_done
+
+def report(name, channels, duration):
+	sends = sum([len(c.messages) for c in channels])
+	calls = sum([c.api_calls for c in channels])
+	limited = sum([c.rate_limited for c in channels])
+	print(f'{name:8} {duration:6.2f}s, {sends} Discord messages, {calls} API calls, {limited} responses 429')
+
+def main(channel_count, count):
+	print(f'{channel_count} channels, {count} messages queued at once per channel')
+
+	channels = [FakeChannel(f'c{i}') for i in range(channel_count)]
+	start = perf_counter()
+	asyncio.run(run_direct(channels, count))
+	report('direct', channels, perf_counter() - start)
+
+	channels = [FakeChannel(f'c{i}') for i in range(channel_count)]
+	start = perf_counter()
+	outbox, handlers_done = asyncio.run(run_outbox(channels, count))
+	report('outbox', channels, perf_counter() - start)
+	print(f'handlers were free after {handlers_done * 1000:.2f} ms, outbox stats: {outbox.stats()}')
+
+if __name__ == '__main__':
+	channel_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+	count = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+	main(channel_count, count)
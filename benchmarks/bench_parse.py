@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+
+# Reddiator benchmark file
+# Module name: benchmarks-bench_parse
+# Version: 1.0
+
+# Description: Compares the parsing of listings into Post records against the previous code
+# (two json.loads of the same body to build the lists of links and permalinks), in time and peak memory.
+#
+# Usage: ./benchmarks/bench_parse.py [listing size] [iterations]
+
+import os, sys, json, tracemalloc
+
+from time import perf_counter
+
+from fake_reddit import build_listing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils import posts
+
+
+def previous_parse(text):
+	links = [items['data']['url'] for items in json.loads(text)['data']['children']]
+	permalinks = [items['data']['permalink'] for items in json.loads(text)['data']['children']]
+	return links, permalinks
+
+def measure(name, func, text, iterations):
+	start = perf_counter()
+	for i in range(iterations):
+		func(text)
+	duration = (perf_counter() - start) / iterations
+
+	tracemalloc.start()
+	result = func(text)
+	retained, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+
+	print(f'{name:28} {duration * 1000:8.3f} ms per listing, peak memory {peak / 1024:8.1f} KiB, retained {retained / 1024:6.1f} KiB')
+
+def main(size, iterations):
+	text = json.dumps(build_listing('benchmark', size))
+	print(f'Listing of {size} posts ({len(text) / 1024:.0f} KiB), decoder: {posts.json_loads.__module__}')
+
+	measure('previous code', previous_parse, text, iterations)
+	measure('parse_listing', posts.parse_listing, text, iterations)
+
+	# same comparison without orjson, to show what the single parse pass alone brings
+	posts.json_loads = json.loads
+	measure('parse_listing (stdlib json)', posts.parse_listing, text, iterations)
+
+if __name__ == '__main__':
+	size = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+	iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+	main(size, iterations)
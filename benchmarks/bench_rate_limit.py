@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+
+# Reddiator benchmark file
+# Module name: benchmarks-bench_rate_limit
+# Version: 1.0
+
+# Description: Fires a burst of interactive and background requests at a local fake Reddit server announcing
+# a small quota in its X-Ratelimit-* headers, and reports how the rate-limit governor spread, queued and shed them.
+#
+# Usage: ./benchmarks/bench_rate_limit.py [quota] [window in seconds] [interactive requests] [background requests]
+
+import os, sys, asyncio
+
+from time import perf_counter
+
+from fake_reddit import FakeReddit
+
+def main(quota, window, interactive, background):
+	fake_reddit = FakeReddit(latency = 0.02, ratelimit = (quota, window)).start()
+
+	os.environ['REDDIT_WWW_URL'] = fake_reddit.url
+	os.environ['REDDIT_OAUTH_URL'] = fake_reddit.url
+	os.environ.setdefault('REDDIT_MAX_REQUESTS_IN_FLIGHT', '16')
+	os.environ.setdefault('REDDIT_BACKGROUND_RESERVE', str(quota // 4))
+	os.environ.setdefault('REDDIT_MAX_QUEUE_WAIT', str(window * 2))
+	for var in ['REDDIT_CLIENT_ID', 'REDDIT_CLIENT_SECRET', 'REDDIT_REFRESH_TOKEN', 'REDDIT_USER_AGENT']:
+		os.environ.setdefault(var, 'benchmark')
+
+	sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+	from utils import reddit
+
+	latencies = {reddit.PRIORITY_INTERACTIVE: [], reddit.PRIORITY_BACKGROUND: []}
+	outcomes = {}
+
+	async def one_request(i, priority):
+		start = perf_counter()
+		try:
+			await reddit.get_random_post_from_subreddit_async(f'sub{i}', priority)
+			outcome = 'ok'
+			latencies[priority].append(perf_counter() - start)
+		except reddit.RequestException as e:
+			outcome = f'code {e.code}'
+		outcomes[(priority, outcome)] = outcomes.get((priority, outcome), 0) + 1
+
+	async def run():
+		# background requests are queued first, interactive ones must still go ahead of them
+		requests = [one_request(i, reddit.PRIORITY_BACKGROUND) for i in range(background)]
+		requests = requests + [one_request(i, reddit.PRIORITY_INTERACTIVE) for i in range(interactive)]
+		await asyncio.gather(*requests)
+
+	start = perf_counter()
+	asyncio.run(run())
+	duration = perf_counter() - start
+	fake_reddit.stop()
+
+	print(f'Quota of {quota} requests per {window}s, {interactive} interactive and {background} background requests, done in {duration:.2f}s')
+	for (priority, outcome), count in sorted(outcomes.items()):
+		name = 'interactive' if priority == reddit.PRIORITY_INTERACTIVE else 'background'
+		print(f'{name:12} {outcome:8} {count}')
+	for priority, name in [(reddit.PRIORITY_INTERACTIVE, 'interactive'), (reddit.PRIORITY_BACKGROUND, 'background')]:
+		if len(latencies[priority]) > 0:
+			print(f'{name:12} mean latency {sum(latencies[priority]) / len(latencies[priority]):.2f}s')
+	print(f'429 responses from the fake server: {fake_reddit.throttled_count}')
+	print(f'governor: {reddit.GOVERNOR.stats()}')
+
+if __name__ == '__main__':
+	args = [int(a) for a in sys.argv[1:]]
+	defaults = [40, 4, 50, 50]
+	main(*(args + defaults[len(args):]))
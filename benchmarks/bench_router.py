@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+
+# Reddiator benchmark file
+# Module name: benchmarks-bench_router
+# Version: 1.0
+
+# Description: Measures the per-message overhead of recognizing and parsing commands, on a stream of
+# mostly non-command messages, with the previous check (splitting every message) and with the router.
+#
+# Usage: ./benchmarks/bench_router.py [messages] [percentage of commands]
+
+import os, sys
+
+from random import Random
+
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.router import Router, Command, Argument, CommandError, is_command
+
+PERIODS = ['hour','hours','now','day','days','today','week','weeks','month','months','year','years','all']
+
+CHAT = ['lol', 'did anyone see the game last night?', 'brb', 'https://www.reddit.com/r/aww/comments/abc/def/',
+	'I think the new patch is great but the matchmaking is still broken, anyone else having this issue since yesterday evening?',
+	'r!', 'gg wp', 'r/funny is the best']
+COMMANDS = ['r! rand aww', 'r! top pics 20 week', 'r! vote EarthPorn 5 month top', 'r! list animals', 'r! help top']
+
+async def handler(msg, **kwargs):
+	pass
+
+def previous(content):
+	message_chunks = content.split(' ')
+	if message_chunks[0] == 'r!' and len(message_chunks) > 1:
+		return message_chunks[1].lower()
+	return None
+
+def build_router():
+	router = Router()
+	router.register(Command('rand', handler, required = 'subreddit'))
+	router.register(Command('top', handler, required = 'subreddit', optional = [Argument('number', 'int', maximum = 100), Argument('timespan', 'choice', PERIODS)]))
+	router.register(Command('vote', handler, required = 'subreddit', optional = [Argument('N', 'int', maximum = 5), Argument('timespan', 'choice', PERIODS), Argument('type', 'choice', ['random', 'top'])]))
+	router.register(Command('list', handler, required = 'listname'))
+	router.register(Command('help', handler, optional = [Argument('type', 'string')]))
+	return router
+
+def main(count, percentage):
+	random = Random(42)
+	messages = [random.choice(COMMANDS) if random.random() * 100 < percentage else random.choice(CHAT) for i in range(count)]
+	router = build_router()
+
+	start = perf_counter()
+	for content in messages:
+		previous(content)
+	duration = perf_counter() - start
+	print(f'previous check (split every message) : {duration / count * 1e9:7.1f} ns per message')
+
+	start = perf_counter()
+	for content in messages:
+		if is_command(content):
+			try:
+				router.parse(content)
+			except CommandError:
+				pass
+	duration = perf_counter() - start
+	print(f'prefix check + router parsing        : {duration / count * 1e9:7.1f} ns per message')
+
+if __name__ == '__main__':
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+	percentage = float(sys.argv[2]) if len(sys.argv) > 2 else 1
+	main(count, percentage)
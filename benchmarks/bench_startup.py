@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+
+# Reddiator benchmark file
+# Module name: benchmarks-bench_startup
+# Version: 1.0
+
+# Description: Time-to-first-response of a freshly started bot process, with the previous sequential startup
+# (discord imported first, categories loaded, then the access token fetched by the first command) and with the
+# parallel warm-up (token, categories and snapshots prepared in threads while discord is imported).
+# Each run starts a new process against the fake Reddit server and a synthetic categories file.
+#
+# Usage: ./benchmarks/bench_startup.py [runs] [latency] [number of subreddits]
+
+import os, sys, json, asyncio, logging, subprocess, tempfile
+
+from statistics import median
+
+from time import time, perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fake_reddit import FakeReddit
+from bench_categories import write_categories_file
+
+VARIANTS = ['sequential', 'parallel']
+
+
+# Runs in the child process: starts the bot the given way, handles one command and prints its timings as JSON
+def child(variant, categories_filename):
+	started = perf_counter()
+	if variant == 'sequential':
+		import discord
+	import reddiator
+	from utils.logs import setup_logging
+	from utils.startup import WarmUp
+	from fake_discord import FakeMessage, FakeChannel, FakeAuthor
+	setup_logging(os.path.join(tempfile.mkdtemp(), 'bench_startup.log'), logging.INFO)
+	imported = perf_counter()
+
+	reddiator.CATEGORY_STORE.filename = categories_filename
+	if variant == 'sequential':
+		reddiator.client = discord.Client()
+		reddiator.CATEGORY_STORE.load()
+	else:
+		warm_up = WarmUp(reddiator.get_warm_up_tasks()).start()
+		reddiator.client = reddiator.build_client()
+		warm_up.wait()
+	ready = perf_counter()
+
+	channel = FakeChannel(latency = 0)
+	async def first_command():
+		await reddiator.on_message(FakeMessage('r! rand sub0', channel, FakeAuthor()))
+		await reddiator.OUTBOX.flush()
+	asyncio.run(first_command())
+	responded = perf_counter()
+
+	print(json.dumps({'responded': time(), 'imports': imported - started, 'startup': ready - imported,
+		'first_command': responded - ready, 'sent': len(channel.messages)}))
+
+def run(variant, categories_filename, env):
+	start = time()
+	output = subprocess.run([sys.executable, os.path.abspath(__file__), '-child', variant, categories_filename],
+		env = env, capture_output = True, text = True, check = True).stdout
+	result = json.loads(output.strip().splitlines()[-1])
+	result['total'] = result['responded'] - start
+	return result
+
+def main(runs, latency, subreddits):
+	fake = FakeReddit(latency = latency).start()
+	env = dict(os.environ, REDDIT_WWW_URL = fake.url, REDDIT_OAUTH_URL = fake.url, REDDIT_CLIENT_ID = 'bench',
+		REDDIT_CLIENT_SECRET = 'bench', REDDIT_REFRESH_TOKEN = 'bench', SUBREDDIT_CACHE_FILENAME = '', SEEN_POSTS_FILENAME = '')
+
+	categories_filename = os.path.join(tempfile.mkdtemp(), 'categories')
+	write_categories_file(categories_filename, subreddits, 50)
+
+	# the first process fills the OS file cache: it isn't counted
+	run(VARIANTS[0], categories_filename, env)
+	for variant in VARIANTS:
+		results = [run(variant, categories_filename, env) for _ in range(runs)]
+		assert all([result['sent'] > 0 for result in results])
+		print(f'{variant:10} : time to first response {median([r["total"] for r in results]) * 1000:7.1f} ms '
+			+ f'(imports {median([r["imports"] for r in results]) * 1000:6.1f} ms, '
+			+ f'startup {median([r["startup"] for r in results]) * 1000:6.1f} ms, '
+			+ f'first command {median([r["first_command"] for r in results]) * 1000:6.1f} ms), median of {runs} runs')
+	fake.stop()
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1 and sys.argv[1] == '-child':
+		child(sys.argv[2], sys.argv[3])
+	else:
+		main(int(sys.argv[1]) if len(sys.argv) > 1 else 5, float(sys.argv[2]) if len(sys.argv) > 2 else 0.2,
+			int(sys.argv[3]) if len(sys.argv) > 3 else 20000)
@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+
+# Reddiator benchmark file
+# Module name: benchmarks-bench_vote
+# Version: 1.0
+
+# Description: Number of Discord API calls and wall-clock time of rendering a vote, with the previous rendering
+# (one message per candidate, up/down reactions added one after the other) and with the single-message rendering.
+#
+# Usage: ./benchmarks/bench_vote.py [candidates] [Discord latency in seconds]
+
+import os, sys, asyncio
+
+from time import perf_counter
+
+from fake_discord import FakeChannel
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.votes import render_vote, add_reactions, NUMBER_EMOJIS
+
+
+async def retry(call):
+	while True:
+		try:
+			return await call()
+		except Exception as e:
+			await asyncio.sleep(e.retry_after)
+
+async def previous_vote(channel, links):
+	await retry(lambda: channel.send(f'Here are {len(links)} links from /r/benchmark. Vote for your favourite!\n'))
+	for link in links:
+		r = await retry(lambda: channel.send(link + '\n'))
+		await retry(lambda: r.add_reaction('\U00002B06'))
+		await retry(lambda: r.add_reaction('\U00002B07'))
+
+async def single_message_vote(channel, links):
+	r = await retry(lambda: channel.send(render_vote(links, 'benchmark')))
+	await add_reactions(r, NUMBER_EMOJIS[:len(links)])
+
+def measure(name, vote, count, latency):
+	channel = FakeChannel(latency = latency)
+	links = [f'https://i.redd.it/benchmark_{i}.jpg' for i in range(count)]
+	start = perf_counter()
+	asyncio.run(vote(channel, links))
+	print(f'{name:16} {perf_counter() - start:6.2f}s, {channel.api_calls} API calls ({channel.rate_limited} rate limited)')
+
+if __name__ == '__main__':
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+	latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+	print(f'Vote with {count} candidates, {latency * 1000:.0f} ms per Discord API call')
+	measure('previous', previous_vote, count, latency)
+	measure('single message', single_message_vote, count, latency)
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+# Reddiator benchmark file
+# Module name: benchmarks-bench_watch
+# Version: 1.0
+
+# Description: Watches the new posts of many subreddits of very different activity on the fake Reddit server, with
+# time running 60 times faster (poll intervals of 1 s to 1 min standing for 1 min to 1 h). Reports the requests per
+# watched subreddit per (simulated) hour and the posts transferred, against polling each subreddit on its own every
+# minute, and checks that every new post is dispatched exactly once.
+#
+# Usage: ./benchmarks/bench_watch.py [subreddits] [duration in seconds]
+
+import os, sys, asyncio, logging, tempfile
+
+from random import Random
+
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fake_reddit import FakeReddit
+
+SPEEDUP = 60
+
+
+def main(count, duration):
+	rng = Random(42)
+	# a few busy subreddits (a post every few minutes), most of them quiet (a few posts per day)
+	rates = {f'watched{i}': (rng.uniform(1 / 300, 1 / 60) if i % 20 == 0 else rng.uniform(1 / 86400, 1 / 3600)) * SPEEDUP for i in range(count)}
+	fake = FakeReddit(latency = 0.02, new_post_rates = rates).start()
+	os.environ.update({'REDDIT_WWW_URL': fake.url, 'REDDIT_OAUTH_URL': fake.url, 'REDDIT_CLIENT_ID': 'bench',
+		'REDDIT_CLIENT_SECRET': 'bench', 'REDDIT_REFRESH_TOKEN': 'bench', 'REDDIT_RATE_LIMIT_RATE': '1000', 'REDDIT_RATE_LIMIT_BURST': '1000'})
+	from utils.logs import setup_logging
+	from utils.scheduler import SubscriptionStore
+	from utils.watcher import Watcher
+
+	directory = tempfile.mkdtemp()
+	setup_logging(os.path.join(directory, 'bench_watch.log'), logging.INFO)
+	# creation time of the newest post of each subreddit when it was first polled: the posts after it must all be dispatched
+	initial = {}
+	class RecordingWatcher(Watcher):
+		def update(self, sub, posts, now):
+			first = sub.last_created is None
+			super().update(sub, posts, now)
+			if first:
+				initial[sub.name.lower()] = sub.last_created
+
+	dispatched = []
+	watcher = RecordingWatcher(SubscriptionStore(os.path.join(directory, 'subscriptions.db')), lambda channels, post: dispatched.append(post),
+		tiers = [tier // SPEEDUP for tier in (60, 120, 300, 600, 1800, 3600)], tick = 0.25)
+	for subreddit in rates:
+		watcher.watch(1, subreddit)
+
+	async def run():
+		watcher.start()
+		await asyncio.sleep(duration)
+		watcher.task.cancel()
+
+	start = time()
+	asyncio.run(run())
+	end = time()
+	fake.stop()
+
+	stats = watcher.stats()
+	simulated_hours = (end - start) * SPEEDUP / 3600
+	requests = stats['requests']
+	# the last posts are only seen by the next poll of their subreddit: only the posts older than the slowest interval count
+	cutoff = end - watcher.tiers[-1] - 1
+	expected = sum([fake.new_posts_between(sub, created, cutoff) for sub, created in initial.items() if created < cutoff])
+	on_time = len(set([post.permalink for post in dispatched if post.created <= cutoff]))
+	unique = len(set([post.permalink for post in dispatched]))
+	naive_requests = count * (end - start) / watcher.tiers[0]
+
+	print(f'{count} subreddits watched for {simulated_hours:.1f} simulated hours, {len(watcher.batches)} batches, tiers {stats["tiers"]}')
+	print(f'watcher      : {requests} requests ({requests / count / simulated_hours:.2f} per subreddit per hour), {fake.new_posts_served} posts transferred')
+	print(f'one by one   : {naive_requests:.0f} requests ({naive_requests / count / simulated_hours:.2f} per subreddit per hour), up to {naive_requests * 100:.0f} posts transferred')
+	print(f'dispatched   : {len(dispatched)} posts, {unique} distinct ({len(dispatched) - unique} duplicates), {on_time}/{expected} of the posts created more than one (simulated) hour before the end')
+
+if __name__ == '__main__':
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 200, float(sys.argv[2]) if len(sys.argv) > 2 else 180)
@@ -0,0 +1,154 @@
+# Reddiator benchmark file
+# Module name: benchmarks-fake_discord
+# Version: 1.0
+
+# Description: Stand-ins for the Discord objects used by the bot (channels, messages, authors), with latency and
+# Discord's per-channel rate limit, to benchmark the bot without a live Discord server
+
+import asyncio, itertools
+
+from collections import deque
+
+from time import monotonic
+
+
+IDS = itertools.count(1)
+
+
+class FakeHTTPException(Exception):
+
+	def __init__(self, retry_after):
+		super().__init__(f'429 Too Many Requests (retry after {retry_after:.2f}s)')
+		self.status = 429
+		self.retry_after = retry_after
+
+
+# Sliding-window bucket: at most limit calls per period seconds
+class FakeBucket():
+
+	def __init__(self, limit, period):
+		self.limit = limit
+		self.period = period
+		self.calls = deque()
+
+	def hit(self):
+		now = monotonic()
+		while len(self.calls) > 0 and now - self.calls[0] >= self.period:
+			self.calls.popleft()
+		if len(self.calls) >= self.limit:
+			raise FakeHTTPException(self.period - (now - self.calls[0]))
+		self.calls.append(now)
+
+
+class FakeMessage():
+
+	def __init__(self, content, channel, author = None):
+		self.id = next(IDS)
+		self.content = content
+		self.channel = channel
+		self.author = author
+		self.reactions = []
+
+	async def add_reaction(self, emoji):
+		self.channel.api_calls += 1
+		await asyncio.sleep(self.channel.latency)
+		try:
+			self.channel.reaction_bucket.hit()
+		except FakeHTTPException:
+			self.channel.rate_limited += 1
+			raise
+		self.reactions.append(emoji)
+
+
+class FakeChannel():
+
+	def __init__(self, name = 'general', nsfw = False, latency = 0.05, limit = 5, period = 5.0):
+		self.id = next(IDS)
+		self.name = name
+		self.nsfw = nsfw
+		self.latency = latency
+		self.bucket = FakeBucket(limit, period)
+		self.reaction_bucket = FakeBucket(4, 1.0)
+		self.messages = []
+		self.api_calls = 0
+		self.rate_limited = 0
+
+	def is_nsfw(self):
+		return self.nsfw
+
+	def __str__(self):
+		return self.name
+
+	async def send(self, content = None, embed = None):
+		self.api_calls += 1
+		await asyncio.sleep(self.latency)
+		try:
+			self.bucket.hit()
+		except FakeHTTPException:
+			self.rate_limited += 1
+			raise
+		message = FakeMessage(content, self)
+		message.embed = embed
+		self.messages.append(message)
+		return message
+
+
+class FakeAuthor():
+
+	def __init__(self, name = 'user'):
+		self.id = next(IDS)
+		self.name = name
+
+
+# Trace of messages posted on Discord: one message per line, '<channel> <content>' (channel names are free,
+# a channel named nsfw-... is marked NSFW). Empty lines and lines starting with # are ignored.
+def load_trace(filename):
+	trace = []
+	with open(filename, 'r') as f:
+		for line in f:
+			line = line.rstrip('\n')
+			if len(line.strip()) == 0 or line.startswith('#'):
+				continue
+			channel, content = line.split(' ', 1)
+			trace.append((channel, content))
+	return trace
+
+# Replays a trace into the on_message handler of the bot at a target rate (messages per second, 0 for as fast as
+# possible). The messages are sent on schedule whether or not the previous ones were handled (open loop), as
+# Discord would. Returns the handling time of each message, and the channels (with their API call counters).
+class TraceReplayer():
+
+	def __init__(self, trace, latency = 0.05, limit = 5, period = 5.0):
+		self.trace = trace
+		self.channels = {}
+		self.authors = {}
+		for name, _ in trace:
+			if name not in self.channels:
+				self.channels[name] = FakeChannel(name, nsfw = name.startswith('nsfw'), latency = latency, limit = limit, period = period)
+				self.authors[name] = FakeAuthor(f'user-{name}')
+
+	async def replay(self, on_message, rate = 0):
+		latencies = []
+
+		async def dispatch(message):
+			start = monotonic()
+			await on_message(message)
+			latencies.append((message.content, monotonic() - start))
+
+		start = monotonic()
+		tasks = []
+		for index, (name, content) in enumerate(self.trace):
+			if rate > 0:
+				delay = start + index / rate - monotonic()
+				if delay > 0:
+					await asyncio.sleep(delay)
+			message = FakeMessage(content, self.channels[name], self.authors[name])
+			tasks.append(asyncio.ensure_future(dispatch(message)))
+		await asyncio.gather(*tasks)
+		return latencies, monotonic() - start
+
+	def api_calls(self):
+		return sum([channel.api_calls for channel in self.channels.values()])
+
+	def rate_limited(self):
+		return sum([channel.rate_limited for channel in self.channels.values()])
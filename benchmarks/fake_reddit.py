@@ -0,0 +1,280 @@
+# Reddiator benchmark file
+# Module name: benchmarks-fake_reddit
+# Version: 1.0
+
+# Description: A local stand-in for the Reddit endpoints used by the bot, to benchmark it without a live account
+
+import json, threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from random import randint, uniform
+
+from time import sleep, monotonic, time
+from urllib.parse import urlparse, parse_qs
+
+
+# Posts carry a realistic subset of the (many) fields returned by Reddit, so that parsing benchmarks
+# handle bodies of about the same size as the real ones.
+def build_post(subreddit, index):
+	url = f'https://i.redd.it/{subreddit}_{index}.jpg'
+	return {'kind': 't3', 'data': {
+		'name': f't3_{subreddit}{index}',
+		'id': f'{subreddit}{index}',
+		'subreddit': subreddit,
+		'subreddit_name_prefixed': f'r/{subreddit}',
+		'title': f'Post number {index} of r/{subreddit}, with a title about as long as the usual ones',
+		'selftext': '',
+		'author': f'user_{index}',
+		'author_fullname': f't2_user{index}',
+		'url': url,
+		'url_overridden_by_dest': url,
+		'domain': 'i.redd.it',
+		'permalink': f'/r/{subreddit}/comments/{index}/post_{index}/',
+		'thumbnail': f'https://b.thumbs.redditmedia.com/{subreddit}_{index}.jpg',
+		'over18': False,
+		'spoiler': False,
+		'is_self': False,
+		'is_video': False,
+		'post_hint': 'image',
+		'score': 1000 - index,
+		'ups': 1000 - index,
+		'downs': 0,
+		'upvote_ratio': 0.97,
+		'num_comments': index,
+		'created_utc': 1600000000.0 + index,
+		'gilded': 0,
+		'all_awardings': [],
+		'link_flair_richtext': [],
+		'media': None,
+		'secure_media': None,
+		'preview': {'enabled': True, 'images': [{'id': f'img{index}',
+			'source': {'url': url, 'width': 1080, 'height': 1350},
+			'resolutions': [{'url': f'{url}?width={w}', 'width': w, 'height': w * 5 // 4} for w in (108, 216, 320, 640, 960)]}]}}}
+
+def build_listing(subreddit, count, offset = 0):
+	children = [build_post(subreddit, i) for i in range(offset, offset + count)]
+	return {'kind': 'Listing', 'data': {'modhash': None, 'dist': count, 'children': children, 'after': None, 'before': None}}
+
+# The k-th new post of a subreddit is created at start + k / rate (rate in posts per second)
+def build_new_post(subreddit, k, start, rate):
+	post = build_post(subreddit, k)
+	url = f'https://i.redd.it/{subreddit}_new{k}.jpg'
+	post['data'].update({'name': f't3_{subreddit}_{k}', 'id': f'{subreddit}_{k}', 'created_utc': start + k / rate, 'url': url,
+		'url_overridden_by_dest': url, 'permalink': f'/r/{subreddit}/comments/new{k}/post_{k}/'})
+	return post
+
+# /new of a subreddit or a multireddit (a+b+c), newest first. With before, the limit posts following the post
+# of this fullname (as Reddit, nothing if the post isn't in the listing).
+def build_new_listing(server, members, limit, before):
+	now = time()
+	entries = []
+	if before is None:
+		for member in members:
+			rate = server.new_post_rates.get(member, server.new_post_rate)
+			newest = int((now - server.new_start) * rate)
+			entries.extend([(member, k, rate) for k in range(max(newest - limit + 1, 0), newest + 1)])
+		entries.sort(key = lambda entry: entry[1] / entry[2], reverse = True)
+		entries = entries[:limit]
+	else:
+		sub, _, k = before[3:].rpartition('_')
+		if sub not in members or not k.isdigit():
+			entries = []
+		else:
+			since = int(k) / server.new_post_rates.get(sub, server.new_post_rate)
+			for member in members:
+				rate = server.new_post_rates.get(member, server.new_post_rate)
+				newest = int((now - server.new_start) * rate)
+				first = int(since * rate) + 1
+				entries.extend([(member, k, rate) for k in range(first, min(first + limit, newest + 1)) if k / rate > since])
+			entries.sort(key = lambda entry: entry[1] / entry[2])
+			entries = entries[:limit][::-1]
+	with server.lock:
+		server.new_posts_served += len(entries)
+	children = [build_new_post(member, k, server.new_start, rate) for member, k, rate in entries]
+	return {'kind': 'Listing', 'data': {'modhash': None, 'dist': len(children), 'children': children, 'after': None, 'before': None}}
+
+
+# /api/info?sr_name=a,b,c: the existing subreddits among the given ones (private ones only with their type,
+# quarantined ones flagged), nothing for the banned and missing ones
+def build_info_listing(server, names):
+	children = []
+	for name in names:
+		sub = name.lower()
+		if len(sub) == 0 or sub in server.banned_subreddits or sub in server.missing_subreddits:
+			continue
+		if sub in server.private_subreddits:
+			children.append({'kind': 't5', 'data': {'display_name': name, 'subreddit_type': 'private'}})
+		else:
+			children.append({'kind': 't5', 'data': {'display_name': name, 'subreddit_type': 'public', 'over18': sub in server.nsfw_subreddits,
+				'quarantine': sub in server.quarantined_subreddits}})
+	return {'kind': 'Listing', 'data': {'modhash': None, 'dist': len(children), 'children': children, 'after': None, 'before': None}}
+
+
+class FakeRedditHandler(BaseHTTPRequestHandler):
+
+	protocol_version = 'HTTP/1.1'
+	disable_nagle_algorithm = True
+
+	def log_message(self, format, *args):
+		pass
+
+	def send_json(self, status, payload):
+		body = json.dumps(payload).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		for name, value in self.extra_headers.items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def handle_request(self):
+		server = self.server
+		url = urlparse(self.path)
+		query = parse_qs(url.query)
+		parts = [p for p in url.path.split('/') if p]
+
+		subreddit = parts[1].lower() if len(parts) >= 2 and parts[0] == 'r' else None
+		# members of a multireddit (e.g. /r/a+b+c/new): the request fails if any of them does
+		members = set(subreddit.split('+')) if subreddit is not None else set()
+		endpoint = '/r/*/' + parts[2].replace('.json', '') if subreddit is not None and len(parts) == 3 else url.path
+
+		self.extra_headers = {}
+		with server.lock:
+			server.request_count += 1
+			server.endpoint_counts[endpoint] = server.endpoint_counts.get(endpoint, 0) + 1
+			limited = url.path != '/api/v1/access_token' and server.consume_quota(self.extra_headers)
+
+		sleep(server.latency + uniform(0, server.jitter))
+
+		if limited:
+			self.send_json(429, {'message': 'Too Many Requests', 'error': 429})
+		elif members & server.banned_subreddits:
+			self.send_json(404, {'reason': 'banned', 'message': 'Not Found', 'error': 404})
+		elif members & server.private_subreddits:
+			self.send_json(403, {'reason': 'private', 'message': 'Forbidden', 'error': 403})
+		elif members & server.quarantined_subreddits:
+			self.send_json(403, {'reason': 'quarantined', 'quarantine_message': 'This community is quarantined', 'message': 'Forbidden', 'error': 403})
+		elif members & server.missing_subreddits:
+			# Reddit redirects the requests for subreddits that don't exist to its search page
+			self.extra_headers['Location'] = f'/subreddits/search.json?q={subreddit}'
+			self.send_json(302, {})
+		elif subreddit in server.empty_subreddits and parts[2] in ('top', 'random'):
+			self.send_json(200, build_listing(subreddit, 0))
+		elif url.path == '/api/v1/access_token':
+			self.send_json(200, {'access_token': 'fake-token', 'token_type': 'bearer', 'expires_in': 3600, 'scope': 'read'})
+		elif url.path == '/api/info':
+			self.send_json(200, build_info_listing(server, query.get('sr_name', [''])[0].split(',')))
+		elif len(parts) == 3 and parts[0] == 'r' and parts[2] in ('about', 'about.json'):
+			self.send_json(200, {'kind': 't5', 'data': {'display_name': parts[1], 'over18': parts[1] in server.nsfw_subreddits}})
+		elif len(parts) == 3 and parts[0] == 'r' and parts[2] == 'random':
+			self.send_json(200, [build_listing(parts[1], 1, offset = randint(0, 999))])
+		elif len(parts) == 3 and parts[0] == 'r' and parts[2] == 'top':
+			limit = int(query.get('limit', ['25'])[0])
+			self.send_json(200, build_listing(parts[1], limit))
+		elif len(parts) == 3 and parts[0] == 'r' and parts[2] == 'new':
+			limit = int(query.get('limit', ['25'])[0])
+			self.send_json(200, build_new_listing(server, sorted(members), limit, query.get('before', [None])[0]))
+		else:
+			self.send_json(404, {'message': 'Not Found', 'error': 404})
+
+	def do_GET(self):
+		self.handle_request()
+
+	def do_POST(self):
+		length = int(self.headers.get('Content-Length', 0))
+		self.rfile.read(length)
+		self.handle_request()
+
+
+class FakeRedditServer(ThreadingHTTPServer):
+
+	# Scripted rate limit: quota requests per window seconds, announced with Reddit's X-Ratelimit-* headers.
+	# Returns True (and sets Retry-After) if the request is over the quota. Must be called with the lock held.
+	def consume_quota(self, headers):
+		if self.ratelimit is None:
+			return False
+		quota, window = self.ratelimit
+		now = monotonic()
+		if now - self.window_start >= window:
+			self.window_start = now
+			self.window_used = 0
+		reset = window - (now - self.window_start)
+		self.window_used += 1
+		headers['X-Ratelimit-Used'] = str(self.window_used)
+		headers['X-Ratelimit-Remaining'] = str(max(quota - self.window_used, 0))
+		headers['X-Ratelimit-Reset'] = str(int(reset))
+		if self.window_used > quota:
+			self.throttled_count += 1
+			headers['Retry-After'] = str(int(reset) + 1)
+			return True
+		return False
+
+
+class FakeReddit():
+
+	# Error mix: requests for banned subreddits get a 404, private and quarantined ones a 403, missing ones a 302
+	# to the search page, and empty ones an empty listing (as Reddit does for subreddits without posts).
+	# New posts are created in each subreddit at new_post_rates[subreddit] (default new_post_rate) posts per second,
+	# starting from an hour before the server starts.
+	def __init__(self, latency = 0.1, nsfw_subreddits = (), banned_subreddits = (), ratelimit = None, jitter = 0,
+			private_subreddits = (), quarantined_subreddits = (), missing_subreddits = (), empty_subreddits = (),
+			new_post_rate = 0.01, new_post_rates = None):
+		self.server = FakeRedditServer(('127.0.0.1', 0), FakeRedditHandler)
+		self.server.ratelimit = ratelimit
+		self.server.window_start = monotonic()
+		self.server.window_used = 0
+		self.server.throttled_count = 0
+		self.server.daemon_threads = True
+		self.server.latency = latency
+		self.server.nsfw_subreddits = set(nsfw_subreddits)
+		self.server.jitter = jitter
+		self.server.banned_subreddits = set(banned_subreddits)
+		self.server.private_subreddits = set(private_subreddits)
+		self.server.quarantined_subreddits = set(quarantined_subreddits)
+		self.server.missing_subreddits = set(missing_subreddits)
+		self.server.empty_subreddits = set(empty_subreddits)
+		self.server.new_post_rate = new_post_rate
+		self.server.new_post_rates = {sub.lower(): rate for sub, rate in (new_post_rates or {}).items()}
+		self.server.new_start = time() - 3600
+		self.server.new_posts_served = 0
+		self.server.request_count = 0
+		self.server.endpoint_counts = {}
+		self.server.lock = threading.Lock()
+		self.thread = threading.Thread(target = self.server.serve_forever, daemon = True)
+
+	@property
+	def url(self):
+		host, port = self.server.server_address
+		return f'http://{host}:{port}'
+
+	@property
+	def request_count(self):
+		return self.server.request_count
+
+	@property
+	def endpoint_counts(self):
+		return dict(self.server.endpoint_counts)
+
+	@property
+	def new_posts_served(self):
+		return self.server.new_posts_served
+
+	# Number of posts created in the subreddit between the two times
+	def new_posts_between(self, subreddit, start, end):
+		rate = self.server.new_post_rates.get(subreddit.lower(), self.server.new_post_rate)
+		# start is usually the creation time of a post: rounded, so that start + k / rate counts as the k-th post
+		return int((end - self.server.new_start) * rate) - int(round((start - self.server.new_start) * rate, 6))
+
+	@property
+	def throttled_count(self):
+		return self.server.throttled_count
+
+	def start(self):
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
@@ -43,7 +43,7 @@ VERSION = '0.5.3'
 ###
 #
 #= r! vote $subreddit [N] [period] [type]
-#- Responds with N posts from $subreddit and adds up and down arrow as reactions to let people vote.
+#- Responds with N posts from $subreddit in a single message, and adds a numbered reaction per post to let people vote.
 #
 #- Optional parameter [N] can be used to specify how many posts must be posted.
 #  Default is 3, limit is 5.
@@ -59,174 +59,306 @@ VERSION = '0.5.3'
 # If no command is specified, the bot will display the general help menu, with the available commands
 
 
-import os, sys, getopt, psutil, logging
+import os, sys, getopt, logging, asyncio
 
-import discord
-client = discord.Client()
+from time import time, perf_counter
 
-from dotenv import load_dotenv
+STARTED = perf_counter()
 
-import json
+from utils.shards import get_worker_shards, build_supervisor
+from utils.shared_store import SharedStore
+from utils.startup import acquire_instance_lock, WarmUp
 
-from random import randint
+# In a sharded deployment, each worker process connects to the range of shards given by the supervisor
+SHARD_IDS, SHARD_COUNT = get_worker_shards()
 
-from time import time
+# discord.py is by far the longest import of the bot: it is only imported when the client is built (see __main__),
+# while the warm-up tasks run. The event handlers are registered on the client once it's built.
+client = None
+EVENT_HANDLERS = []
 
-from utils.reddit import *
+def build_client():
+	import discord
+	if SHARD_COUNT is None:
+		return discord.Client()
+	return discord.AutoShardedClient(shard_ids = SHARD_IDS, shard_count = SHARD_COUNT)
 
-def custom_info_log(msg):
-	logger = logging.getLogger('root')
-	logger.log(21, '\t\t' + msg)
+def event(handler):
+	EVENT_HANDLERS.append(handler)
+	return handler
+
+import json
 
-def load_categories(filename):
-	with open(filename, 'r') as f:
-		categories = {}
-		for line in f.readlines():
-			line_split = line.split(':')
-			categories[line_split[0].replace('','').lower()] = {'name' : line_split[0], 'subreddits' : [a.replace('\n','') for a in line_split[1].split(',')]}
-	return categories
+from random import randint, sample, choice
 
-async def respond(msg, link, permalink, subreddit):
+from utils.reddit import *
+from utils.reservoir import build_reservoir
+from utils.categories import CategoryStore
+from utils.router import Router, Command, Argument, CommandError, is_command
+from utils.outbox import build_outbox
+from utils.votes import VoteTracker, render_vote, render_results, add_reactions, NUMBER_EMOJIS
+from utils.seen import build_seen_posts
+from utils.health import build_category_health
+from utils.scheduler import build_scheduler, format_duration
+from utils.watcher import build_watcher
+from utils.logs import get_logger, setup_logging, new_correlation_id, INFO
+
+PERIODS = ['hour','hours','now','day','days','today','week','weeks','month','months','year','years','all']
+LIST_OPTIONS = ['-subs', '-category_search', '-cat_search', '-catsearch', '-csearch', '-search', '-e', '-exclude', '-ex']
+from utils.metrics import LatencyRecorder, METRICS, start_metrics_server, format_summary
+
+CATEGORY_STORE = CategoryStore()
+CATEGORY_HEALTH = build_category_health(lambda: CATEGORY_STORE.index)
+RESERVOIR = build_reservoir(lambda category: CATEGORY_HEALTH.pick(category, False))
+COMMAND_LATENCY = LatencyRecorder('commands')
+STATS_TASK = None
+HEALTH_TASK = None
+STARTUP_TIMES = {'warm_up': None, 'ready': None, 'first_response': None}
+OUTBOX = build_outbox()
+VOTES = VoteTracker()
+VOTE_DURATION = int(os.getenv('VOTE_DURATION', '3600'))
+SEEN_POSTS = build_seen_posts()
+LIST_FANOUT = int(os.getenv('LIST_FANOUT', '3'))
+HEALTH_REPORT_MAX_CATEGORIES = 20
+SCHEDULED_TOP_SIZE = 50
+ADMIN_USER_IDS = [int(user_id) for user_id in os.getenv('ADMIN_USER_IDS', '').split(',') if len(user_id) > 0]
+NSFW_CHECK_STAGE = METRICS.histogram('stage', stage = 'nsfw_check')
+PARSE_STAGE = METRICS.histogram('stage', stage = 'parse')
+
+LOGGER = get_logger('root')
+
+def custom_info_log(msg, *args):
+	LOGGER.log(INFO, '\t\t' + msg, *args)
+
+async def respond(msg, post, subreddit):
+	send_post(msg.channel, post, subreddit)
+
+# label describes the post in the message, e.g. 'random' or 'new'
+def send_post(channel, post, subreddit, label = 'random'):
 	#TODO update to use embeds to send more beautiful content
 
+	# the post is classified once, when it is fetched (see utils.media), and linked through its direct media url
+	link = post.media_url
+	permalink = post.permalink
+
 	prefix = 'https://www.reddit.com'
 
-	if link[-4:] == '.gif' or 'gfycat.com' in link or 'gif' in link:
-		message = f'Here is the link to a random gif from /r/{subreddit}: {link}\nLink to the original reddit post <'+ prefix + f'{permalink}'+'>'
-	elif link[-4:] in ['.jpg','.png'] or link[-5:] == '.jpeg' or 'imgur.com' in link:
-		message = f' Here is the link to a random picture from /r/{subreddit}: {link}\nLink to the original reddit post <'+ prefix + f'{permalink}'+'>'
-	elif 'reddit.com' in link:
-		message = f' Here is the link to a random post from /r/{subreddit}: {link}'
+	if post.media_type == 'gif':
+		message = f'Here is the link to a {label} gif from /r/{subreddit}: {link}\nLink to the original reddit post <'+ prefix + f'{permalink}'+'>'
+	elif post.media_type == 'image':
+		message = f' Here is the link to a {label} picture from /r/{subreddit}: {link}\nLink to the original reddit post <'+ prefix + f'{permalink}'+'>'
+	elif post.media_type == 'video':
+		message = f' Here is the link to a {label} video from /r/{subreddit}: {link}\nLink to the original reddit post <'+ prefix + f'{permalink}'+'>'
+	elif post.media_type == 'self':
+		message = f' Here is the link to a {label} post from /r/{subreddit}: {link}'
 	else:
-		message = f' Here is the link to a random post from /r/{subreddit}: {link}\nLink to the original reddit post <'+ prefix + f'{permalink}'+'>'
+		message = f' Here is the link to a {label} post from /r/{subreddit}: {link}\nLink to the original reddit post <'+ prefix + f'{permalink}'+'>'
 
-	custom_info_log(f'Link is: {link} ({permalink})')
-	await msg.channel.send(message)
+	custom_info_log('Link is: %s (%s)', link, permalink)
+	SEEN_POSTS.add(channel.id, permalink)
+	# Discord only embeds the first link of a message: each post is sent on its own, to keep its preview
+	OUTBOX.send(channel, message, coalesce = False)
 
 async def respond_vote(msg, links, subreddit, warning = False):
 
 	if warning == True:
-		await msg.channel.send('Sorry, couldn\'t find enough posts, giving you what I can...')
+		OUTBOX.send(msg.channel, 'Sorry, couldn\'t find enough posts, giving you what I can...')
 
-	await msg.channel.send(f'Here are {len(links)} links from /r/{subreddit}. Vote for your favourite!\n')
-	for link in links.keys():
-		r = await msg.channel.send(link + '\n')
-		custom_info_log(f'Got back message with id {r.id}, attempting to add reactions...')
-		await r.add_reaction('\U00002B06')
-		await r.add_reaction('\U00002B07')
+	# all the candidates in a single message, with one numbered reaction per candidate
+	r = await OUTBOX.send(msg.channel, render_vote(links.keys(), subreddit), coalesce = False)
+	if r is None:
+		return
+	custom_info_log('Got back message with id %s, attempting to add reactions...', r.id)
+	VOTES.track(r.id, links.keys())
+	for permalink in links.values():
+		SEEN_POSTS.add(msg.channel.id, permalink)
+	await add_reactions(r, NUMBER_EMOJIS[:len(links)])
+	if VOTE_DURATION > 0:
+		asyncio.ensure_future(close_vote(msg.channel, r.id))
+
+# The results of a vote are posted once it closes, from the votes counted by VOTES
+async def close_vote(channel, message_id):
+	await asyncio.sleep(VOTE_DURATION)
+	results = VOTES.close(message_id)
+	if results is not None:
+		custom_info_log('Vote %s closed with %s votes', message_id, sum([votes for _, votes in results]))
+		OUTBOX.send(channel, render_results(results))
 
 
 async def print_help_menu(msg, type = 'general'):
-	custom_info_log(f'Help menu requested (type = {type})')
+	custom_info_log('Help menu requested (type = %s)', type)
 	if type == 'top':
-		message = """The `top` command displays a random post in the top posts of the specified subreddit.\nYou can use arguments to specify how many top posts the bot should look at, and the period from which the top posts must be extracted.\nThe command is: `r! top $subreddit [N] [period]` \n\nDefault value for the period is 'all', possible values are all, year, month, week, day|today, hour|now.\nThe default value for N is 10, maximum value is 100. If you get the same post twice, try increasing this parameter!\nAll parameters are optionnal but must be specified in the correct order."""
+		message = """The `top` command displays a random post in the top posts of the specified subreddit.\nYou can use arguments to specify how many top posts the bot should look at, and the period from which the top posts must be extracted.\nThe command is: `r! top $subreddit [N] [period]` \n\nDefault value for the period is 'all', possible values are all, year, month, week, day|today, hour|now.\nThe default value for N is 50, maximum value is 100. The bot avoids the posts already shown in the channel: if you get the same post twice, try increasing this parameter!\nAll parameters are optionnal but must be specified in the correct order."""
 	elif type == 'list':
 		message = """The `list` command displays a random post from a list of predefined subreddits (called a category).\nThe following commands are also available:\n `r! list $category -subs`                          Lists the subreddits mapped to the specified category.\n `r! list $string -cat_search`                 Lists the available categories with a name containing the specified string.\n `r! list $string -search`                          Lists the available categories mapped to at least one subreddits with a name containg the specified string.\n `r! list $category -e $sub1,...`          Exclude the subreddits specified from the list mapped to the category. Subreddits to exclude must be seperated by a comma.\n `r! list -all`                                                   Lists all the available categories."""
+	elif type == 'subscribe':
+		message = """The `subscribe` command makes the bot post in this channel on a schedule, from a subreddit or from a category.\nThe command is `r! subscribe $subreddit|$category [top|rand] [period] [every] [at]`\n\nThe bot posts one of the top posts of the period (default is top of the day) or a random post, every 30m, 6h, 1d... (default is 1d, minimum is 10m). With `at HH:MM` (UTC), the first post is sent at this time, e.g. `r! subscribe EarthPorn top day 1d 08:00` for the top of the day every morning.\n `r! subscriptions`                       Lists the subscriptions of the channel.\n `r! unsubscribe $id`                   Removes a subscription of the channel.\n `r! watch $subreddit`                 Posts the new posts of the subreddit in this channel (`r! unwatch $subreddit` to stop).\nSubscriptions can only be changed by the users allowed to manage the channel."""
 	elif type == 'vote':
-		message = """The `vote` command displays several posts from the same specified subreddit and let you vote for your favourite!\nYou can use arguments to specify how many posts the bot should display (maximum 5, default is 3), as well as the time period from which the posts should be extracted.\nThe command is `r! vote $subreddit [N] [period] [random|top]`\n\nYou can use the 'random' or 'top' options to specify if you want to posts to come from the top of the period (default is top of all time) or completely randomly (in which case the period will be ignored, if specified).\nAll parameters are optionnal but must be specified in the correct order."""
+		message = """The `vote` command displays several posts from the same specified subreddit and let you vote for your favourite!\nYou can use arguments to specify how many posts the bot should display (maximum 5, default is 3), as well as the time period from which the posts should be extracted.\nThe command is `r! vote $subreddit [N] [period] [random|top]`\n\nYou can use the 'random' or 'top' options to specify if you want to posts to come from the top of the period (default is top of all time) or completely randomly (in which case the period will be ignored, if specified).\nAll parameters are optionnal but must be specified in the correct order.\nThe results of the vote are posted when it closes."""
 	else:
-		message = f"""Thank you for use Reddiator v{VERSION}!\nThe bot responds to the following commands:\n `r! rand $subreddit`          Displays a random post from the specified subreddit.\n `r! top $subreddit`            Displays a random post from the top posts of the specified subreddit.\n `r! list $category`            Displays a random post from a selection of subreddits mapped to a category (or list).\n `r! vote $subreddit`          Let's you vote for your favourite post!\n `r! help $command`              Displays the help menu for the specified command."""
+		message = f"""Thank you for use Reddiator v{VERSION}!\nThe bot responds to the following commands:\n `r! rand $subreddit`          Displays a random post from the specified subreddit.\n `r! top $subreddit`            Displays a random post from the top posts of the specified subreddit.\n `r! list $category`            Displays a random post from a selection of subreddits mapped to a category (or list).\n `r! vote $subreddit`          Let's you vote for your favourite post!\n `r! subscribe $subreddit`   Posts from the subreddit (or category) in this channel on a schedule.\n `r! help $command`              Displays the help menu for the specified command."""
+
+
+	OUTBOX.send(msg.channel, message)
+
+async def print_list_command(msg, listname, option = None, excluded_subs = None):
+	if option is None:
+		if listname.lower() == '-all':
+			response = 'The following categories are available: ' + ', '.join(CATEGORY_STORE.categories.keys())
+			OUTBOX.send(msg.channel, response)
+		else:
+			await print_post_in_list(msg, listname)
+		return
+
+	listname = listname.lower()
+
+	if option == '-subs':
+		if listname not in CATEGORY_STORE.categories:
+			logging.warning('Requested list %s does not exist in the loaded categories.', listname)
+			response = """Sorry, the category you requested does not exist. Try `r! help list` to see the help menu for the 'list' command."""
+		else:
+			subreddits = CATEGORY_STORE.categories[listname]['subreddits']
+			response = 'The following subreddits are in the category \'' + listname + '\': ' +  ', '.join(subreddits)
+
+	elif option in ['-category_search','-cat_search','-catsearch','-csearch']:
+
+		search_results = CATEGORY_STORE.index.search_categories(listname)
+
+		if len(search_results) > 1:
+			response = 'The following categories contain the string \'' + listname + '\': ' + ', '.join(search_results)
+		elif len(search_results) == 1:
+			response = 'Only one category contains the string \'' + listname + '\': ' + search_results[0]
+		else:
+			response = 'Sorry, there are no categories with a name containing the string \'' + listname + '\''
+
+	elif option == '-search':
 
+		search_results = CATEGORY_STORE.index.search_subreddits(listname)
 
-	await msg.channel.send(message)
+		if len(search_results) > 1:
+			response = 'The following categories contain a subreddit with a name containg the string \'' + listname + '\': ' + ', '.join(search_results)
+		elif len(search_results) == 1:
+			response = 'Only one category contains a subreddit with a name containing the string \'' + listname + '\': ' + search_results[0]
+		else:
+			response = 'Sorry, there are no categories with at least a subreddit with a name containing the string \'' + listname + '\''
+
+	elif excluded_subs is not None:
+		await print_post_in_list(msg, listname, excluded_subs)
+		return
+
+	else:
+		logging.warning('Received a list command from user %s with an exclusion but no subreddits to exclude.', msg.author.name)
+		response = """Bad command! Type `r! help` for the general help menu, and `r! help list` for the help menu for the 'list' command."""
+
+	OUTBOX.send(msg.channel, response)
 
 async def print_post_in_list(msg, listname, excluded_subs = []):
-	custom_info_log(f'Received list command from user {msg.author.name} for {listname}')
+	custom_info_log('Received list command from user %s for %s', msg.author.name, listname)
 	listname = listname.lower()
 
-	if listname not in CATEGORIES.keys():
+	index = CATEGORY_STORE.index
+
+	if listname not in index.categories:
 		logging.warning('Requested list does not exist in the loaded categories.')
 		await handle_error(msg, 8)
 	else:
-		subreddits = CATEGORIES[listname]['subreddits']
-		custom_info_log(f'Got {len(subreddits)} subreddits matching the category {listname}')
+		subreddits = index.categories[listname]['subreddits']
+		custom_info_log('Got %s subreddits matching the category %s', len(subreddits), listname)
 
-		filtered_subreddits = []
+		# the subreddits are drawn from the live ones (see utils.health), with a few spare ones in case the first ones fail
+		nsfw_allowed = msg.channel.is_nsfw()
 		if len(excluded_subs) > 0:
-			custom_info_log(f'Received a list of subreddits to exclude: {excluded_subs}')
-			excluded_subs_list = [sub.lower() for sub in excluded_subs.split(',')]
-			for sub in subreddits:
-				if sub.lower() in excluded_subs_list:
-					custom_info_log(f'Excluding subreddit {sub} from the request')
-				else:
-					filtered_subreddits.append(sub)
+			custom_info_log('Received a list of subreddits to exclude: %s', excluded_subs)
+			excluded = [sub.lower() for sub in excluded_subs.split(',')]
+			if len(index.subreddits(listname, excluded)) == 0:
+				await handle_error(msg, 7)
+				return
+			excluded = set(excluded)
+			eligible = [sub for sub in CATEGORY_HEALTH.eligible(listname, nsfw_allowed) if sub.lower() not in excluded]
+			candidates = sample(eligible, min(2 * LIST_FANOUT, len(eligible)))
 		else:
-			filtered_subreddits = subreddits
+			excluded = set()
+			candidates = CATEGORY_HEALTH.pick(listname, nsfw_allowed, 2 * LIST_FANOUT)
 
-		if len(filtered_subreddits) > 0:
-			custom_info_log(f'Got {len(filtered_subreddits)} subreddits to search through...')
+		if len(candidates) > 0:
+			custom_info_log('Drew %s subreddits to search through...', len(candidates))
 		else:
-			await handle_error(msg, 7)
+			live = [sub for sub in CATEGORY_HEALTH.eligible(listname, True) if sub.lower() not in excluded]
+			logging.warning('No eligible subreddit left in category %s (%s live ones, NSFW allowed: %s).', listname, len(live), nsfw_allowed)
+			await handle_error(msg, 9 if len(live) > 0 else 6)
 			return
 
-		found = False
-		loop_check = 0
-
-		while not found:
-			random_index = randint(0, len(filtered_subreddits) - 1)
-			sub = filtered_subreddits[random_index]
-			custom_info_log(f'Subreddit #{random_index} was chosen: {sub}')
-			loop_check = loop_check + 1
+		post = None
+		if len(excluded_subs) == 0:
+			post = RESERVOIR.pop_category(listname)
 
+		if post is None:
 			try:
-				link, permalink = get_random_post_from_subreddit(sub)
-				found = True
+				post = await get_random_post_from_any_subreddit_async(candidates, LIST_FANOUT)
 			except RequestException as e:
-				if e.code < 6 and e.code > 0:
-					custom_info_log('Retrying...')
-				else:
-					await handle_error(msg, e.code)
-
-			if loop_check > len(subreddits):
-				logging.warning('More failed requests than subreddits in the category: stopping here to avoid infine loop. Reddit may be down.')
-				await handle_error(msg, 6)
+				if e.code == 6:
+					logging.warning('All the subreddits of the category failed: Reddit may be down.')
+				await handle_error(msg, e.code)
 				return
 
-		await respond(msg, link, permalink, sub)
+		await respond(msg, post, post.subreddit)
 
 
 async def print_top_post_from_subreddit(msg, subreddit, number = 50, timespan = 'all'):
-	custom_info_log(f'Top post request for subreddit {subreddit}, with pool size = {number} and timespan = {timespan}')
+	custom_info_log('Top post request for subreddit %s, with pool size = %s and timespan = %s', subreddit, number, timespan)
 
-	if check_not_nsfw(msg, subreddit):
-		try:
-			link, permalink = get_top_post_from_subreddit(subreddit, number, timespan)
-			await respond(msg, link, permalink, subreddit)
-		except RequestException as e:
-			await handle_error(msg, e.code)
-	else:
-		raise RequestException(9)
+	try:
+		if await check_not_nsfw(msg, subreddit):
+			post = await get_top_post_from_subreddit_async(subreddit, number, timespan, SEEN_POSTS.predicate(msg.channel.id))
+			await respond(msg, post, subreddit)
+		else:
+			await handle_error(msg, 9)
+	except RequestException as e:
+		await handle_error(msg, e.code)
 
 async def print_random_post_from_subreddit(msg, subreddit):
-	custom_info_log(f'Received random post command for {subreddit} from user {msg.author.name}')
+	custom_info_log('Received random post command for %s from user %s', subreddit, msg.author.name)
 
-	if check_not_nsfw(msg, subreddit):
-		try:
-			post_link, perma_link = get_random_post_from_subreddit(subreddit)
-			await respond(msg, post_link, perma_link, subreddit)
-		except RequestException as e:
-			await handle_error(msg, e.code)
-	else:
-		await handle_error(msg, 9)
+	try:
+		if await check_not_nsfw(msg, subreddit):
+			seen = SEEN_POSTS.predicate(msg.channel.id)
+			post = RESERVOIR.pop_subreddit(subreddit)
+			if post is None or seen(post):
+				post = await get_random_post_from_subreddit_async(subreddit, seen = seen)
+			await respond(msg, post, subreddit)
+		else:
+			await handle_error(msg, 9)
+	except RequestException as e:
+		await handle_error(msg, e.code)
 
 async def print_vote_posts_from_subreddit(msg, subreddit, N = 3, type = 'top', timespan = 'all'):
 
-	custom_info_log(f'Received vote request command for {subreddit} from user {msg.author.name} asking for {N} {type} posts')
+	custom_info_log('Received vote request command for %s from user %s asking for %s %s posts', subreddit, msg.author.name, N, type)
 
 	results = {}
+
+	if type == 'top':
+		# a single (cached) listing is enough to draw N distinct posts
+		try:
+			for post in await sample_top_posts_from_subreddit_async(subreddit, 50, timespan, N, SEEN_POSTS.predicate(msg.channel.id)):
+				results[post.media_url] = post.permalink
+		except RequestException as e:
+			await handle_error(msg, e.code)
+			return
+
+	# posts already shown in the channel, or already picked for this vote, are replaced by fresh posts
+	# of the (cached) top listing instead of being fetched again
+	seen = lambda post: post.permalink in results.values() or SEEN_POSTS.seen(msg.channel.id, post.permalink)
 	loop_counter = 0
-	while len(results) < N and loop_counter < N*5:
+	while type == 'random' and len(results) < N and loop_counter < N*2:
 		try:
-			if type == 'top':
-				link, permalink = get_top_post_from_subreddit(subreddit, 50, timespan)
-			elif type == 'random':
-				link, permalink = get_random_post_from_subreddit(subreddit)
+			post = await get_random_post_from_subreddit_async(subreddit, seen = seen)
+			link, permalink = post.media_url, post.permalink
 
 			if link not in results.keys():
 				results[link] = permalink
 			else:
-				#kind of a dirty fix: each time we're seeing a link we have already we are incrementing the counter
-				#and we're stopping if we have this 5 times the requested number of posts
+				#the subreddit doesn't have enough fresh posts: we stop after a few duplicates
 				#no error is raised, we simply output the few posts we managed to get (at least the user doesn't get nothing)
 				loop_counter = loop_counter + 1
 
@@ -251,18 +383,19 @@ async def print_ariavoire_post(msg):
 	random_index = randint(0, len(ariavoire_subreddits) - 1)
 	await print_random_post_from_subreddit(msg, ariavoire_subreddits[random_index])
 
-def check_not_nsfw(msg, subreddit):
-	custom_info_log(f'Received a request to check NSFW status of subreddit {subreddit} for channel {msg.channel}')
-	if msg.channel.is_nsfw():
-		custom_info_log('Channel is marked NSFW, no need to check anything')
-		return True
-	else:
-		if get_nsfw_status(subreddit):
-			custom_info_log('Subreddit is NFSW, aborting...')
-			return False
-		else:
-			custom_info_log('Subreddit is SFW, continuing...')
+async def check_not_nsfw(msg, subreddit):
+	with NSFW_CHECK_STAGE.time():
+		custom_info_log('Received a request to check NSFW status of subreddit %s for channel %s', subreddit, msg.channel)
+		if msg.channel.is_nsfw():
+			custom_info_log('Channel is marked NSFW, no need to check anything')
 			return True
+		else:
+			if await get_nsfw_status_async(subreddit):
+				custom_info_log('Subreddit is NFSW, aborting...')
+				return False
+			else:
+				custom_info_log('Subreddit is SFW, continuing...')
+				return True
 
 async def handle_error(msg, code):
 # Error codes :
@@ -276,6 +409,8 @@ async def handle_error(msg, code):
 # 7 = All subreddits filtered
 # 8 = Category not found
 # 9 = Post from a NSFW subreddit requested on a channel not marked NSFW
+# 10 = Rate limited by Reddit
+# 11 = No posts found
 	if code == 0:
 		message = """Sorry, something went wrong, please reach out to us (nicely)!"""
 	elif code == 1:
@@ -296,195 +431,371 @@ async def handle_error(msg, code):
 		message = """Sorry, the category you requested does not exist. Try `r! help list` to see the help menu for the 'list' command."""
 	elif code == 9:
 		message = """Sorry, it appears that this Discord channel is not tagged NSFW but the requested subreddit is."""
-
-	await msg.channel.send(message)
-
-
-@client.event
-async def on_ready():
-	custom_info_log(f'{client.user} is now connected to the Discord server!')
-
-@client.event
-async def on_message(message):
-	if message.author == client.user:
+	elif code == 10:
+		message = """Sorry, Reddit is receiving too many requests from us right now, please try again in a moment."""
+	elif code == 11:
+		message = """Sorry, there are no posts in this subreddit for this period, try a longer one!"""
+
+	METRICS.counter('command_errors', code = code).inc()
+	OUTBOX.send(msg.channel, message)
+
+def check_admin(msg, command):
+	if msg.author.id not in ADMIN_USER_IDS:
+		logging.warning('User %s requested the %s but is not an administrator of the bot.', msg.author.name, command)
+		OUTBOX.send(msg.channel, 'Sorry, this command is reserved to the administrators of the bot.')
+		return False
+	custom_info_log('%s requested by user %s', command.capitalize(), msg.author.name)
+	return True
+
+# Admin only: latency histograms and error counters, the same figures as the metrics endpoint
+async def print_stats(msg):
+	if check_admin(msg, 'stats'):
+		OUTBOX.send(msg.channel, '```\n' + format_summary(METRICS) + '\n```', coalesce = False)
+
+# Admin only: subreddits pruned from the categories by the health checks
+async def print_health(msg):
+	if not check_admin(msg, 'health report'):
+		return
+	stats = CATEGORY_HEALTH.stats()
+	OUTBOX.send(msg.channel, f"{stats['checked']}/{stats['subreddits']} subreddits checked: {stats['sfw']} SFW, {stats['nsfw']} NSFW, {stats['unavailable']} unavailable.")
+	report = CATEGORY_HEALTH.report()
+	for name, pruned in report[:HEALTH_REPORT_MAX_CATEGORIES]:
+		line = f'**{name}**: ' + ', '.join([f'{sub} ({reason})' for sub, reason in pruned])
+		OUTBOX.send(msg.channel, line if len(line) <= 1000 else line[:997] + '...')
+	if len(report) > HEALTH_REPORT_MAX_CATEGORIES:
+		OUTBOX.send(msg.channel, f'... and {len(report) - HEALTH_REPORT_MAX_CATEGORIES} more categories.')
+
+
+def can_manage_subscriptions(msg):
+	if msg.author.id in ADMIN_USER_IDS:
+		return True
+	permissions = getattr(msg.author, 'guild_permissions', None)
+	return permissions is not None and permissions.manage_channels
+
+async def check_subscriptions_allowed(msg):
+	if SCHEDULER is None:
+		OUTBOX.send(msg.channel, 'Sorry, subscriptions are not enabled on this bot.')
+		return False
+	if not can_manage_subscriptions(msg):
+		logging.warning('User %s tried to change the subscriptions of channel %s without the permission to manage it.', msg.author.name, msg.channel)
+		OUTBOX.send(msg.channel, 'Sorry, only the users allowed to manage this channel can change its subscriptions.')
+		return False
+	return True
+
+async def subscribe(msg, target, listing = 'top', timespan = 'day', interval = 86400, at = None):
+	custom_info_log('Received a subscription request from user %s for %s', msg.author.name, target)
+	if not await check_subscriptions_allowed(msg):
+		return
+	if count_channel_subscriptions(msg.channel.id) >= SCHEDULER.max_per_channel:
+		OUTBOX.send(msg.channel, f'Sorry, a channel can\'t have more than {SCHEDULER.max_per_channel} subscriptions. Try `r! subscriptions` to see them.')
 		return
 
-	message_chunks = message.content.split(' ')
-
-	if message_chunks[0] == 'r!' and len(message_chunks) > 1:
-		custom_info_log(f'Received a message for the bot: {message.content}')
-
-		if message_chunks[1].lower() == 'help':
-			if len(message_chunks) == 3:
-				await print_help_menu(message, type = message_chunks[2])
-			else:
-				await print_help_menu(message)
-
-		elif message_chunks[1].lower() in ['penelope','pénélope','pénelope']:
-			await print_penelope_post(message)
-
-		elif message_chunks[1].lower() in ['ariavoire','aria']:
-			await print_ariavoire_post(message)
-
-		elif message_chunks[1].lower() == 'top':
-			if len(message_chunks) == 2:
-				await print_help_menu(message, 'top')
-
-			if len(message_chunks) == 3:
-				await print_top_post_from_subreddit(message, message_chunks[2])
-
-			if len(message_chunks) == 4:
-				if message_chunks[3].isdigit():
-					await print_top_post_from_subreddit(message, message_chunks[2], number=message_chunks[3])
-
-				elif message_chunks[3] in PERIODS:
-					await print_top_post_from_subreddit(message, message_chunks[2], timespan=message_chunks[3])
-				else:
-					logging.warning(f'Received a top command from user {message.author.name} with wrong parameters. (1)')
-					response = """Bad command! Type `r! help` for the general help menu, and `r! help top` for the help menu for the 'top' command."""
-					await message.channel.send(response)
-
-			if len(message_chunks) == 5:
-				if message_chunks[3].isdigit() and message_chunks[4] in PERIODS:
-					await print_top_post_from_subreddit(message, message_chunks[2], message_chunks[3], message_chunks[4])
-				else:
-					logging.warning(f'Received a top command from user {message.author.name} with wrong parameters. (2)')
-					response = """Bad command! Type `r! help` for the general help menu, and `r! help top` for the help menu for the 'top' command."""
-					await message.channel.send(response)
-
-		elif message_chunks[1].lower() == 'list':
-			if len(message_chunks) > 3:
-
-				listname = message_chunks[2].lower()
-
-				if message_chunks[3].lower() == '-subs':
-					if listname not in CATEGORIES.keys():
-						logging.warning('Requested list {listname} does not exist in the loaded categories.')
-						response = """Sorry, the category you requested does not exist. Try `r! help list` to see the help menu for the 'list' command."""
-					else:
-						subreddits = CATEGORIES[listname]['subreddits']
-						response = 'The following subreddits are in the category \'' + listname + '\': ' +  ', '.join(subreddits)
-
-					await message.channel.send(response)
-
-				elif message_chunks[3].lower() in ['-category_search','-cat_search','-catsearch','-csearch']:
-
-					search_results = []
-
-					for cat in CATEGORIES.keys():
-						if listname in cat:
-							search_results.append(cat)
-
-					if len(search_results) > 1:
-						response = 'The following categories contain the string \'' + listname + '\': ' + ', '.join(search_results)
-					elif len(search_results) == 1:
-						response = 'Only one category contains the string \'' + listname + '\': ' + search_results[0]
-					else:
-						response = 'Sorry, there are no categories with a name containing the string \'' + listname + '\''
-
-					await message.channel.send(response)
-
-				elif message_chunks[3].lower() == '-search':
-
-					search_results = []
+	source = 'cat' if target.lower() in CATEGORY_STORE.categories else 'sub'
+	if source == 'sub':
+		try:
+			if not await check_not_nsfw(msg, target):
+				await handle_error(msg, 9)
+				return
+		except RequestException as e:
+			await handle_error(msg, e.code)
+			return
 
-					for cat in CATEGORIES.keys():
-						if any([listname in sub.lower() for sub in CATEGORIES[cat]['subreddits']]):
-							search_results.append(cat)
+	subscription = SCHEDULER.subscribe(msg.channel.id, source, target, 'rand' if listing == 'random' else listing, normalize_timespan(timespan), interval, at)
+	OUTBOX.send(msg.channel, f'Subscribed! {subscription.describe()}, next post <t:{int(subscription.next_run)}:R>.')
 
-					if len(search_results) > 1:
-						response = 'The following categories contain a subreddit with a name containg the string \'' + listname + '\': ' + ', '.join(search_results)
-					elif len(search_results) == 1:
-						response = 'Only one category contains a subreddit with a name containing the string \'' + listname + '\': ' + search_results[0]
-					else:
-						response = 'Sorry, there are no categories with at least a subreddit with a name containing the string \'' + listname + '\''
+def count_channel_subscriptions(channel_id):
+	return len(SCHEDULER.channel_subscriptions(channel_id)) + len(WATCHER.channel_watches(channel_id))
 
-					await message.channel.send(response)
+async def watch(msg, subreddit):
+	custom_info_log('Received a watch request from user %s for %s', msg.author.name, subreddit)
+	if not await check_subscriptions_allowed(msg):
+		return
+	if count_channel_subscriptions(msg.channel.id) >= SCHEDULER.max_per_channel:
+		OUTBOX.send(msg.channel, f'Sorry, a channel can\'t have more than {SCHEDULER.max_per_channel} subscriptions. Try `r! subscriptions` to see them.')
+		return
+	try:
+		if not await check_not_nsfw(msg, subreddit):
+			await handle_error(msg, 9)
+			return
+	except RequestException as e:
+		await handle_error(msg, e.code)
+		return
+	WATCHER.watch(msg.channel.id, subreddit)
+	OUTBOX.send(msg.channel, f'The new posts of r/{subreddit} will be posted in this channel.')
 
-				elif message_chunks[3] in ['-e', '-exclude', '-ex']:
+async def unwatch(msg, subreddit):
+	if not await check_subscriptions_allowed(msg):
+		return
+	if WATCHER.unwatch(msg.channel.id, subreddit):
+		OUTBOX.send(msg.channel, f'The new posts of r/{subreddit} won\'t be posted in this channel anymore.')
+	else:
+		OUTBOX.send(msg.channel, f'Sorry, this channel doesn\'t watch r/{subreddit}. Try `r! subscriptions` to see its subscriptions.')
 
-					await print_post_in_list(message, message_chunks[2], message_chunks[4])
+async def unsubscribe(msg, id):
+	if not await check_subscriptions_allowed(msg):
+		return
+	if id.lstrip('#').isdigit() and SCHEDULER.unsubscribe(msg.channel.id, int(id.lstrip('#'))):
+		OUTBOX.send(msg.channel, f'Subscription {id} removed.')
+	else:
+		OUTBOX.send(msg.channel, f'Sorry, this channel has no subscription {id}. Try `r! subscriptions` to see them.')
 
-			elif message_chunks[2].lower() == '-all':
-				response = 'The following categories are available: ' + ', '.join(CATEGORIES.keys())
-				await message.channel.send(response)
-			elif len(message_chunks) == 2:
-				await print_help_menu(message, 'list')
-			else:
-				await print_post_in_list(message, message_chunks[2])
+async def print_subscriptions(msg):
+	if SCHEDULER is None:
+		OUTBOX.send(msg.channel, 'Sorry, subscriptions are not enabled on this bot.')
+		return
+	subscriptions = SCHEDULER.channel_subscriptions(msg.channel.id)
+	watches = WATCHER.channel_watches(msg.channel.id)
+	if len(subscriptions) + len(watches) == 0:
+		OUTBOX.send(msg.channel, 'This channel has no subscriptions. Try `r! help subscribe` to create one.')
+	else:
+		OUTBOX.send(msg.channel, '\n'.join([f'{s.describe()}, next post <t:{int(s.next_run)}:R>' for s in subscriptions]
+			+ [f'new posts from r/{subreddit}' for subreddit in watches]))
+
+# Subscriptions firing together on the same listing share a single fetch (see utils.scheduler).
+# Each channel then gets a post it hasn't seen yet, if the listing has one.
+async def fetch_scheduled_posts(key, subscriptions):
+	source, target, listing, timespan = key
+	channels = {s.id: client.get_channel(s.channel_id) for s in subscriptions}
+	# the channels of the other shards (and the deleted ones) are not ours to serve
+	subscriptions = [s for s in subscriptions if channels[s.id] is not None]
+	if len(subscriptions) == 0:
+		return []
+	nsfw_allowed = all([channels[s.id].is_nsfw() for s in subscriptions])
 
-		elif message_chunks[1].lower() == 'rand':
-			await print_random_post_from_subreddit(message, message_chunks[2])
+	try:
+		if source == 'cat':
+			picked = CATEGORY_HEALTH.pick(target, nsfw_allowed)
+			if len(picked) == 0:
+				logging.warning('No eligible subreddit left in category %s for %s subscriptions.', target, len(subscriptions))
+				return []
+			subreddit = picked[0]
+		else:
+			subreddit = subscriptions[0].target
+			if not nsfw_allowed and await run_blocking(get_nsfw_status, subreddit, PRIORITY_BACKGROUND, priority = PRIORITY_BACKGROUND):
+				logging.warning('Subreddit %s became NSFW, skipping its subscriptions in channels not marked NSFW.', subreddit)
+				subscriptions = [s for s in subscriptions if channels[s.id].is_nsfw()]
+
+		if listing == 'rand' and len(subscriptions) == 1:
+			seen = SEEN_POSTS.predicate(subscriptions[0].channel_id)
+			return [(subscriptions[0], (subreddit, await get_random_post_from_subreddit_async(subreddit, PRIORITY_BACKGROUND, seen)))]
+		if listing == 'rand':
+			posts = await run_blocking(get_top_posts_from_subreddit, subreddit, RANDOM_SHARED_LISTING_SIZE, 'all', PRIORITY_BACKGROUND, priority = PRIORITY_BACKGROUND)
+		else:
+			posts = await run_blocking(get_top_posts_from_subreddit, subreddit, SCHEDULED_TOP_SIZE, timespan, PRIORITY_BACKGROUND, priority = PRIORITY_BACKGROUND)
+	except RequestException as e:
+		logging.warning('Failed to fetch the posts of %s subscriptions to %s (code %s).', len(subscriptions), subreddit if source == 'sub' else target, e.code)
+		return []
+
+	if len(posts) == 0:
+		return []
+	results = []
+	for subscription in subscriptions:
+		seen = SEEN_POSTS.predicate(subscription.channel_id)
+		results.append((subscription, (subreddit, choice([post for post in posts if not seen(post)] or posts))))
+	return results
+
+# The post is labelled (and counted) as a top or random post, as the subscription asked for
+async def deliver_scheduled_post(subscription, result):
+	channel = client.get_channel(subscription.channel_id)
+	if channel is not None:
+		subreddit, post = result
+		label = 'top' if subscription.listing == 'top' else 'random'
+		custom_info_log('Delivering a %s post from %s for subscription #%s', label, subreddit, subscription.id)
+		METRICS.counter('scheduled_posts', listing = label).inc()
+		send_post(channel, post, subreddit, label)
+
+# Admin only: cost of the watched subreddits in requests to Reddit
+async def print_watches(msg):
+	if not check_admin(msg, 'watches report'):
+		return
+	if WATCHER is None:
+		OUTBOX.send(msg.channel, 'Sorry, subscriptions are not enabled on this bot.')
+		return
+	stats = WATCHER.stats()
+	lines = [f"{stats['subreddits']} watched subreddits in {stats['batches']} batches, {stats['requests_last_hour']} requests in the last hour "
+		+ f"({stats['requests_per_subreddit_hour']:.2f} per subreddit), {stats['dispatched']} posts dispatched."]
+	lines.extend([f'r/{subreddit}: {requests:.2f} requests in the last hour, polled every {format_duration(tier)}' for subreddit, requests, tier in WATCHER.busiest()])
+	OUTBOX.send(msg.channel, '\n'.join(lines))
+
+# New posts of the watched subreddits (see utils.watcher), skipped in the channels where they can't or already were posted
+def dispatch_new_post(channel_ids, post):
+	for channel_id in channel_ids:
+		channel = client.get_channel(channel_id)
+		if channel is None or (post.over18 and not channel.is_nsfw()) or SEEN_POSTS.seen(channel_id, post.permalink):
+			continue
+		send_post(channel, post, post.subreddit, 'new')
+
+# As for the subscriptions, the channels of the other shards (and the deleted ones) are not ours to serve:
+# the subreddits watched only by them are polled by the workers of their shards
+def serves_channel(channel_id):
+	return client.get_channel(channel_id) is not None
+
+SCHEDULER = build_scheduler(fetch_scheduled_posts, deliver_scheduled_post)
+WATCHER = build_watcher(SCHEDULER.store if SCHEDULER is not None else None, dispatch_new_post, serves_channel)
+
+# The stats of the components are exposed as gauges by the metrics endpoint
+for name, stats in [('reservoir', RESERVOIR.stats), ('seen_posts', SEEN_POSTS.stats), ('category_health', CATEGORY_HEALTH.stats), ('rate_limit', GOVERNOR.stats), ('token', get_token_stats),
+		('coalescing', get_coalescing_stats), ('outbox', OUTBOX.stats), ('connections', get_connection_stats),
+		('subreddit_cache', SUBREDDIT_CACHE.stats), ('subreddit_metadata', get_metadata_stats), ('listing_cache', LISTING_CACHE.stats), ('startup', lambda: STARTUP_TIMES)]:
+	METRICS.register_stats(name, stats)
+if SCHEDULER is not None:
+	METRICS.register_stats('scheduler', SCHEDULER.stats)
+	METRICS.register_stats('watcher', WATCHER.stats)
+
+def get_performance_stats():
+	return {'commands': COMMAND_LATENCY.stats(), 'reservoir': RESERVOIR.stats(), 'seen_posts': SEEN_POSTS.stats(), 'rate_limit': GOVERNOR.stats(), 'token': get_token_stats(), 'coalescing': get_coalescing_stats(), 'outbox': OUTBOX.stats()}
+
+async def log_performance_stats(interval = 300):
+	while True:
+		await asyncio.sleep(interval)
+		custom_info_log('Performance stats: %s', get_performance_stats())
+
+# Health of a shard, reported to the supervisor through the shared store
+def get_shard_health(shard_id):
+	if SHARD_COUNT is None:
+		connected, latency = not client.is_closed(), client.latency
+	else:
+		shard = client.get_shard(shard_id)
+		connected, latency = shard is not None and not shard.is_closed(), shard.latency if shard is not None else float('nan')
+	guilds = len([guild for guild in client.guilds if guild.shard_id == shard_id])
+	return {'pid': os.getpid(), 'connected': connected, 'latency': round(latency, 3), 'guilds': guilds, 'commands': COMMAND_LATENCY.stats()}
+
+async def report_shard_health(interval):
+	loop = asyncio.get_event_loop()
+	while True:
+		for shard_id in SHARD_IDS or [0]:
+			await loop.run_in_executor(None, SHARED_STORE.report_health, shard_id, get_shard_health(shard_id))
+		await asyncio.sleep(interval)
+
+@event
+async def on_ready():
+	global STATS_TASK, HEALTH_TASK
+	if STARTUP_TIMES['ready'] is None:
+		STARTUP_TIMES['ready'] = perf_counter() - STARTED
+	custom_info_log('%s is now connected to the Discord server! (%.3f s after startup)', client.user, STARTUP_TIMES['ready'])
+	RESERVOIR.start()
+	CATEGORY_HEALTH.start()
+	if SCHEDULER is not None:
+		SCHEDULER.start()
+		WATCHER.start()
+	CATEGORY_STORE.start_watching(int(os.getenv('CATEGORIES_RELOAD_INTERVAL', '30')))
+	if STATS_TASK is None:
+		STATS_TASK = asyncio.ensure_future(log_performance_stats())
+	if HEALTH_TASK is None and SHARED_STORE is not None:
+		HEALTH_TASK = asyncio.ensure_future(report_shard_health(int(os.getenv('SHARD_HEALTH_INTERVAL', '30'))))
+
+# Tasks run before connecting to Discord, so that the first commands don't have to wait for them
+def get_warm_up_tasks():
+	tasks = [('access_token', get_access_token), ('subreddit_cache', restore_subreddit_cache), ('seen_posts', SEEN_POSTS.restore),
+		('category_health', CATEGORY_HEALTH.restore)]
+	if len(CATEGORY_STORE.filename) > 0:
+		tasks.append(('categories', CATEGORY_STORE.load))
+	if SCHEDULER is not None:
+		tasks.append(('subscriptions', SCHEDULER.load))
+		tasks.append(('watches', WATCHER.load))
+	return tasks
+
+def build_router():
+	router = Router()
+	router.register(Command('help', print_help_menu, optional = [Argument('type', 'string')]))
+	router.register(Command('penelope', print_penelope_post, aliases = ['pénélope', 'pénelope']))
+	router.register(Command('ariavoire', print_ariavoire_post, aliases = ['aria']))
+	router.register(Command('rand', print_random_post_from_subreddit, required = 'subreddit'))
+	router.register(Command('top', print_top_post_from_subreddit, required = 'subreddit', help_type = 'top',
+		optional = [Argument('number', 'int', maximum = 100), Argument('timespan', 'choice', PERIODS)]))
+	router.register(Command('vote', print_vote_posts_from_subreddit, required = 'subreddit', help_type = 'vote',
+		optional = [Argument('N', 'int', maximum = 5), Argument('timespan', 'choice', PERIODS), Argument('type', 'choice', ['random', 'top'])]))
+	router.register(Command('stats', print_stats))
+	router.register(Command('health', print_health))
+	router.register(Command('subscribe', subscribe, aliases = ['sub'], required = 'target', help_type = 'subscribe',
+		optional = [Argument('listing', 'choice', ['top', 'rand', 'random']), Argument('timespan', 'choice', PERIODS),
+			Argument('interval', 'duration'), Argument('at', 'time')]))
+	router.register(Command('unsubscribe', unsubscribe, aliases = ['unsub'], required = 'id', help_type = 'subscribe'))
+	router.register(Command('subscriptions', print_subscriptions))
+	router.register(Command('watch', watch, required = 'subreddit', help_type = 'subscribe'))
+	router.register(Command('unwatch', unwatch, required = 'subreddit', help_type = 'subscribe'))
+	router.register(Command('watches', print_watches))
+	router.register(Command('list', print_list_command, required = 'listname', help_type = 'list',
+		optional = [Argument('option', 'choice', LIST_OPTIONS, ignore_case = True), Argument('excluded_subs', 'string')]))
+	return router
+
+ROUTER = build_router()
+
+@event
+async def on_raw_reaction_add(payload):
+	if payload.user_id != client.user.id:
+		VOTES.add_vote(payload.message_id, str(payload.emoji))
+
+@event
+async def on_raw_reaction_remove(payload):
+	if payload.user_id != client.user.id:
+		VOTES.remove_vote(payload.message_id, str(payload.emoji))
+
+@event
+async def on_message(message):
+	if message.author == client.user or not is_command(message.content):
+		return
 
+	# every record logged while handling the command (including in the request threads) carries its ID
+	new_correlation_id()
+	start = perf_counter()
+	await handle_command(message)
+	COMMAND_LATENCY.record(perf_counter() - start)
+	if STARTUP_TIMES['first_response'] is None:
+		STARTUP_TIMES['first_response'] = perf_counter() - STARTED
+		custom_info_log('First command handled %.3f s after startup', STARTUP_TIMES['first_response'])
 
-		elif message_chunks[1].lower() == 'vote':
-			if len(message_chunks) < 3:
-				await print_help_menu(message, 'vote')
-			else:
-				if len(message_chunks) == 3:
-					await print_vote_posts_from_subreddit(message, message_chunks[2])
-
-				elif len(message_chunks) == 4:
-					if message_chunks[3].isdigit():
-						await print_vote_posts_from_subreddit(message, message_chunks[2], N=min(int(message_chunks[3]),5))
-
-					elif message_chunks[3] in PERIODS:
-						await print_vote_posts_from_subreddit(message, message_chunks[2], timespan=message_chunks[3])
-					elif message_chunks[3] in ['random', 'top']:
-						await print_vote_posts_from_subreddit(message, message_chunks[2], type=message_chunks[3])
-					else:
-						logging.warning(f'Received a vote command from user {message.author.name} with wrong parameters. (1)')
-						response = """Bad command! Type `r! help` for the general help menu, and `r! help vote` for the help menu for the 'vote' command."""
-						await message.channel.send(response)
-
-				elif len(message_chunks) == 5:
-					if message_chunks[3].isdigit() and message_chunks[4] in PERIODS:
-						await print_top_post_from_subreddit(message, message_chunks[2], N=min(int(message_chunks[3]),5), timespan=message_chunks[4])
-					elif message_chunks[3].isdigit() and message_chunks[4] in ['random', 'top']:
-						await print_top_post_from_subreddit(message, message_chunks[2], N=min(int(message_chunks[3]),5), type=message_chunks[4])
-					elif message_chunks[3] in PERIODS and messages_chunks[4] in ['random', 'top']:
-						await print_top_post_from_subreddit(message, message_chunks[2], timespan=message_chunks[3], type=message_chunks[4])
-
-					else:
-						logging.warning(f'Received a vote command from user {message.author.name} with wrong parameters. (2)')
-						response = """Bad command! Type `r! help` for the general help menu, and `r! help vote` for the help menu for the 'vote' command."""
-						await message.channel.send(response)
-				elif len(message_chunks) == 6:
-					if message_chunks[3].isdigit() and message_chunks[4] in PERIODS and message_chunks[5] in ['random', 'top']:
-						await print_top_post_from_subreddit(message, message_chunks[2], N=min(int(message_chunks[3]),5), timespan=message_chunks[4], type=message_chunks[5])
-					else:
-						logging.warning(f'Received a vote command from user {message.author.name} with wrong parameters. (3)')
-						response = """Bad command! Type `r! help` for the general help menu, and `r! help vote` for the help menu for the 'vote' command."""
-						await message.channel.send(response)
-				else:
-					logging.warning(f'Received a vote command from user {message.author.name} with wrong parameters (4).')
-					response = """Bad command! Type `r! help` for the general help menu, and `r! help vote` for the help menu for the 'vote' command."""
-					await message.channel.send(response)
+async def handle_command(message):
+	custom_info_log('Received a message for the bot: %s', message.content)
 
-		else:
+	try:
+		with PARSE_STAGE.time():
+			command, kwargs = ROUTER.parse(message.content)
+	except CommandError as e:
+		METRICS.counter('commands', command = 'invalid').inc()
+		if e.command is None:
 			logging.warning('Bad command, responding with help menu hint.')
 			response = """Bad command! Type `r! help` for the general help menu!"""
-			await message.channel.send(response)
+		else:
+			logging.warning('Received a %s command from user %s with wrong parameters (%s).', e.command.name, message.author.name, e.reason)
+			response = f"""Bad command! Type `r! help` for the general help menu, and `r! help {e.command.help_type}` for the help menu for the '{e.command.name}' command."""
+		OUTBOX.send(message.channel, response)
+		return
+
+	METRICS.counter('commands', command = command.name).inc()
+	with METRICS.histogram('command', command = command.name).time():
+		if kwargs is None:
+			await print_help_menu(message, command.help_type)
+		else:
+			await command.handler(message, **kwargs)
 
 
 if __name__ == '__main__':
 
 	try:
-		opts, args = getopt.getopt(sys.argv[1:],"hf:l:",["logfile=","loglevel="])
+		opts, args = getopt.getopt(sys.argv[1:],"hf:l:s:w:",["logfile=","loglevel=","shards=","workers="])
 	except getopt.GetoptError:
-		print("""Invalid options. Available options are:\n\n -h \t\t\t\t\t\tDisplays this help menu\n -f <filename>, --logfile=<filename> \t\tSets the logfilename.\n -l <level>, loglevel=<level>\t\t\tSets the log level. Available values are info, warn and error.""")
+		print("""Invalid options. Available options are:\n\n -h \t\t\t\t\t\tDisplays this help menu\n -f <filename>, --logfile=<filename> \t\tSets the logfilename.\n -l <level>, loglevel=<level>\t\t\tSets the log level. Available values are info, warn and error.\n -s <N>, --shards=<N>\t\t\t\tRuns N Discord shards in worker processes.\n -w <N>, --workers=<N>\t\t\t\tNumber of worker processes for the shards (defaults to one per shard).""")
 		sys.exit(2)
 
 	logfilename = ''
 	loglevel = 21
+	loglevel_name = 'info'
+	shard_count = 0
+	workers = 0
 
 	for opt, arg in opts:
 		if opt in ('-h', '--help'):
-			print(f"""Reddiator Bot version {VERSION}\nAvailable options are:\n\n -h \t\t\t\t\t\tDisplays this help menu\n -f <filename>, --logfile=<filename> \t\tSets the logfilename.\n -l <level>, loglevel=<level>\t\t\tSets the log level. Available values are info, warn and error.""")
+			print(f"""Reddiator Bot version {VERSION}\nAvailable options are:\n\n -h \t\t\t\t\t\tDisplays this help menu\n -f <filename>, --logfile=<filename> \t\tSets the logfilename.\n -l <level>, loglevel=<level>\t\t\tSets the log level. Available values are info, warn and error.\n -s <N>, --shards=<N>\t\t\t\tRuns N Discord shards in worker processes.\n -w <N>, --workers=<N>\t\t\t\tNumber of worker processes for the shards (defaults to one per shard).""")
 			sys.exit()
 		elif opt in ('-f', '--logfile'):
 			logfilename = arg
+		elif opt in ('-s', '--shards'):
+			shard_count = int(arg)
+		elif opt in ('-w', '--workers'):
+			workers = int(arg)
 		elif opt in ('-l', '--loglevel'):
+			loglevel_name = arg
 			if arg == 'info':
 				loglevel = 21
 			elif arg == 'warn':
@@ -499,34 +810,49 @@ if __name__ == '__main__':
 		#defaulting to timestamped logfile
 		logfilename = 'reddiator.' + str(int(time())) + '.log'
 
-	logging.addLevelName(21, 'INFO')
-	logging.basicConfig(filename=logfilename,
-                            filemode='a',
-                            format='%(asctime)s,%(msecs)d %(name)s %(levelname)s\t %(message)s',
-                            level=loglevel)
+	setup_logging(logfilename, loglevel,
+		json_lines = os.getenv('LOG_FORMAT', 'text') == 'json',
+		max_bytes = int(os.getenv('LOG_MAX_BYTES', '0')),
+		backup_count = int(os.getenv('LOG_BACKUP_COUNT', '5')),
+		max_length = int(os.getenv('LOG_MAX_MESSAGE_LENGTH', '2000')),
+		warning_interval = int(os.getenv('LOG_WARNING_INTERVAL', '60')),
+		warning_burst = int(os.getenv('LOG_WARNING_BURST', '5')))
+
+	custom_info_log('Starting Reddiator Bot version %s', VERSION)
 
-	custom_info_log(f'Starting Reddiator Bot version {VERSION}')
 
+	#replacing the running instance if any (the .env file was loaded when utils.reddit was imported)
+	#(the workers of a sharded deployment are started by the supervisor, which holds the lock)
+	if SHARD_COUNT is None:
+		INSTANCE_LOCK = acquire_instance_lock(os.getenv('PIDFILE', 'reddiator.pid'))
 
-	#killing running instance of the process if any is already running
-	for proc in psutil.process_iter():
-		if proc.name() == SCRIPT_NAME and proc.pid != os.getpid():
-			logging.warning(f'Killing already running reddiator process with pid = {proc.pid}')
-			proc.kill()
+	custom_info_log('Bot initiation completed, process pid = %s', os.getpid())
 
-	custom_info_log(f'Bot initiation completed, process pid = {proc.pid}')
+	METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+	if METRICS_PORT > 0 and shard_count == 0:
+		# each worker of a sharded deployment serves its metrics on its own port (METRICS_PORT + its first shard)
+		start_metrics_server(METRICS, METRICS_PORT + (SHARD_IDS[0] if SHARD_IDS is not None else 0), os.getenv('METRICS_HOST', '127.0.0.1'))
 
-	load_dotenv()
+	if shard_count > 0:
+		# supervisor mode: this process only runs the workers, which share their caches through the store
+		store = SharedStore(os.getenv('SHARED_STORE_FILENAME', '') or 'reddiator.shared.db')
+		command = [sys.executable, os.path.abspath(__file__), '-l', loglevel_name]
+		build_supervisor(command, shard_count, workers or shard_count, store, logfilename).run()
+		sys.exit()
 	TOKEN = os.getenv('DISCORD_TOKEN')
 
-	CATEGORIES_FILENAME = os.getenv('CATEGORIES_FILENAME')
+	CATEGORIES_FILENAME = os.getenv('CATEGORIES_FILENAME', '')
 	if len(CATEGORIES_FILENAME) > 0:
-		CATEGORIES = load_categories(CATEGORIES_FILENAME)
-		custom_info_log(f'Successfully loaded subreddits for {len(CATEGORIES)} categories.')
+		CATEGORY_STORE.filename = CATEGORIES_FILENAME
 	else:
-        	logging.warning('No category file found in environnement variables, skipped category loading.')
-        	CATEGORIES = {}
-
-	PERIODS = ['hour','hours','now','day','days','today','week','weeks','month','months','year','years','all']
+		logging.warning('No category file found in environnement variables, skipped category loading.')
+
+	#everything the first commands need is prepared concurrently, while discord.py is imported
+	warm_up = WarmUp(get_warm_up_tasks()).start()
+	client = build_client()
+	for handler in EVENT_HANDLERS:
+		client.event(handler)
+	warm_up.wait()
+	STARTUP_TIMES['warm_up'] = perf_counter() - STARTED
 
 	client.run(TOKEN)
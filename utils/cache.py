@@ -0,0 +1,225 @@
+# Reddiator bot module file
+# Module name: utils-cache
+# Version: 1.0
+
+# Description: This module provides the in-memory caches used to avoid hitting Reddit's API for data we already have
+
+import json, logging, os, sys, threading
+
+from collections import OrderedDict
+
+from time import time
+
+from utils.logs import get_logger, INFO
+
+
+LOGGER = get_logger('utils.cache')
+
+def custom_info_log(msg, *args):
+	LOGGER.log(INFO, '\t' + msg, *args)
+
+
+# Bounded cache with a per-entry time-to-live and least-recently-used eviction.
+# Entries are stored with their absolute (wall-clock) expiry time, so that a snapshot written to disk
+# can be reloaded after a restart with the remaining lifetime of each entry.
+# The cache is shared between the event loop and the request threads, hence the lock.
+class TTLCache():
+
+	def __init__(self, name, maxsize, ttl):
+		self.name = name
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.expirations = 0
+		self.store = None
+		self.shared_hits = 0
+
+	# Backs the cache with a store shared between processes (see utils.shared_store): local misses are looked up
+	# in the store, and new entries are written through to it. Keys are stored as JSON, values are turned
+	# into JSON serializable values with encode (and back with decode).
+	def share(self, store, namespace, encode = None, decode = None):
+		self.store = store
+		self.namespace = namespace
+		self.encode = encode
+		self.decode = decode
+
+	def get(self, key, default = None):
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None and entry[1] < time():
+				del self.entries[key]
+				self.expirations = self.expirations + 1
+				entry = None
+			if entry is not None:
+				self.entries.move_to_end(key)
+				self.hits = self.hits + 1
+				return entry[0]
+		if self.store is not None:
+			shared = self.store.get(self.namespace, json.dumps(key))
+			if shared is not None:
+				value = shared[0] if self.decode is None else self.decode(shared[0])
+				self.set(key, value, ttl = shared[1] - time(), share = False)
+				self.shared_hits = self.shared_hits + 1
+				self.hits = self.hits + 1
+				return value
+		self.misses = self.misses + 1
+		return default
+
+	# Same as get, without updating the recency of the entry nor the hit/miss stats
+	def peek(self, key, default = None):
+		with self.lock:
+			entry = self.entries.get(key)
+		if entry is None or entry[1] < time():
+			return default
+		return entry[0]
+
+	def set(self, key, value, ttl = None, share = True):
+		if ttl is None:
+			ttl = self.ttl
+		with self.lock:
+			self.entries[key] = (value, time() + ttl)
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.maxsize:
+				self.entries.popitem(last = False)
+				self.evictions = self.evictions + 1
+		if share:
+			self.write_through(key, value, ttl)
+
+	def write_through(self, key, value, ttl):
+		if self.store is not None:
+			self.store.set(self.namespace, json.dumps(key), value if self.encode is None else self.encode(value), ttl)
+
+	def delete(self, key):
+		with self.lock:
+			self.entries.pop(key, None)
+		if self.store is not None:
+			self.store.delete(self.namespace, json.dumps(key))
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+
+	def __len__(self):
+		return len(self.entries)
+
+	def stats(self):
+		lookups = self.hits + self.misses
+		return {'size': len(self.entries), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+			'hit_rate': self.hits / lookups if lookups > 0 else 0.0, 'evictions': self.evictions, 'expirations': self.expirations,
+			'shared_hits': self.shared_hits}
+
+	# Writes the non-expired entries to a JSON file (keys and values must be JSON serializable).
+	# The file is written next to the destination and renamed, so that a crash never leaves a truncated snapshot.
+	def save_snapshot(self, filename):
+		now = time()
+		with self.lock:
+			entries = [[key, value, expires] for key, (value, expires) in self.entries.items() if expires > now]
+		tmp_filename = filename + '.tmp'
+		with open(tmp_filename, 'w') as f:
+			json.dump({'name': self.name, 'entries': entries}, f)
+		os.replace(tmp_filename, filename)
+		custom_info_log('Saved %s entries of cache %s to %s', len(entries), self.name, filename)
+
+	def load_snapshot(self, filename):
+		try:
+			with open(filename, 'r') as f:
+				snapshot = json.load(f)
+		except FileNotFoundError:
+			custom_info_log('No snapshot found for cache %s in %s, starting with an empty cache', self.name, filename)
+			return 0
+		except ValueError:
+			logging.warning('Snapshot file %s for cache %s is corrupted, ignoring it', filename, self.name)
+			return 0
+
+		now = time()
+		loaded = 0
+		for key, value, expires in snapshot['entries']:
+			if expires > now:
+				# JSON turns tuple keys into lists
+				if isinstance(key, list):
+					key = tuple(key)
+				self.set(key, value, ttl = expires - now, share = False)
+				loaded = loaded + 1
+		custom_info_log('Loaded %s entries of cache %s from %s', loaded, self.name, filename)
+		return loaded
+
+
+# Estimates the memory held by a cached value (containers are walked, strings and numbers counted with getsizeof).
+def estimate_size(value):
+	size = sys.getsizeof(value)
+	if isinstance(value, dict):
+		size = size + sum([estimate_size(k) + estimate_size(v) for k, v in value.items()])
+	elif isinstance(value, (list, tuple, set)):
+		size = size + sum([estimate_size(v) for v in value])
+	elif hasattr(value, '__slots__'):
+		size = size + sum([estimate_size(getattr(value, slot, None)) for slot in value.__slots__])
+	return size
+
+
+# TTL/LRU cache which is also bounded by an estimation of the memory held by its values.
+# Least recently used entries are evicted until both the entry count and the byte budget are respected.
+class MemoryBoundedTTLCache(TTLCache):
+
+	def __init__(self, name, maxsize, ttl, maxbytes):
+		super().__init__(name, maxsize, ttl)
+		self.maxbytes = maxbytes
+		self.sizes = {}
+		self.bytes = 0
+
+	def get(self, key, default = None):
+		value = super().get(key, default)
+		with self.lock:
+			# the parent class may have dropped an expired entry
+			if key not in self.entries and key in self.sizes:
+				self.bytes = self.bytes - self.sizes.pop(key)
+		return value
+
+	def set(self, key, value, ttl = None, share = True):
+		if ttl is None:
+			ttl = self.ttl
+		size = estimate_size(value)
+		if size > self.maxbytes:
+			custom_info_log('Value of %s bytes is bigger than the budget of cache %s, not caching it', size, self.name)
+			# the previous value of the key is outdated, it must not be served anymore
+			with self.lock:
+				self.entries.pop(key, None)
+				if key in self.sizes:
+					self.bytes = self.bytes - self.sizes.pop(key)
+			return
+		with self.lock:
+			if key in self.sizes:
+				self.bytes = self.bytes - self.sizes.pop(key)
+			self.entries[key] = (value, time() + ttl)
+			self.entries.move_to_end(key)
+			self.sizes[key] = size
+			self.bytes = self.bytes + size
+			while len(self.entries) > self.maxsize or self.bytes > self.maxbytes:
+				evicted_key, _ = self.entries.popitem(last = False)
+				self.bytes = self.bytes - self.sizes.pop(evicted_key)
+				self.evictions = self.evictions + 1
+		if share:
+			self.write_through(key, value, ttl)
+
+	def delete(self, key):
+		with self.lock:
+			self.entries.pop(key, None)
+			if key in self.sizes:
+				self.bytes = self.bytes - self.sizes.pop(key)
+		if self.store is not None:
+			self.store.delete(self.namespace, json.dumps(key))
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.sizes.clear()
+			self.bytes = 0
+
+	def stats(self):
+		stats = super().stats()
+		stats['bytes'] = self.bytes
+		stats['maxbytes'] = self.maxbytes
+		return stats
@@ -0,0 +1,145 @@
+# Reddiator bot module file
+# Module name: utils-categories
+# Version: 1.0
+
+# Description: This module loads the categories of subreddits and indexes them for the list command searches
+
+import os, logging, asyncio
+
+from utils.logs import get_logger, INFO
+
+
+LOGGER = get_logger('utils.categories')
+
+def custom_info_log(msg, *args):
+	LOGGER.log(INFO, '\t' + msg, *args)
+
+
+def load_categories(filename):
+	with open(filename, 'r') as f:
+		categories = {}
+		for line in f.readlines():
+			if ':' not in line:
+				continue
+			line_split = line.split(':')
+			categories[line_split[0].lower()] = {'name' : line_split[0], 'subreddits' : [a.strip() for a in line_split[1].split(',') if len(a.strip()) > 0]}
+	return categories
+
+def trigrams(text):
+	return set([text[i:i + 3] for i in range(len(text) - 2)])
+
+
+# Immutable index over the categories, built once: lowercase forms are precomputed, category and subreddit names
+# are indexed by trigram for the substring searches, and a reverse map gives the categories of each subreddit.
+class CategoryIndex():
+
+	def __init__(self, categories):
+		self.categories = categories
+		self.positions = dict([(key, i) for i, key in enumerate(categories.keys())])
+		self.subreddits_lower = {}
+		self.sub_categories = {}
+		self.category_trigrams = {}
+		self.subreddit_trigrams = {}
+
+		for key, category in categories.items():
+			self.subreddits_lower[key] = [sub.lower() for sub in category['subreddits']]
+			for gram in trigrams(key):
+				self.category_trigrams.setdefault(gram, set()).add(key)
+			for sub in self.subreddits_lower[key]:
+				self.sub_categories.setdefault(sub, set()).add(key)
+
+		for sub in self.sub_categories.keys():
+			for gram in trigrams(sub):
+				self.subreddit_trigrams.setdefault(gram, set()).add(sub)
+
+	@staticmethod
+	def load(filename):
+		return CategoryIndex(load_categories(filename))
+
+	# Returns the names containing the (lowercase) string, using the trigram index when the string is long enough
+	def lookup(self, string, names, index):
+		if len(string) < 3:
+			return [name for name in names if string in name]
+		candidates = None
+		for gram in trigrams(string):
+			matches = index.get(gram)
+			if matches is None:
+				return []
+			candidates = matches if candidates is None else candidates & matches
+		return [name for name in candidates if string in name]
+
+	# Categories with a name containing the string
+	def search_categories(self, string):
+		return self.in_file_order(self.lookup(string.lower(), self.categories.keys(), self.category_trigrams))
+
+	# Categories mapped to at least one subreddit with a name containing the string
+	def search_subreddits(self, string):
+		results = set()
+		for sub in self.lookup(string.lower(), self.sub_categories.keys(), self.subreddit_trigrams):
+			results.update(self.sub_categories[sub])
+		return self.in_file_order(results)
+
+	def categories_of(self, subreddit):
+		return self.in_file_order(self.sub_categories.get(subreddit.lower(), set()))
+
+	def in_file_order(self, keys):
+		return sorted(keys, key = lambda key: self.positions[key])
+
+	# Subreddits of the category, without the excluded ones (a list of lowercase names)
+	def subreddits(self, category, excluded = ()):
+		subreddits = self.categories[category]['subreddits']
+		if len(excluded) == 0:
+			return subreddits
+		excluded = set(excluded)
+		return [sub for sub, sub_lower in zip(subreddits, self.subreddits_lower[category]) if sub_lower not in excluded]
+
+
+# Holds the current index, and reloads it when the categories file changes.
+# The new index is built in a thread and swapped in at once, so commands always see a complete index.
+class CategoryStore():
+
+	def __init__(self, filename = ''):
+		self.filename = filename
+		self.index = CategoryIndex({})
+		self.mtime = None
+		self.task = None
+
+	@property
+	def categories(self):
+		return self.index.categories
+
+	def get_mtime(self):
+		try:
+			return os.stat(self.filename).st_mtime
+		except OSError:
+			return None
+
+	def load(self):
+		self.mtime = self.get_mtime()
+		self.index = CategoryIndex.load(self.filename)
+		custom_info_log('Successfully loaded subreddits for %s categories.', len(self.index.categories))
+
+	async def reload_if_changed(self):
+		mtime = self.get_mtime()
+		if mtime is None or mtime == self.mtime:
+			return False
+		custom_info_log('Categories file %s changed, reloading it', self.filename)
+		try:
+			index = await asyncio.get_event_loop().run_in_executor(None, CategoryIndex.load, self.filename)
+		except Exception:
+			logging.exception('Error reloading the categories file %s, keeping the current categories', self.filename)
+			return False
+		self.mtime = mtime
+		self.index = index
+		custom_info_log('Reloaded subreddits for %s categories.', len(index.categories))
+		return True
+
+	async def watch(self, interval):
+		while True:
+			await asyncio.sleep(interval)
+			await self.reload_if_changed()
+
+	def start_watching(self, interval = 30):
+		if self.task is None and len(self.filename) > 0:
+			self.task = asyncio.ensure_future(self.watch(interval))
+		return self.task
@@ -0,0 +1,197 @@
+# Reddiator bot module file
+# Module name: utils-health
+# Version: 1.0
+
+# Description: This module checks the subreddits of the categories in the background, so that the list command only draws from live ones
+
+import atexit, json, logging, os, asyncio
+
+from random import sample
+
+from time import time
+
+from utils.reddit import RequestException, PRIORITY_BACKGROUND, get_subreddits_metadata, run_blocking
+from utils.logs import get_logger, INFO
+
+
+LOGGER = get_logger('utils.health')
+
+def custom_info_log(msg, *args):
+	LOGGER.log(INFO, '\t' + msg, *args)
+
+
+ERROR_NAMES = {1: 'not found', 2: 'private', 3: 'banned', 4: 'quarantined'}
+
+
+# Every subreddit of the categories is checked (through the subreddit cache) every recheck seconds, at most budget
+# subreddits per interval, never checked ones first. A round is a single bulk lookup (see utils.reddit.get_subreddits_metadata),
+# i.e. one request per 100 subreddits plus one per subreddit that turned out to be banned or not found.
+# The health of a subreddit is 'sfw', 'nsfw' or the code of the error making it unavailable (1 to 4): other errors
+# (rate limit, Reddit down...) say nothing about the subreddits and the round is retried at the next interval.
+# Each category has two precomputed eligible views (live subreddits, and live SFW subreddits) rebuilt after each
+# round of checks that changed something, so a draw is a random pick in a list. Subreddits never checked are eligible.
+class CategoryHealth():
+
+	def __init__(self, index, interval = 60, budget = 100, recheck = 21600):
+		# index is a function returning the current category index, since the categories are loaded (and reloaded) later
+		self.index = index
+		self.interval = interval
+		self.budget = budget
+		self.recheck = recheck
+		self.health = {}
+		self.views = {}
+		self.views_index = None
+		self.filename = None
+		self.checks = 0
+		self.failures = 0
+		self.task = None
+
+	# Subreddits (lowercase) to check in the next round
+	def due(self, index, now):
+		never, stale = [], []
+		for sub in index.sub_categories.keys():
+			entry = self.health.get(sub)
+			if entry is None:
+				never.append(sub)
+			elif now - entry[1] >= self.recheck:
+				stale.append(sub)
+		stale.sort(key = lambda sub: self.health[sub][1])
+		return (never + stale)[:self.budget]
+
+	# Returns the number of subreddits whose health changed (None if the lookup failed)
+	async def check(self, subreddits):
+		try:
+			results = await run_blocking(get_subreddits_metadata, subreddits, PRIORITY_BACKGROUND, priority = PRIORITY_BACKGROUND)
+		except RequestException as e:
+			self.failures = self.failures + 1
+			custom_info_log('Health check of %s subreddits failed (code %s), will retry later', len(subreddits), e.code)
+			return None
+		now = time()
+		changes = 0
+		for subreddit, metadata in results.items():
+			health = metadata['error'] if 'error' in metadata else ('nsfw' if metadata['over18'] else 'sfw')
+			previous = self.health.get(subreddit)
+			self.health[subreddit] = (health, now)
+			if previous is not None and previous[0] != health:
+				custom_info_log('Health of subreddit %s changed from %s to %s', subreddit, describe(previous[0]), describe(health))
+			if previous is None or previous[0] != health:
+				changes = changes + 1
+		self.checks = self.checks + len(results)
+		return changes
+
+	async def check_round(self):
+		index = self.index()
+		subreddits = self.due(index, time())
+		if len(subreddits) > 0:
+			changes = await self.check(subreddits)
+			if changes is not None:
+				custom_info_log('Checked the health of %s subreddits, %s changed', len(subreddits), changes)
+				if changes > 0:
+					self.build_views(index)
+		# subreddits removed from the categories are forgotten
+		for sub in [sub for sub in self.health.keys() if sub not in index.sub_categories]:
+			del self.health[sub]
+
+	def build_views(self, index):
+		views = {}
+		for key, category in index.categories.items():
+			live, sfw = [], []
+			for sub, sub_lower in zip(category['subreddits'], index.subreddits_lower[key]):
+				health = self.health.get(sub_lower, (None, 0))[0]
+				if health in ERROR_NAMES:
+					continue
+				live.append(sub)
+				if health != 'nsfw':
+					sfw.append(sub)
+			views[key] = (live, sfw)
+		# swapped at once: draws always see complete views
+		self.views = views
+		self.views_index = index
+
+	# Live subreddits of the category (only the SFW ones if nsfw_allowed is False)
+	def eligible(self, category, nsfw_allowed):
+		index = self.index()
+		if index is not self.views_index:
+			# the categories were (re)loaded since the views were built
+			self.build_views(index)
+		live, sfw = self.views.get(category, ([], []))
+		return live if nsfw_allowed else sfw
+
+	# Draws k distinct eligible subreddits of the category (fewer if there aren't enough)
+	def pick(self, category, nsfw_allowed, k = 1):
+		eligible = self.eligible(category, nsfw_allowed)
+		return sample(eligible, min(k, len(eligible)))
+
+	async def run(self):
+		while True:
+			try:
+				await self.check_round()
+			except Exception:
+				logging.exception('Unexpected error while checking the health of the subreddits')
+			await asyncio.sleep(self.interval)
+
+	def start(self):
+		if self.task is None:
+			self.task = asyncio.ensure_future(self.run())
+		return self.task
+
+	# Unavailable subreddits of each category: [(category name, [(subreddit, reason)])]
+	def report(self):
+		index = self.index()
+		report = []
+		for key, category in index.categories.items():
+			pruned = [(sub, ERROR_NAMES[self.health[sub_lower][0]]) for sub, sub_lower in zip(category['subreddits'], index.subreddits_lower[key])
+				if self.health.get(sub_lower, (None, 0))[0] in ERROR_NAMES]
+			if len(pruned) > 0:
+				report.append((category['name'], pruned))
+		return report
+
+	def stats(self):
+		healths = [entry[0] for entry in self.health.values()]
+		return {'subreddits': len(self.index().sub_categories), 'checked': len(healths), 'sfw': healths.count('sfw'), 'nsfw': healths.count('nsfw'),
+			'unavailable': len([health for health in healths if health in ERROR_NAMES]), 'checks': self.checks, 'failures': self.failures}
+
+	# Same as the other snapshots, the file is written next to the destination and renamed
+	def save(self, filename):
+		tmp_filename = filename + '.tmp'
+		with open(tmp_filename, 'w') as f:
+			json.dump([[sub, health, checked] for sub, (health, checked) in self.health.items()], f)
+		os.replace(tmp_filename, filename)
+		custom_info_log('Saved the health of %s subreddits to %s', len(self.health), filename)
+
+	# Reloads the snapshot of the file given to build_category_health, if any, and saves it back at exit
+	def restore(self):
+		if self.filename is not None:
+			self.load(self.filename)
+			atexit.register(self.save, self.filename)
+
+	def load(self, filename):
+		try:
+			with open(filename, 'r') as f:
+				entries = json.load(f)
+		except FileNotFoundError:
+			custom_info_log('No subreddit health found in %s, starting from scratch', filename)
+			return 0
+		except ValueError:
+			logging.warning('Subreddit health file %s is corrupted, ignoring it', filename)
+			return 0
+		self.health = {sub: (health, checked) for sub, health, checked in entries}
+		# rebuilt on the next draw
+		self.views_index = None
+		custom_info_log('Loaded the health of %s subreddits from %s', len(entries), filename)
+		return len(entries)
+
+
+def describe(health):
+	return ERROR_NAMES.get(health, health)
+
+def build_category_health(index):
+	category_health = CategoryHealth(index,
+		interval = float(os.getenv('CATEGORY_HEALTH_INTERVAL', '60')),
+		budget = int(os.getenv('CATEGORY_HEALTH_BUDGET', '100')),
+		recheck = int(os.getenv('CATEGORY_HEALTH_RECHECK', '21600')))
+	filename = os.getenv('CATEGORY_HEALTH_FILENAME', '')
+	if len(filename) > 0:
+		# loaded by restore(), during the warm-up of the bot
+		category_health.filename = filename
+	return category_health
@@ -0,0 +1,152 @@
+# Reddiator bot module file
+# Module name: utils-logs
+# Version: 1.0
+
+# Description: This module sets up the logging pipeline: records are queued by the threads that log them,
+# and formatted and written to the log file by a background thread
+
+import atexit, contextvars, json, logging, queue, threading
+
+from itertools import count
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from time import time
+
+
+# Level of the informational messages of the bot
+INFO = 21
+
+# Correlation ID of the command being handled, attached to every record logged while handling it
+# (the request threads run with the context of the command that submitted them, see utils.reddit.run_blocking)
+CORRELATION_ID = contextvars.ContextVar('correlation_id', default = '-')
+CORRELATION_COUNTER = count(1)
+
+LOGGERS = {}
+
+
+# Loggers are looked up once per name (logging.getLogger takes a lock on every call)
+def get_logger(name):
+	logger = LOGGERS.get(name)
+	if logger is None:
+		logger = LOGGERS.setdefault(name, logging.getLogger(name))
+	return logger
+
+def new_correlation_id():
+	correlation_id = f'{next(CORRELATION_COUNTER):x}'
+	CORRELATION_ID.set(correlation_id)
+	return correlation_id
+
+
+# Runs in the thread that logs: only attaches the correlation ID, the message itself is formatted by the writer thread
+class CorrelationFilter(logging.Filter):
+
+	def filter(self, record):
+		record.correlation_id = CORRELATION_ID.get()
+		return True
+
+
+# Repeated warnings (same logger and same message template) are let through at most burst times per interval,
+# the next one that gets through tells how many were suppressed in between.
+class RateLimitFilter(logging.Filter):
+
+	def __init__(self, interval = 60, burst = 5):
+		super().__init__()
+		self.interval = interval
+		self.burst = burst
+		self.windows = {}
+		self.lock = threading.Lock()
+
+	def filter(self, record):
+		if record.levelno < logging.WARNING:
+			return True
+		key = (record.name, record.msg)
+		now = time()
+		with self.lock:
+			start, emitted, suppressed = self.windows.get(key, (now, 0, 0))
+			if now - start > self.interval:
+				start, emitted = now, 0
+			if emitted >= self.burst:
+				self.windows[key] = (start, emitted, suppressed + 1)
+				return False
+			self.windows[key] = (start, emitted + 1, 0)
+			if len(self.windows) > 10000:
+				self.windows.clear()
+		record.suppressed = suppressed
+		return True
+
+
+# Formatting is deferred to the writer thread: the record is queued as is instead of being formatted by
+# the thread that logs it. The arguments of a record must therefore not be modified after the logging call.
+class DeferredQueueHandler(QueueHandler):
+
+	def prepare(self, record):
+		return record
+
+
+class TruncatingFormatter(logging.Formatter):
+
+	def __init__(self, fmt = None, max_length = 2000):
+		super().__init__(fmt)
+		self.max_length = max_length
+
+	def get_message(self, record):
+		message = record.getMessage()
+		if len(message) > self.max_length:
+			message = message[:self.max_length] + f'... ({len(message) - self.max_length} more characters)'
+		if getattr(record, 'suppressed', 0) > 0:
+			message = message + f' ({record.suppressed} similar messages suppressed)'
+		return message
+
+	def format(self, record):
+		record.message = self.get_message(record)
+		record.asctime = self.formatTime(record)
+		text = self._fmt % record.__dict__
+		if record.exc_info:
+			text = text + '\n' + self.formatException(record.exc_info)
+		return text
+
+
+# One JSON object per line, for the log processing tools
+class JSONLinesFormatter(TruncatingFormatter):
+
+	def format(self, record):
+		entry = {'time': record.created, 'level': record.levelname, 'logger': record.name, 'thread': record.threadName,
+			'correlation_id': getattr(record, 'correlation_id', '-'), 'message': self.get_message(record).strip()}
+		if record.exc_info:
+			entry['exception'] = self.formatException(record.exc_info)
+		return json.dumps(entry)
+
+
+# Replaces logging.basicConfig: the root logger gets a handler that only queues the records, a background thread
+# formats them and writes them to the log file, rotated when it reaches max_bytes (0 disables the rotation).
+def setup_logging(filename, level, json_lines = False, max_bytes = 0, backup_count = 5, max_length = 2000, warning_interval = 60, warning_burst = 5):
+	logging.addLevelName(INFO, 'INFO')
+	# the formats don't use the source location nor the process of the records: they aren't collected on every call
+	logging._srcfile = None
+	logging.logProcesses = False
+	logging.logMultiprocessing = False
+
+	file_handler = RotatingFileHandler(filename, mode = 'a', maxBytes = max_bytes, backupCount = backup_count)
+	if json_lines:
+		file_handler.setFormatter(JSONLinesFormatter(max_length = max_length))
+	else:
+		file_handler.setFormatter(TruncatingFormatter('%(asctime)s %(name)s %(levelname)s [%(correlation_id)s]\t %(message)s', max_length = max_length))
+
+	records = queue.SimpleQueue()
+	queue_handler = DeferredQueueHandler(records)
+	queue_handler.addFilter(CorrelationFilter())
+	queue_handler.addFilter(RateLimitFilter(warning_interval, warning_burst))
+
+	root = logging.getLogger()
+	root.handlers = [queue_handler]
+	root.setLevel(level)
+
+	listener = QueueListener(records, file_handler, respect_handler_level = True)
+	listener.start()
+	# the records still queued are written before exiting
+	atexit.register(stop_logging, listener)
+	return listener
+
+def stop_logging(listener):
+	if listener._thread is not None:
+		listener.stop()
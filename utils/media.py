@@ -0,0 +1,68 @@
+# Reddiator bot module file
+# Module name: utils-media
+# Version: 1.0
+
+# Description: This module classifies the posts and resolves a direct link to their media, from the fields of the listing
+
+import os
+
+from html import unescape
+
+from utils.cache import TTLCache
+
+
+GIF_DOMAINS = ('gfycat.com', 'redgifs.com', 'giphy.com')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def get_preview_url(data, variant = None):
+	try:
+		image = data['preview']['images'][0]
+		if variant is not None:
+			image = image['variants'][variant]
+		return unescape(image['source']['url'])
+	except (KeyError, IndexError, TypeError):
+		return None
+
+# Returns the media type of the post ('gif', 'image', 'video', 'self' or 'link') and the most direct url to its media,
+# so that Discord can embed it right away instead of unfurling the page of the hosting website.
+# The fallback_url of the Reddit videos (and video previews) is never used: it is a DASH video stream without the
+# audio track, that Discord would play silently.
+def resolve_media(data):
+	url = data.get('url', '')
+	hint = data.get('post_hint', '')
+	domain = data.get('domain', '')
+	path = url.split('?')[0].lower()
+
+	if data.get('is_self') or hint == 'self':
+		return 'self', url
+	if path.endswith('.gif'):
+		return 'gif', url
+	if path.endswith('.gifv'):
+		# imgur serves the same animation as mp4
+		return 'gif', url[:url.lower().rindex('.gifv')] + '.mp4'
+	if domain.endswith(GIF_DOMAINS):
+		return 'gif', get_preview_url(data, 'gif') or url
+	if data.get('is_video') or hint in ('hosted:video', 'rich:video'):
+		return 'video', url
+	if path.endswith(IMAGE_EXTENSIONS) or hint == 'image':
+		if path.endswith(IMAGE_EXTENSIONS):
+			return 'image', url
+		return 'image', get_preview_url(data) or url
+	if domain.endswith('imgur.com'):
+		# imgur page of a single image: its preview is the image itself
+		return 'image', get_preview_url(data) or url
+	return 'link', url
+
+# The resolution of a post is cached by permalink, so that posts seen again (from the listing cache,
+# the reservoirs...) are not classified twice.
+def get_media(data):
+	permalink = data.get('permalink')
+	media = MEDIA_CACHE.get(permalink)
+	if media is None:
+		media = resolve_media(data)
+		MEDIA_CACHE.set(permalink, media)
+	return media
+
+
+MEDIA_CACHE = TTLCache('media', int(os.getenv('MEDIA_CACHE_SIZE', '10000')), int(os.getenv('MEDIA_CACHE_TTL', '86400')))
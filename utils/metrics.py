@@ -0,0 +1,248 @@
+# Reddiator bot module file
+# Module name: utils-metrics
+# Version: 1.0
+
+# Description: This module provides the helpers used to measure the bot's performance
+
+import threading
+
+from collections import deque
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from time import perf_counter
+
+
+# Keeps the latest samples of a latency (in seconds) and computes percentiles over them.
+class LatencyRecorder():
+
+	def __init__(self, name, maxsamples = 1024):
+		self.name = name
+		self.samples = deque(maxlen = maxsamples)
+		self.count = 0
+		self.lock = threading.Lock()
+
+	def record(self, seconds):
+		with self.lock:
+			self.samples.append(seconds)
+			self.count = self.count + 1
+
+	def percentile(self, p):
+		with self.lock:
+			samples = sorted(self.samples)
+		if len(samples) == 0:
+			return 0.0
+		index = min(int(len(samples) * p / 100), len(samples) - 1)
+		return samples[index]
+
+	def stats(self):
+		return {'count': self.count, 'p50': self.percentile(50), 'p99': self.percentile(99)}
+
+
+# Latency histogram with logarithmic buckets (HDR-style): values are counted in microseconds, in buckets
+# of 2 ** SUB_BUCKET_BITS sub-buckets per power of two, so that recording is O(1) and percentiles are exact
+# to about 6%, with a fixed amount of memory whatever the number of samples.
+SUB_BUCKET_BITS = 4
+
+def bucket_index(microseconds):
+	if microseconds < (1 << SUB_BUCKET_BITS):
+		return microseconds
+	shift = microseconds.bit_length() - SUB_BUCKET_BITS - 1
+	return ((shift + 1) << SUB_BUCKET_BITS) + (microseconds >> shift) - (1 << SUB_BUCKET_BITS)
+
+# Highest value (in microseconds) counted in a bucket
+def bucket_value(index):
+	if index < (1 << SUB_BUCKET_BITS):
+		return index
+	shift = (index >> SUB_BUCKET_BITS) - 1
+	return (((index & ((1 << SUB_BUCKET_BITS) - 1)) + (1 << SUB_BUCKET_BITS) + 1) << shift) - 1
+
+class Histogram():
+
+	def __init__(self, name, labels):
+		self.name = name
+		self.labels = labels
+		self.counts = {}
+		self.count = 0
+		self.sum = 0.0
+		self.max = 0.0
+		self.lock = threading.Lock()
+
+	def record(self, seconds):
+		index = bucket_index(int(seconds * 1e6))
+		with self.lock:
+			self.counts[index] = self.counts.get(index, 0) + 1
+			self.count = self.count + 1
+			self.sum = self.sum + seconds
+			if seconds > self.max:
+				self.max = seconds
+
+	def time(self):
+		return Timer(self)
+
+	def percentile(self, p):
+		with self.lock:
+			counts = sorted(self.counts.items())
+			target = self.count * p / 100
+		seen = 0
+		for index, count in counts:
+			seen = seen + count
+			if seen >= target:
+				return min(bucket_value(index) / 1e6, self.max)
+		return 0.0
+
+	def stats(self):
+		return {'count': self.count, 'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99), 'max': self.max}
+
+# with histogram.time(): ... records the duration of the block (exceptions included)
+class Timer():
+
+	__slots__ = ('histogram', 'start')
+
+	def __init__(self, histogram):
+		self.histogram = histogram
+
+	def __enter__(self):
+		self.start = perf_counter()
+		return self
+
+	def __exit__(self, *args):
+		self.histogram.record(perf_counter() - self.start)
+		return False
+
+class Counter():
+
+	def __init__(self, name, labels):
+		self.name = name
+		self.labels = labels
+		self.value = 0
+		self.lock = threading.Lock()
+
+	def inc(self, value = 1):
+		with self.lock:
+			self.value = self.value + value
+
+
+# Histograms and counters are created on first use, one per name and set of labels.
+# The stats() methods of the other components (caches, rate limit...) are exposed as gauges.
+class MetricsRegistry():
+
+	def __init__(self, prefix = 'reddiator'):
+		self.prefix = prefix
+		self.histograms = {}
+		self.counters = {}
+		self.gauges = {}
+		self.lock = threading.Lock()
+
+	def get(self, metrics, cls, name, labels):
+		key = (name, tuple(sorted(labels.items())))
+		metric = metrics.get(key)
+		if metric is None:
+			with self.lock:
+				metric = metrics.setdefault(key, cls(name, labels))
+		return metric
+
+	def histogram(self, name, **labels):
+		return self.get(self.histograms, Histogram, name, labels)
+
+	def counter(self, name, **labels):
+		return self.get(self.counters, Counter, name, labels)
+
+	def register_stats(self, name, stats):
+		self.gauges[name] = stats
+
+	def snapshot(self):
+		return {'histograms': {(histogram.name, key[1]): histogram.stats() for key, histogram in list(self.histograms.items())},
+			'counters': {(counter.name, key[1]): counter.value for key, counter in list(self.counters.items())}}
+
+	# Prometheus text format: histograms are exposed as summaries (quantiles, sum and count)
+	def render_prometheus(self):
+		lines = []
+		for name, metrics in group_by_name(self.histograms).items():
+			lines.append(f'# TYPE {self.prefix}_{name}_seconds summary')
+			for histogram in metrics:
+				for quantile in (0.5, 0.9, 0.99):
+					lines.append(f'{self.prefix}_{name}_seconds{format_labels(histogram.labels, quantile = quantile)} {histogram.percentile(quantile * 100):.6f}')
+				lines.append(f'{self.prefix}_{name}_seconds_sum{format_labels(histogram.labels)} {histogram.sum:.6f}')
+				lines.append(f'{self.prefix}_{name}_seconds_count{format_labels(histogram.labels)} {histogram.count}')
+		for name, metrics in group_by_name(self.counters).items():
+			lines.append(f'# TYPE {self.prefix}_{name}_total counter')
+			for counter in metrics:
+				lines.append(f'{self.prefix}_{name}_total{format_labels(counter.labels)} {counter.value}')
+		for name, stats in list(self.gauges.items()):
+			try:
+				values = flatten_stats(stats())
+			except Exception:
+				continue
+			for key, value in values:
+				lines.append(f'# TYPE {self.prefix}_{name}_{key} gauge')
+				lines.append(f'{self.prefix}_{name}_{key} {value}')
+		return '\n'.join(lines) + '\n'
+
+def group_by_name(metrics):
+	groups = {}
+	for metric in list(metrics.values()):
+		groups.setdefault(metric.name, []).append(metric)
+	return groups
+
+def format_labels(labels, **extra):
+	labels = dict(labels, **extra)
+	if len(labels) == 0:
+		return ''
+	return '{' + ','.join([f'{key}="{str(value)}"' for key, value in sorted(labels.items())]) + '}'
+
+# Numeric values of a (nested) stats dict, with their path as name
+def flatten_stats(stats, prefix = ''):
+	values = []
+	for key, value in stats.items():
+		name = f'{prefix}{key}'.replace('.', '_').replace('-', '_')
+		if isinstance(value, dict):
+			values.extend(flatten_stats(value, name + '_'))
+		elif isinstance(value, (bool, int, float)):
+			values.append((name, float(value)))
+	return values
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		if self.path.split('?')[0] != '/metrics':
+			self.send_error(404)
+			return
+		body = self.server.registry.render_prometheus().encode()
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+# Serves /metrics from a daemon thread, on the loopback interface by default
+def start_metrics_server(registry, port, host = '127.0.0.1'):
+	server = ThreadingHTTPServer((host, port), MetricsHandler)
+	server.daemon_threads = True
+	server.registry = registry
+	thread = threading.Thread(target = server.serve_forever, name = 'metrics', daemon = True)
+	thread.start()
+	return server
+
+
+# Short text summary of the histograms and counters, for the stats command (one line per metric)
+def format_summary(registry, max_length = 1900):
+	snapshot = registry.snapshot()
+	lines = []
+	for (name, labels), stats in sorted(snapshot['histograms'].items()):
+		label = ','.join([str(value) for _, value in labels])
+		lines.append(f'{name}[{label}] n={stats["count"]} p50={stats["p50"] * 1000:.1f}ms p99={stats["p99"] * 1000:.1f}ms max={stats["max"] * 1000:.1f}ms')
+	for (name, labels), value in sorted(snapshot['counters'].items()):
+		label = ','.join([str(value) for _, value in labels])
+		lines.append(f'{name}[{label}] {value}')
+	text = '\n'.join(lines)
+	if len(text) > max_length:
+		text = text[:max_length] + '\n...'
+	return text
+
+
+METRICS = MetricsRegistry()
@@ -0,0 +1,141 @@
+# Reddiator bot module file
+# Module name: utils-outbox
+# Version: 1.0
+
+# Description: This module delivers the messages sent by the bot to Discord, paced per channel
+
+import os, logging, asyncio
+
+from collections import deque
+
+from time import monotonic
+
+from utils.metrics import LatencyRecorder, METRICS
+from utils.logs import get_logger, INFO
+
+
+LOGGER = get_logger('utils.outbox')
+
+def custom_info_log(msg, *args):
+	LOGGER.log(INFO, '\t' + msg, *args)
+
+
+MAX_MESSAGE_LENGTH = 2000
+
+
+class OutgoingMessage():
+
+	__slots__ = ('content', 'coalesce', 'future', 'queued_at')
+
+	def __init__(self, content, coalesce, future):
+		self.content = content
+		self.coalesce = coalesce
+		self.future = future
+		self.queued_at = monotonic()
+
+
+# Messages are queued per channel and sent by one worker task per channel, so that channels are served
+# in parallel while each channel is paced to stay within Discord's per-channel bucket (burst messages,
+# then one message every 1/rate seconds). Plain text messages queued for the same channel are merged into a
+# single message when possible (not the posts, whose links would lose their preview). Handlers enqueue their messages and move on; they only wait for the
+# returned future when they need the sent message (e.g. to add reactions).
+class Outbox():
+
+	def __init__(self, rate = 1.0, burst = 5, max_retries = 3):
+		self.rate = rate
+		self.burst = burst
+		self.max_retries = max_retries
+		self.queues = {}
+		self.buckets = {}
+		self.workers = {}
+		self.sent = 0
+		self.coalesced = 0
+		self.rate_limited = 0
+		self.failed = 0
+		self.latency = LatencyRecorder('send')
+
+	# coalesce = False for messages that must be sent on their own (e.g. the ones that get reactions, or the links to embed)
+	def send(self, channel, content, coalesce = True):
+		future = asyncio.get_event_loop().create_future()
+		self.queues.setdefault(channel.id, deque()).append(OutgoingMessage(content, coalesce, future))
+		if channel.id not in self.workers:
+			self.workers[channel.id] = asyncio.ensure_future(self.deliver(channel))
+		return future
+
+	async def wait_for_bucket(self, channel_id):
+		tokens, last = self.buckets.get(channel_id, (self.burst, monotonic()))
+		now = monotonic()
+		tokens = min(self.burst, tokens + (now - last) * self.rate)
+		if tokens < 1:
+			await asyncio.sleep((1 - tokens) / self.rate)
+			now = monotonic()
+			tokens = 1
+		self.buckets[channel_id] = (tokens - 1, now)
+
+	# Takes the next message of the queue, merged with the following text messages if they fit in one message
+	def next_batch(self, queue):
+		batch = [queue.popleft()]
+		if batch[0].coalesce:
+			length = len(batch[0].content)
+			while len(queue) > 0 and queue[0].coalesce and length + 1 + len(queue[0].content) <= MAX_MESSAGE_LENGTH:
+				length = length + 1 + len(queue[0].content)
+				batch.append(queue.popleft())
+		return batch
+
+	async def deliver(self, channel):
+		queue = self.queues[channel.id]
+		try:
+			while len(queue) > 0:
+				batch = self.next_batch(queue)
+				if len(batch) > 1:
+					self.coalesced = self.coalesced + len(batch) - 1
+				await self.send_batch(channel, batch)
+		finally:
+			del self.workers[channel.id]
+			if len(queue) == 0:
+				del self.queues[channel.id]
+			else:
+				self.workers[channel.id] = asyncio.ensure_future(self.deliver(channel))
+
+	async def send_batch(self, channel, batch):
+		content = '\n'.join([message.content for message in batch])
+		result = None
+		for attempt in range(self.max_retries + 1):
+			await self.wait_for_bucket(channel.id)
+			try:
+				with METRICS.histogram('discord_send').time():
+					result = await channel.send(content)
+				break
+			except Exception as e:
+				if getattr(e, 'status', None) == 429 and attempt < self.max_retries:
+					self.rate_limited = self.rate_limited + 1
+					retry_after = getattr(e, 'retry_after', None) or 1.0
+					logging.warning('Rate limited by Discord on channel %s, retrying in %ss', channel.id, retry_after)
+					await asyncio.sleep(retry_after)
+				else:
+					self.failed = self.failed + 1
+					logging.error('Error sending a message to channel %s: %r', channel.id, e)
+					break
+
+		now = monotonic()
+		for message in batch:
+			self.latency.record(now - message.queued_at)
+			if not message.future.done():
+				message.future.set_result(result)
+		if result is not None:
+			self.sent = self.sent + 1
+
+	# Waits until all the queued messages are sent
+	async def flush(self):
+		while len(self.workers) > 0:
+			await asyncio.gather(*list(self.workers.values()), return_exceptions = True)
+
+	def stats(self):
+		return {'queued': sum([len(q) for q in self.queues.values()]), 'channels': len(self.queues), 'sent': self.sent,
+			'coalesced': self.coalesced, 'rate_limited': self.rate_limited, 'failed': self.failed, 'latency': self.latency.stats()}
+
+
+def build_outbox():
+	return Outbox(rate = float(os.getenv('DISCORD_CHANNEL_RATE', '1')),
+		burst = int(os.getenv('DISCORD_CHANNEL_BURST', '5')),
+		max_retries = int(os.getenv('DISCORD_MAX_RETRIES', '3')))
@@ -0,0 +1,75 @@
+# Reddiator bot module file
+# Module name: utils-posts
+# Version: 1.0
+
+# Description: This module turns the JSON returned by Reddit's API into compact post records
+
+from utils.media import get_media
+
+# orjson is much faster than the standard json module, but it is optional
+try:
+	import orjson
+	json_loads = orjson.loads
+except ImportError:
+	import json
+	json_loads = json.loads
+
+
+# Compact representation of a Reddit post: only the fields used by the bot are kept,
+# the rest of the (big) decoded JSON tree can be freed right after parsing.
+class Post():
+
+	__slots__ = ('url', 'permalink', 'subreddit', 'over18', 'score', 'media_type', 'media_url', 'name', 'created')
+
+	def __init__(self, url, permalink, subreddit = '', over18 = False, score = 0, media_type = 'link', media_url = None, name = '', created = 0.0):
+		self.url = url
+		self.permalink = permalink
+		self.subreddit = subreddit
+		self.over18 = over18
+		self.score = score
+		self.media_type = media_type
+		# direct link to the media (e.g. the mp4 of a v.redd.it video), defaults to the url of the post
+		self.media_url = media_url if media_url is not None else url
+		# fullname (e.g. t3_abc123) and creation time, used as cursors by the /new watcher (see utils.watcher)
+		self.name = name
+		self.created = created
+
+	def __eq__(self, other):
+		return isinstance(other, Post) and self.permalink == other.permalink
+
+	def __hash__(self):
+		return hash(self.permalink)
+
+	def __repr__(self):
+		return f'Post({self.permalink})'
+
+def build_post(data):
+	media_type, media_url = get_media(data)
+	# the NSFW flag of a post is over_18 (over18 is the one of a subreddit)
+	return Post(data['url'], data['permalink'], data.get('subreddit', ''), bool(data.get('over_18', data.get('over18', False))), data.get('score', 0),
+		media_type, media_url, data.get('name', ''), float(data.get('created_utc', 0.0)))
+
+# Posts are stored as lists of their fields in the shared store (see utils.shared_store)
+def encode_posts(posts):
+	return [[getattr(post, slot) for slot in Post.__slots__] for post in posts]
+
+def decode_posts(rows):
+	return [Post(*row) for row in rows]
+
+# Parses a listing (e.g. /top) in a single pass. Raises ValueError if the body is not a listing.
+def parse_listing(text):
+	try:
+		return [build_post(child['data']) for child in json_loads(text)['data']['children']]
+	except (KeyError, TypeError, IndexError) as e:
+		raise ValueError(f'Unexpected listing format ({e!r})')
+
+# Parses the response of /random (a list whose first element is a listing containing the post).
+def parse_random_post(text):
+	try:
+		return build_post(json_loads(text)[0]['data']['children'][0]['data'])
+	except (KeyError, TypeError, IndexError) as e:
+		raise ValueError(f'Unexpected random post format ({e!r})')
+
+# Responses logged on errors are truncated, the body of a listing can be several hundred kilobytes
+def truncate(text, length = 500):
+	return text if len(text) <= length else text[:length] + f'... ({len(text) - length} more characters)'
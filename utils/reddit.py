@@ -4,20 +4,31 @@
 
 # Description: This module deals with everything related to Reddit
 
-import reddiator
+import os, re, logging, atexit, threading, contextvars
 
-import os, logging
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import requests
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
 
 from dotenv import load_dotenv
 
-import json
+from random import randint, sample, shuffle, choice
 
-from random import randint
+from collections import deque
 
-from time import time
+from heapq import heappush, heappop
+
+from time import time, monotonic, sleep, perf_counter
+
+from utils.cache import TTLCache, MemoryBoundedTTLCache
+from utils.metrics import LatencyRecorder, METRICS
+from utils.posts import Post, parse_listing, parse_random_post, truncate, json_loads, encode_posts, decode_posts
+from utils.shared_store import build_shared_store
+from utils.logs import get_logger, INFO
 
 
 class RequestException(Exception):
@@ -28,69 +39,457 @@ class RequestException(Exception):
 # 3 = Requested subreddit is banned
 # 4 = Requested subreddit is quarantined
 # 5 = Problem with the Access Token
+# 10 = Rate limited by Reddit (or request shed by the rate-limit governor)
+# 11 = No posts in the requested listing (e.g. nothing posted in the last hour): the subreddit itself may be fine
 
 	def __init__(self, code):
 		super().__init__(code)
 		self.code = code
 
-def custom_info_log(msg):
-	logger = logging.getLogger('utils.reddit')
-	logger.log(21, '\t' + msg)
+LOGGER = get_logger('utils.reddit')
+
+def custom_info_log(msg, *args):
+	LOGGER.log(INFO, '\t' + msg, *args)
+
+# Connection pooling: one persistent session per Reddit host, so that consecutive requests reuse
+# the same keep-alive connections instead of paying a new TCP and TLS handshake every time.
+# Default headers are set once on the sessions (the Bearer token is updated when it is renewed).
+def build_session(headers):
+	session = requests.Session()
+	adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = POOL_SIZE)
+	session.mount('https://', adapter)
+	session.mount('http://', adapter)
+	session.headers.update(headers)
+	if not KEEP_ALIVE:
+		session.headers['Connection'] = 'close'
+	return session
+
+# Returns the number of connections opened and reused by the sessions, per host.
+def get_connection_stats():
+	stats = {}
+	for name, session in [('www', WWW_SESSION), ('oauth', OAUTH_SESSION)]:
+		opened = 0
+		requests_made = 0
+		adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+		for adapter in adapters.values():
+			pools = adapter.poolmanager.pools
+			for key in pools.keys():
+				pool = pools.get(key)
+				if pool is not None:
+					opened = opened + pool.num_connections
+					requests_made = requests_made + pool.num_requests
+		stats[name] = {'opened': opened, 'reused': max(requests_made - opened, 0), 'requests': requests_made}
+	return stats
+
+# Subreddit metadata (NSFW flag, or the error code if the subreddit is not reachable) is cached,
+# since it almost never changes (see get_subreddits_metadata).
+# Error outcomes are cached too, with a shorter TTL, so that a dead subreddit is not requested over and over
+# (only the ones proving that the subreddit is not reachable, see CACHED_ERROR_CODES: an empty listing proves nothing).
+def remember_subreddit_error(subreddit, code):
+	if code in CACHED_ERROR_CODES:
+		SUBREDDIT_CACHE.set(subreddit.lower(), {'error': code}, ttl = SUBREDDIT_CACHE_ERROR_TTL)
+
+def is_known_unavailable(subreddit):
+	metadata = SUBREDDIT_CACHE.peek(subreddit.lower())
+	return metadata is not None and 'error' in metadata
+
+# The snapshot is restored during the warm-up of the bot (see utils.startup), not when the module is imported
+# (the snapshot is only saved at exit once it was restored, so that a process which didn't restore it can't overwrite it)
+def restore_subreddit_cache():
+	if len(SUBREDDIT_CACHE_FILENAME) > 0:
+		SUBREDDIT_CACHE.load_snapshot(SUBREDDIT_CACHE_FILENAME)
+		atexit.register(save_subreddit_cache)
+
+def save_subreddit_cache():
+	SUBREDDIT_CACHE.save_snapshot(SUBREDDIT_CACHE_FILENAME)
+
+# This function is responsible for requesting a new OAuth access token.
+# Transient failures (network errors, 429 and 5xx) are retried with a backoff.
+# Must be called with TOKEN_LOCK held, so that concurrent callers never refresh the token more than once.
+def refresh_access_token():
 
-def get_nsfw_status(subreddit):
-	headers = {'User-Agent' : os.getenv('REDDIT_USER_AGENT')}
+	global ACCESS_TOKEN
 
-	post_req = requests.get('https://www.reddit.com/r/'+subreddit+'/about.json', headers=headers, allow_redirects = True)
+	start = perf_counter()
+	for attempt in range(TOKEN_MAX_RETRIES + 1):
+		try:
+			token_req = WWW_SESSION.post(REDDIT_WWW_URL + '/api/v1/access_token', auth = HTTPBasicAuth(os.getenv('REDDIT_CLIENT_ID'), os.getenv('REDDIT_CLIENT_SECRET')), data = 'grant_type=refresh_token&refresh_token=' + os.getenv('REDDIT_REFRESH_TOKEN'), timeout = REQUEST_TIMEOUT)
+			if token_req.status_code != 429 and token_req.status_code < 500:
+				break
+			logging.warning('Request for an AT failed with a HTTP %s code (attempt %s)', token_req.status_code, attempt + 1)
+		except requests.exceptions.RequestException as e:
+			logging.warning('Request for an AT failed: %s (attempt %s)', e, attempt + 1)
+			token_req = None
+		if attempt < TOKEN_MAX_RETRIES:
+			sleep(get_retry_delay(token_req, attempt))
+
+	if token_req is None:
+		TOKEN_STATS['failures'] = TOKEN_STATS['failures'] + 1
+		logging.error('Error making the request for an AT. Reddit may be down.')
+		raise RequestException(5)
+
+	response_json = None
+	try:
+		response_json = json_loads(token_req.text)
+	except:
+		logging.error('Error making the request for an AT (or parsing the response). Reddit may be down, or something may be wrong with the bot account (RT revoked?)')
+		logging.error('AT request returned a HTTP %s code with body: %s', token_req.status_code, truncate(token_req.text))
 
-	content = json.loads(post_req.text)
-	if content['data']['over18']:
-		custom_info_log('NSFW subreddit!')
-		return True
-	else:
-		custom_info_log('Subreddit is SFW :)')
-		return False
+	try:
+		expires_in = response_json['expires_in']
+		at = response_json['access_token']
+		custom_info_log('Retrieved a new Reddit AT, expiring in %s seconds', expires_in)
+	except:
+		TOKEN_STATS['failures'] = TOKEN_STATS['failures'] + 1
+		# the token itself must never reach the logs
+		if isinstance(response_json, dict) and 'access_token' in response_json:
+			response_json = dict(response_json, access_token = '<redacted>')
+		logging.error('Error parsing the response from the AT request, no AT and expires attribute found in JSON. RT may be invalid?\nJSON response value: %s', response_json)
+		raise RequestException(5)
+
+	ACCESS_TOKEN = {'AT': at, 'EXPIRES': int(time()) + expires_in}
+	OAUTH_SESSION.headers['Authorization'] = 'Bearer ' + at
+
+	TOKEN_STATS['refreshes'] = TOKEN_STATS['refreshes'] + 1
+	TOKEN_REFRESH_LATENCY.record(perf_counter() - start)
+	schedule_token_renewal(expires_in - TOKEN_RENEWAL_MARGIN)
+	return at
+
+def access_token_valid():
+	return len(ACCESS_TOKEN['AT']) > 0 and ACCESS_TOKEN['EXPIRES'] - TOKEN_EXPIRY_MARGIN > int(time())
+
+# This function returns a valid OAuth access token, fetching a new one when necessary.
+# With force = True, the token is renewed even if it looks valid (e.g. after a 401), unless another
+# thread already replaced the token that was rejected (previous) in the meantime.
+# Only the calls that have to wait for a (possibly concurrent) renewal are timed.
+def get_access_token(force = False, previous = None):
+	if not force and access_token_valid():
+		return ACCESS_TOKEN['AT']
 
-# This function is responsible for fetching a new OAuth access token when necessary.
-def get_access_token():
+	with ACCESS_TOKEN_STAGE.time(), TOKEN_LOCK:
+		# another thread may have renewed the token while we were waiting for the lock
+		if access_token_valid() and (not force or ACCESS_TOKEN['AT'] != previous):
+			TOKEN_STATS['coalesced'] = TOKEN_STATS['coalesced'] + 1
+			custom_info_log('Access token was renewed by another request, let\'s reuse it')
+			return ACCESS_TOKEN['AT']
 
+		custom_info_log('No AT currently registered, or current AT expired, requesting a new one')
+		return refresh_shared_access_token(previous if force else None)
+
+# Uses the token published in the shared store by another worker, if it's valid and isn't the one to replace
+def adopt_shared_access_token(previous = None):
 	global ACCESS_TOKEN
 
-	if len(ACCESS_TOKEN['AT']) == 0 or ACCESS_TOKEN['EXPIRES'] < int(time()):
-		custom_info_log('No AT currently registered, or current AT expired, requesting a new one')
-		token_req = requests.post('https://www.reddit.com/api/v1/access_token', auth = HTTPBasicAuth(os.getenv('REDDIT_CLIENT_ID'), os.getenv('REDDIT_CLIENT_SECRET')), data = 'grant_type=refresh_token&refresh_token=' + os.getenv('REDDIT_REFRESH_TOKEN'), headers = {'User-Agent' : os.getenv('REDDIT_USER_AGENT')})
+	shared = SHARED_STORE.get('token', 'oauth')
+	if shared is None:
+		return False
+	token = shared[0]
+	if token['AT'] == previous or token['EXPIRES'] - TOKEN_EXPIRY_MARGIN <= int(time()):
+		return False
 
-		try:
-			response_json = json.loads(token_req.text)
-		except:
-			logging.error('Error making the request for an AT (or parsing the response). Reddit may be down, or something may be wrong with the bot account (RT revoked?)')
-			print(token_req.status_code)
-			print(token_req.text)
+	ACCESS_TOKEN = token
+	OAUTH_SESSION.headers['Authorization'] = 'Bearer ' + token['AT']
+	TOKEN_STATS['shared'] = TOKEN_STATS['shared'] + 1
+	custom_info_log('Using the access token obtained by another worker')
+	schedule_token_renewal(token['EXPIRES'] - int(time()) - TOKEN_RENEWAL_MARGIN)
+	return True
+
+# With a shared store, a single worker refreshes the token (holding a lock of the store) and publishes it,
+# the other workers wait for it instead of spending a refresh each. Must be called with TOKEN_LOCK held.
+def refresh_shared_access_token(previous = None):
+	if SHARED_STORE is None:
+		return refresh_access_token()
+
+	deadline = monotonic() + TOKEN_SHARED_WAIT
+	while monotonic() < deadline:
+		if adopt_shared_access_token(previous):
+			return ACCESS_TOKEN['AT']
+		if SHARED_STORE.try_lock('token', TOKEN_SHARED_WAIT):
+			try:
+				# the token may have been published between the check and the lock
+				if adopt_shared_access_token(previous):
+					return ACCESS_TOKEN['AT']
+				at = refresh_access_token()
+				SHARED_STORE.set('token', 'oauth', ACCESS_TOKEN, ACCESS_TOKEN['EXPIRES'] - int(time()))
+				return at
+			finally:
+				SHARED_STORE.unlock('token')
+		sleep(0.2)
+
+	logging.warning('No access token published by the other workers in time, requesting one')
+	return refresh_access_token()
+
+# Proactive renewal: the token is renewed in the background shortly before it expires,
+# so that no command has to wait for the refresh.
+def schedule_token_renewal(delay):
+	global TOKEN_RENEWAL_TIMER
+	if TOKEN_RENEWAL_TIMER is not None:
+		TOKEN_RENEWAL_TIMER.cancel()
+	TOKEN_RENEWAL_TIMER = threading.Timer(max(delay, 1), renew_access_token)
+	TOKEN_RENEWAL_TIMER.daemon = True
+	TOKEN_RENEWAL_TIMER.start()
+
+def renew_access_token():
+	try:
+		with TOKEN_LOCK:
+			TOKEN_STATS['renewals'] = TOKEN_STATS['renewals'] + 1
+			custom_info_log('Access token expires soon, renewing it in the background')
+			refresh_shared_access_token(ACCESS_TOKEN['AT'])
+	except RequestException:
+		logging.warning('Background renewal of the access token failed, trying again in a minute')
+		schedule_token_renewal(60)
+
+def get_coalescing_stats():
+	stats = SINGLE_FLIGHT.stats()
+	requests_made = stats['requests'] + RANDOM_STATS['requests']
+	coalesced = stats['coalesced'] + RANDOM_STATS['shared']
+	stats['random_requests'] = RANDOM_STATS['requests']
+	stats['random_shared'] = RANDOM_STATS['shared']
+	stats['coalescing_ratio'] = coalesced / requests_made if requests_made > 0 else 0.0
+	return stats
+
+def get_token_stats():
+	stats = dict(TOKEN_STATS)
+	stats['refresh_latency'] = TOKEN_REFRESH_LATENCY.stats()
+	return stats
+
+
+# Rate-limit governor shared by all the threads making requests to the oauth endpoints.
+# Once Reddit announced its quota in the X-Ratelimit-* headers, the requests are only limited by it: the remaining
+# requests can be sent right away, and the next ones wait for the reset instead of running into a 429.
+# Until then (first requests, or a reset passed without a response since), a token bucket with Reddit's usual
+# quota (600 requests per 600 s, all of them allowed in a burst) stands in for it.
+# Interactive requests (user commands) are served before background ones (pre-fetching, health checks...);
+# background requests are shed when the remaining quota is low, and any request that would have to wait
+# longer than max_wait is shed with RequestException(10).
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+class RateLimitGovernor():
+
+	def __init__(self, rate, burst, background_reserve, max_wait):
+		self.default_rate = rate
+		self.burst = burst
+		self.background_reserve = background_reserve
+		self.max_wait = max_wait
+		self.tokens = burst
+		self.last_refill = monotonic()
+		self.remaining = None
+		self.reset_at = None
+		self.paused_until = 0
+		# requests sent and not answered yet: the quota announced by the next response doesn't count them
+		self.in_flight = 0
+		self.waiting = {PRIORITY_INTERACTIVE: 0, PRIORITY_BACKGROUND: 0}
+		self.shed = 0
+		self.throttled = 0
+		self.condition = threading.Condition()
+
+	def quota_known(self, now):
+		return self.remaining is not None and self.reset_at is not None and now < self.reset_at
+
+	def rate(self, now):
+		if self.quota_known(now):
+			return self.remaining / max(self.reset_at - now, 1)
+		return self.default_rate
+
+	def refill(self, now):
+		self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate(now))
+		self.last_refill = now
+
+	def wait_time(self, priority, now):
+		self.refill(now)
+		if self.paused_until > now:
+			return self.paused_until - now
+		if self.quota_known(now) and self.remaining < 1:
+			return self.reset_at - now
+		if priority == PRIORITY_BACKGROUND and self.waiting[PRIORITY_INTERACTIVE] > 0:
+			return 0.05
+		if self.quota_known(now) or self.tokens >= 1:
+			return 0
+		return (1 - self.tokens) / max(self.rate(now), 0.01)
+
+	def acquire(self, priority = PRIORITY_INTERACTIVE):
+		deadline = monotonic() + self.max_wait
+		with self.condition:
+			self.waiting[priority] = self.waiting[priority] + 1
+			try:
+				while True:
+					now = monotonic()
+					if priority == PRIORITY_BACKGROUND and self.quota_known(now) and self.remaining <= self.background_reserve:
+						self.shed = self.shed + 1
+						custom_info_log('Remaining Reddit quota is low (%s), shedding background request', self.remaining)
+						raise RequestException(10)
+
+					wait = self.wait_time(priority, now)
+					if wait <= 0:
+						self.in_flight = self.in_flight + 1
+						if self.quota_known(now):
+							self.remaining = self.remaining - 1
+						else:
+							self.tokens = self.tokens - 1
+						return
+					if now + wait > deadline:
+						self.shed = self.shed + 1
+						logging.warning('Request would wait %.1fs for the Reddit rate limit, shedding it', wait)
+						raise RequestException(10)
+					self.condition.wait(wait)
+			finally:
+				self.waiting[priority] = self.waiting[priority] - 1
+
+	# Called once per request sent, with the headers of its response (empty if it failed): updates the quota from the
+	# X-Ratelimit-Remaining and X-Ratelimit-Reset (seconds before the reset) headers.
+	# Within a window, responses can arrive out of order: the lowest remaining quota is kept.
+	# The reset is announced in whole seconds, hence the extra second before the quota is considered renewed.
+	def update(self, headers):
+		with self.condition:
+			self.in_flight = max(self.in_flight - 1, 0)
+			try:
+				remaining = float(headers['X-Ratelimit-Remaining']) - self.in_flight
+				reset_at = monotonic() + float(headers['X-Ratelimit-Reset']) + 1
+			except (KeyError, ValueError):
+				return
+			if self.quota_known(monotonic()) and reset_at <= self.reset_at + 1:
+				remaining = min(remaining, self.remaining)
+			self.remaining = max(remaining, 0)
+			self.reset_at = reset_at
+			self.condition.notify_all()
+
+	# Stops all requests for the specified number of seconds (429 or 5xx)
+	def pause(self, seconds):
+		with self.condition:
+			self.paused_until = max(self.paused_until, monotonic() + seconds)
+			self.throttled = self.throttled + 1
+			self.condition.notify_all()
+
+	def stats(self):
+		with self.condition:
+			now = monotonic()
+			return {'remaining': self.remaining if self.quota_known(now) else None,
+				'reset_in': self.reset_at - now if self.quota_known(now) else None,
+				'rate': self.rate(now), 'tokens': self.tokens, 'in_flight': self.in_flight,
+				'queued_interactive': self.waiting[PRIORITY_INTERACTIVE], 'queued_background': self.waiting[PRIORITY_BACKGROUND],
+				'shed': self.shed, 'throttled': self.throttled,
+				'queued_in_loop': REQUEST_SEMAPHORE.queued() if REQUEST_SEMAPHORE is not None else 0}
+
+def get_retry_delay(post_req, attempt):
+	try:
+		return float(post_req.headers['Retry-After'])
+	except (KeyError, ValueError, AttributeError):
+		return min(RETRY_BASE_DELAY * 2 ** attempt, 30)
+
+
+# Request coalescing: identical fetches made concurrently (same key) are merged into a single one, whose result
+# (or error) is handed to all the callers. The boundary is the fetch as a whole: the request, the parsing of the
+# response and the cache fill run once, and the callers share the parsed result (e.g. the list of Posts).
+class SingleFlight():
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.calls = {}
+		self.requests = 0
+		self.coalesced = 0
+
+	def do(self, key, func):
+		with self.lock:
+			self.requests = self.requests + 1
+			call = self.calls.get(key)
+			leader = call is None
+			if leader:
+				call = {'done': threading.Event(), 'result': None, 'error': None}
+				self.calls[key] = call
+			else:
+				self.coalesced = self.coalesced + 1
+
+		if not leader:
+			call['done'].wait()
+			if isinstance(call['error'], RequestException):
+				raise RequestException(call['error'].code)
+			elif call['error'] is not None:
+				raise RequestException(0)
+			return call['result']
 
 		try:
-			expires = int(time()) + response_json['expires_in']
-			at = response_json['access_token']
-			custom_info_log(f'Retrieved Reddit AT : {at}')
-		except:
-			logging.error(f'Error parsing the response from the AT request, no AT and expires attribute found in JSON. RT may be invalid?\nJSON response value: {response_json}')
-			raise RequestException(5)
-
-		ACCESS_TOKEN = {'AT': at, 'EXPIRES': expires}
-		return at
+			call['result'] = func()
+			return call['result']
+		except Exception as e:
+			call['error'] = e
+			raise
+		finally:
+			with self.lock:
+				del self.calls[key]
+			call['done'].set()
 
-	else:
-		custom_info_log('Looks like our access token is still valid, let\'s reuse it')
-		return ACCESS_TOKEN['AT']
+	def stats(self):
+		return {'requests': self.requests, 'coalesced': self.coalesced,
+			'coalescing_ratio': self.coalesced / self.requests if self.requests > 0 else 0.0}
 
 
 # This function is responsible for making the actual request to Reddit's API.
 # It will simply take an url as parameter, and perform a get on the page.
-def make_request(url, allow_redirects = False):
-	at = get_access_token()
-	headers = {'Authorization' : 'Bearer ' + at, 'User-Agent' : os.getenv('REDDIT_USER_AGENT')}
+# An empty listing raises the "no posts" error, unless allow_empty is True (e.g. no new posts since a cursor).
+# Requests throttled by Reddit (429) or failing on Reddit's side (5xx) are retried after the delay
+# given by the Retry-After header (or an exponential backoff).
+# Concurrent identical requests are coalesced by the callers, around the parsing of the response (see SingleFlight).
+def make_request(url, allow_redirects = False, priority = PRIORITY_INTERACTIVE, allow_empty = False):
+	replayed = False
+	for attempt in range(MAX_RETRIES + 1):
+		at = get_access_token()
+		post_req = governed_get(url, allow_redirects, priority)
+
+		# the token was revoked or expired earlier than announced: renew it once and replay the request
+		if post_req.status_code == 401 and not replayed:
+			replayed = True
+			TOKEN_STATS['replays'] = TOKEN_STATS['replays'] + 1
+			logging.warning('Request to Reddit failed with a HTTP 401 code, renewing the access token and replaying it')
+			get_access_token(force = True, previous = at)
+			post_req = governed_get(url, allow_redirects, priority)
+
+		if (post_req.status_code == 429 or post_req.status_code >= 500) and attempt < MAX_RETRIES:
+			delay = get_retry_delay(post_req, attempt)
+			logging.warning('Request to Reddit failed with a HTTP %s code, retrying in %.1fs', post_req.status_code, delay)
+			GOVERNOR.pause(delay)
+		else:
+			break
+
+	try:
+		return check_response(post_req, allow_empty)
+	except RequestException as e:
+		METRICS.counter('reddit_errors', code = e.code).inc()
+		raise
+
+# The governor is told about every request sent, even the failed ones, so that it knows which ones are still in flight
+def governed_get(url, allow_redirects, priority):
+	GOVERNOR.acquire(priority)
+	post_req = None
+	try:
+		post_req = session_get(OAUTH_SESSION, url, allow_redirects)
+	finally:
+		GOVERNOR.update(post_req.headers if post_req is not None else {})
+	return post_req
+
+# Requests are timed per endpoint, e.g. /r/*/top or /api/v1/access_token (subreddit names are not kept as labels)
+def get_endpoint(url):
+	path = url.split('?')[0].split('://', 1)[-1].split('/', 1)[-1].split('/')
+	if len(path) >= 3 and path[0] == 'r':
+		return '/r/*/' + path[2].replace('.json', '')
+	return '/' + '/'.join(path)
+
+# A stalled connection would hold one of the MAX_REQUESTS_IN_FLIGHT threads forever: requests time out after
+# REQUEST_TIMEOUT (connect, read), and network errors are reported as RequestException(0) like any other failure.
+def session_get(session, url, allow_redirects):
+	with METRICS.histogram('reddit_request', endpoint = get_endpoint(url)).time():
+		try:
+			return session.get(url, allow_redirects = allow_redirects, timeout = REQUEST_TIMEOUT)
+		except requests.exceptions.RequestException as e:
+			logging.warning('Request to Reddit failed: %s', e)
+			METRICS.counter('reddit_errors', code = 0).inc()
+			raise RequestException(0)
 
-	post_req = requests.get(url, headers=headers, allow_redirects = allow_redirects)
 
-	if post_req.status_code == 200 and post_req.text != '{"kind": "Listing", "data": {"modhash": null, "dist": 0, "children": [], "after": null, "before": null}}':
+# This function maps the status of a response from Reddit to the error codes of RequestException.
+# It returns the response itself if everything went fine.
+def check_response(post_req, allow_empty = False):
+	if post_req.status_code == 200 and (allow_empty or post_req.text != '{"kind": "Listing", "data": {"modhash": null, "dist": 0, "children": [], "after": null, "before": null}}'):
 		return post_req
 	elif post_req.status_code == 404:
 		if 'banned' in post_req.text:
@@ -99,7 +498,7 @@ def make_request(url, allow_redirects = False):
 		else:
 			logging.warning('Request to get a random post from specified subreddit failed with a HTTP 404 error. The subreddit may not exist anymore.')
 			raise RequestException(1)
-	elif post_req.status_code == 302 and 'search?q=' in post_req.text:
+	elif post_req.status_code == 302 and ('search?q=' in post_req.text or 'search' in post_req.headers.get('Location', '')):
 		logging.warning('Request to get a random post from specified subreddit returned with a HTTP 302 error redirecting to the search page: the subreddit probably doesn\'t exist.')
 		raise RequestException(1)
 	elif post_req.status_code == 403:
@@ -112,65 +511,459 @@ def make_request(url, allow_redirects = False):
 		else:
 			logging.error('Request to get a random post from specified subreddit failed with a HTTP 403 code, but the subreddit does not seem private or quarantined.')
 			raise RequestException(0)
+	elif post_req.status_code == 429:
+		logging.error('Request to Reddit failed with a HTTP 429 code: we are being rate limited.')
+		raise RequestException(10)
 	elif post_req.status_code == 200:
-		logging.warning('Request to get a random post from specified subreddit failed with a HTTP 200 error but an empty body. The subreddit may not exist anymore.')
-		raise RequestException(1)
+		# the subreddits that don't exist are answered by a 404 or a redirection to the search page, an empty listing
+		# only means that there is no post (e.g. in the top of the hour of a quiet subreddit)
+		logging.warning('Request to get posts from specified subreddit returned an empty listing.')
+		raise RequestException(11)
 	else:
-		logging.error(f'Request to get a random post from specified subreddit failed with a HTTP {post_req.status_code} error.\nThe response headers are:\n{post_req.headers}\nThe response body is:\n{post_req.text}')
+		logging.error('Request to get a random post from specified subreddit failed with a HTTP %s error.\nThe response body is:\n%s', post_req.status_code, truncate(post_req.text))
 		raise RequestException(0)
 
 
 # This function is repsonsible for fetching a single random post from Reddit's API.
-def get_random_post_from_subreddit(subreddit):
+# /random returns a single post, so concurrent random requests for the same subreddit cannot share it:
+# while one is in flight, the other requests share a single fetch of the subreddit's top listing instead
+# (coalesced and cached like any listing) and each takes a post that was not recently handed out.
+# seen is an optional predicate telling whether a post was already shown (see utils.seen): when /random returns
+# such a post, a fresh one is drawn from the top listing (usually cached) instead of asking /random again.
+def get_random_post_from_subreddit(subreddit, priority = PRIORITY_INTERACTIVE, seen = None):
+	key = subreddit.lower()
+	with RANDOM_LOCK:
+		RANDOM_STATS['requests'] = RANDOM_STATS['requests'] + 1
+		shared = key in RANDOM_IN_FLIGHT
+		if shared:
+			RANDOM_STATS['shared'] = RANDOM_STATS['shared'] + 1
+		else:
+			RANDOM_IN_FLIGHT.add(key)
 
-	url = 'https://oauth.reddit.com/r/' + subreddit + '/random'
+	if shared:
+		return get_shared_random_post_from_subreddit(subreddit, priority, seen)
 
 	try:
-		post_req = make_request(url, allow_redirects = True)
-#                       print(json.loads(post_req.text)[0]['data']['children'])
-#                       post_link = json.loads(post_req.text)[0]['data']['children']['url']
-#                       perma_link = json.loads(post_req.text)[0]['data']['children']['permalink']
+		post = fetch_random_post_from_subreddit(subreddit, priority)
+	finally:
+		with RANDOM_LOCK:
+			RANDOM_IN_FLIGHT.discard(key)
+
+	if seen is not None and seen(post):
+		custom_info_log('Random post from %s was already shown, drawing another one from the top listing', subreddit)
+		RANDOM_STATS['seen'] = RANDOM_STATS['seen'] + 1
+		return get_shared_random_post_from_subreddit(subreddit, priority, seen)
+	return post
+
+def get_shared_random_post_from_subreddit(subreddit, priority, seen = None):
+	custom_info_log('Drawing a random post from the shared listing of %s', subreddit)
+	posts = get_top_posts_from_subreddit(subreddit, RANDOM_SHARED_LISTING_SIZE, 'all', priority)
+	if len(posts) == 0:
+		logging.warning('No post left in the shared listing of %s.', subreddit)
+		raise RequestException(11)
+	with RANDOM_LOCK:
+		served = RANDOM_RECENTLY_SERVED.setdefault(subreddit.lower(), deque(maxlen = RANDOM_SHARED_LISTING_SIZE))
+		candidates = [post for post in posts if post.permalink not in served and (seen is None or not seen(post))]
+		if len(candidates) == 0:
+			candidates = [post for post in posts if seen is None or not seen(post)] or posts
+		post = choice(candidates)
+		served.append(post.permalink)
+	return post
+
+def fetch_random_post_from_subreddit(subreddit, priority):
+
+	url = REDDIT_OAUTH_URL + '/r/' + subreddit + '/random'
+
+	try:
+		post_req = make_request(url, allow_redirects = True, priority = priority)
 
 		try:
-			response_json = json.loads(post_req.text)
-			try:
-				post_link = response_json[0]['data']['children'][0]['data']['url']
-				perma_link = response_json[0]['data']['children'][0]['data']['permalink']
-			except Exception as e:
-				logging.error('Error reading the JSON data returned by Reddit API')
-				logging.error(f'JSON data: {response_json}')
-				raise RequestException(0)
-		except:
-			logging.error('Error parsing the JSON returned by Reddit API')
-			logging.error(f'Response headers: {post_req.headers}')
-			logging.error(f'Response body: {post_req.text}')
+			with JSON_PARSE_STAGE.time():
+				post = parse_random_post(post_req.text)
+		except ValueError as e:
+			logging.error('Error parsing the JSON returned by Reddit API: %s', e)
+			logging.error('Response body: %s', truncate(post_req.text))
 			raise RequestException(0)
 
-		custom_info_log(f'Successfully got random post from {subreddit}')
-		return post_link, perma_link
+		custom_info_log('Successfully got random post from %s', subreddit)
+		return post
 	except RequestException as e:
+		remember_subreddit_error(subreddit, e.code)
 		raise RequestException(e.code)
 
 
-def get_top_post_from_subreddit(subreddit, number, timespan):
+# Top listings are cached, keyed by (subreddit, timespan, limit), for a duration depending on the timespan:
+# the top posts of the hour change quickly, the top posts of all time almost never do.
+def normalize_timespan(timespan):
+	return TIMESPAN_ALIASES.get(timespan, timespan)
 
-	url = 'https://oauth.reddit.com/r/' + subreddit + '/top?t=' + timespan + '&limit=' + str(number)
+def get_top_posts_from_subreddit(subreddit, number, timespan, priority = PRIORITY_INTERACTIVE):
+	timespan = normalize_timespan(timespan)
+	key = (subreddit.lower(), timespan, int(number))
 
-	try:
-		post_req = make_request(url, allow_redirects = False)
-		links = [items['data']['url'] for items in json.loads(post_req.text)['data']['children']]
-		permalinks = [items['data']['permalink'] for items in json.loads(post_req.text)['data']['children']]
+	posts = LISTING_CACHE.get(key)
+	if posts is not None:
+		custom_info_log('Using the cached top %s posts of %s from %s', number, timespan, subreddit)
+		return posts
+	return SINGLE_FLIGHT.do(('top', ) + key, partial(fetch_top_posts_from_subreddit, subreddit, number, timespan, key, priority))
+
+def fetch_top_posts_from_subreddit(subreddit, number, timespan, key, priority):
+	url = REDDIT_OAUTH_URL + '/r/' + subreddit + '/top?t=' + timespan + '&limit=' + str(number)
 
-		custom_info_log(f'Successfully fetched {str(len(links))} links frop top posts')
+	try:
+		post_req = make_request(url, allow_redirects = False, priority = priority)
+		try:
+			with JSON_PARSE_STAGE.time():
+				posts = parse_listing(post_req.text)
+		except ValueError as e:
+			logging.error('Error parsing the JSON returned by Reddit API: %s', e)
+			logging.error('Response body: %s', truncate(post_req.text))
+			raise RequestException(0)
 
-		random_index = randint(0, len(links) - 1)
-		custom_info_log(f'Link #{random_index} was chosen')
+		custom_info_log('Successfully fetched %s links frop top posts', str(len(posts)))
 
-		return links[random_index], permalinks[random_index]
+		LISTING_CACHE.set(key, posts, ttl = LISTING_CACHE_TTLS.get(timespan, LISTING_CACHE_TTLS['all']))
+		return posts
 	except RequestException as e:
+		remember_subreddit_error(subreddit, e.code)
 		raise RequestException(e.code)
 
+# Draws k distinct posts (without replacement) from the top listing, so that several posts only cost one request.
+# Less than k posts are returned if the listing is too small.
+# Posts for which seen returns True are only drawn when there aren't enough fresh ones in the listing
+def sample_top_posts_from_subreddit(subreddit, number, timespan, k, seen = None):
+	posts = get_top_posts_from_subreddit(subreddit, number, timespan)
+	k = min(k, len(posts))
+	if seen is None:
+		return sample(posts, k)
+	fresh = [post for post in posts if not seen(post)]
+	if len(fresh) >= k:
+		return sample(fresh, k)
+	custom_info_log('Only %s posts of the top %s of %s were not shown yet', len(fresh), number, subreddit)
+	return fresh + sample([post for post in posts if post not in fresh], k - len(fresh))
+
+# The listing may be empty once its stickied posts and the posts that can't be parsed are filtered out
+def get_top_post_from_subreddit(subreddit, number, timespan, seen = None):
+	posts = sample_top_posts_from_subreddit(subreddit, number, timespan, 1, seen)
+	if len(posts) == 0:
+		logging.warning('No post left in the top %s posts of %s from %s.', number, timespan, subreddit)
+		raise RequestException(11)
+	return posts[0]
+
+# Newest posts of one or several subreddits (a multireddit, e.g. /r/a+b+c/new), newest first.
+# With before (the fullname of a post of the same listing), only the limit posts following it are returned
+# (an empty listing then just means that nothing was posted since).
+def get_new_posts(subreddits, before = None, limit = 100):
+	url = REDDIT_OAUTH_URL + '/r/' + '+'.join(subreddits) + '/new?limit=' + str(limit) + ('&before=' + before if before is not None else '')
+	post_req = make_request(url, allow_redirects = False, priority = PRIORITY_BACKGROUND, allow_empty = True)
+	try:
+		with JSON_PARSE_STAGE.time():
+			return parse_listing(post_req.text)
+	except ValueError as e:
+		logging.error('Error parsing the JSON returned by Reddit API: %s', e)
+		logging.error('Response body: %s', truncate(post_req.text))
+		raise RequestException(0)
+
+
+# Metadata of many subreddits at once, through the oauth client: {subreddit (lowercase): metadata}, where metadata is
+# {'over18': bool}, or {'error': code} for the subreddits that are not reachable (same codes as RequestException).
+# The subreddits not in the cache are resolved SUBREDDIT_INFO_CHUNK at a time by /api/info?sr_name=a,b,c, which
+# returns the existing ones (private ones only with their type). The missing ones (banned or not found, which
+# /api/info doesn't tell apart) are then requested one by one from /r/$sub/about, so the error codes are the ones
+# of make_request. Other errors (rate limit, Reddit down...) are raised, the chunks already resolved staying cached.
+def get_subreddits_metadata(subreddits, priority = PRIORITY_INTERACTIVE):
+	results = {}
+	missing = []
+	for subreddit in subreddits:
+		key = subreddit.lower()
+		if key in results:
+			continue
+		metadata = SUBREDDIT_CACHE.get(key)
+		if metadata is not None:
+			results[key] = metadata
+		elif SUBREDDIT_NAME.fullmatch(subreddit) is None:
+			# not a valid name, it can't exist
+			results[key] = {'error': 1}
+		else:
+			results[key] = None
+			missing.append(key)
+	METADATA_STATS['lookups'] = METADATA_STATS['lookups'] + len(results)
+	if len(missing) == 0:
+		return results
+
+	custom_info_log('No cached metadata for %s subreddits, requesting them by chunks of %s', len(missing), SUBREDDIT_INFO_CHUNK)
+	for i in range(0, len(missing), SUBREDDIT_INFO_CHUNK):
+		results.update(request_subreddits_info(missing[i:i + SUBREDDIT_INFO_CHUNK], priority))
+	for key in [key for key in missing if results[key] is None]:
+		results[key] = request_subreddit_about(key, priority)
+	return results
+
+def request_subreddits_info(subreddits, priority):
+	return SINGLE_FLIGHT.do(('info', ) + tuple(subreddits), partial(fetch_subreddits_info, subreddits, priority))
+
+def fetch_subreddits_info(subreddits, priority):
+	url = REDDIT_OAUTH_URL + '/api/info?sr_name=' + ','.join(subreddits)
+	post_req = make_request(url, allow_redirects = False, priority = priority, allow_empty = True)
+	METADATA_STATS['info_requests'] = METADATA_STATS['info_requests'] + 1
+	try:
+		with JSON_PARSE_STAGE.time():
+			children = json_loads(post_req.text)['data']['children']
+		found = {child['data']['display_name'].lower(): child['data'] for child in children}
+	except (ValueError, KeyError, TypeError):
+		logging.error('Error reading the subreddit info returned by Reddit for %s subreddits', len(subreddits))
+		raise RequestException(0)
+
+	results = {}
+	for subreddit in subreddits:
+		data = found.get(subreddit)
+		if data is None:
+			results[subreddit] = None
+			continue
+		if data.get('subreddit_type') == 'private':
+			metadata = {'error': 2}
+		elif data.get('quarantine'):
+			metadata = {'error': 4}
+		else:
+			metadata = {'over18': bool(data.get('over18'))}
+		store_subreddit_metadata(subreddit, metadata)
+		results[subreddit] = metadata
+	return results
+
+def request_subreddit_about(subreddit, priority):
+	return SINGLE_FLIGHT.do(('about', subreddit), partial(fetch_subreddit_about, subreddit, priority))
+
+def fetch_subreddit_about(subreddit, priority):
+	METADATA_STATS['about_requests'] = METADATA_STATS['about_requests'] + 1
+	try:
+		post_req = make_request(REDDIT_OAUTH_URL + '/r/' + subreddit + '/about', allow_redirects = False, priority = priority)
+		with JSON_PARSE_STAGE.time():
+			metadata = {'over18': bool(json_loads(post_req.text)['data']['over18'])}
+	except RequestException as e:
+		if e.code not in CACHED_ERROR_CODES:
+			raise
+		metadata = {'error': e.code}
+	except (ValueError, KeyError, TypeError):
+		logging.error('Error reading the about data returned by Reddit for subreddit %s', subreddit)
+		raise RequestException(0)
+	store_subreddit_metadata(subreddit, metadata)
+	return metadata
+
+def store_subreddit_metadata(subreddit, metadata):
+	if 'error' in metadata:
+		remember_subreddit_error(subreddit, metadata['error'])
+	else:
+		SUBREDDIT_CACHE.set(subreddit.lower(), metadata)
+
+def get_subreddit_metadata(subreddit, priority = PRIORITY_INTERACTIVE):
+	metadata = get_subreddits_metadata([subreddit], priority)[subreddit.lower()]
+	if 'error' in metadata:
+		custom_info_log('Subreddit %s is unavailable (code %s)', subreddit, metadata["error"])
+		raise RequestException(metadata['error'])
+	return metadata
+
+def get_metadata_stats():
+	return dict(METADATA_STATS)
+
+def get_nsfw_status(subreddit, priority = PRIORITY_INTERACTIVE):
+	if get_subreddit_metadata(subreddit, priority)['over18']:
+		custom_info_log('NSFW subreddit!')
+		return True
+	else:
+		custom_info_log('Subreddit is SFW :)')
+		return False
+
+
+# Async layer: the functions above use the blocking requests library, so the Discord
+# handlers must not call them directly or every Reddit round-trip freezes the event loop.
+# The coroutines below run them in a dedicated thread pool, with a semaphore bounding
+# the number of Reddit requests in flight at any given time.
+# Waiting requests get a slot by priority, so that queued background work never delays user commands.
+class PrioritySemaphore():
+
+	def __init__(self, value):
+		self.value = value
+		self.waiters = []
+		self.counter = 0
+
+	async def acquire(self, priority):
+		if self.value > 0 and len(self.waiters) == 0:
+			self.value = self.value - 1
+			return
+		future = asyncio.get_event_loop().create_future()
+		self.counter = self.counter + 1
+		heappush(self.waiters, (priority, self.counter, future))
+		try:
+			await future
+		except asyncio.CancelledError:
+			if future.done() and not future.cancelled():
+				# the slot was handed to us just before the cancellation, pass it on
+				self.release()
+			raise
+
+	def release(self):
+		while len(self.waiters) > 0:
+			_, _, future = heappop(self.waiters)
+			if not future.done():
+				future.set_result(None)
+				return
+		self.value = self.value + 1
+
+	def queued(self):
+		return len([w for w in self.waiters if not w[2].done()])
+
+def get_request_semaphore():
+	global REQUEST_SEMAPHORE
+	if REQUEST_SEMAPHORE is None:
+		REQUEST_SEMAPHORE = PrioritySemaphore(MAX_REQUESTS_IN_FLIGHT)
+	return REQUEST_SEMAPHORE
+
+async def run_blocking(func, *args, priority = PRIORITY_INTERACTIVE, **kwargs):
+	semaphore = get_request_semaphore()
+	await semaphore.acquire(priority)
+	try:
+		loop = asyncio.get_event_loop()
+		# the request runs with the context (e.g. the correlation ID of the command) of the coroutine
+		future = loop.run_in_executor(REQUEST_EXECUTOR, partial(contextvars.copy_context().run, func, *args, **kwargs))
+	except BaseException:
+		semaphore.release()
+		raise
+
+	# A request running in a thread can't be stopped: when the coroutine is cancelled (e.g. a hedged request that lost),
+	# the thread still runs it to the end, so the slot is only released once the thread is done
+	def done(future):
+		semaphore.release()
+		if not future.cancelled():
+			# nobody may be waiting for the result anymore
+			future.exception()
+	future.add_done_callback(done)
+	return await asyncio.shield(future)
+
+async def make_request_async(url, allow_redirects = False):
+	return await run_blocking(make_request, url, allow_redirects = allow_redirects)
+
+async def get_access_token_async():
+	return await run_blocking(get_access_token)
+
+async def get_nsfw_status_async(subreddit):
+	return await run_blocking(get_nsfw_status, subreddit)
+
+async def get_subreddits_metadata_async(subreddits, priority = PRIORITY_INTERACTIVE):
+	return await run_blocking(get_subreddits_metadata, subreddits, priority, priority = priority)
+
+async def get_random_post_from_subreddit_async(subreddit, priority = PRIORITY_INTERACTIVE, seen = None):
+	return await run_blocking(get_random_post_from_subreddit, subreddit, priority, seen, priority = priority)
+
+# Hedged fetch: requests random posts from up to fanout distinct subreddits at once, and returns the first
+# post obtained. The other requests are abandoned, not cancelled: they were already sent to Reddit, and still use
+# its quota and a request slot until they complete (their posts are dropped).
+# Subreddits recently found banned/private/quarantined/not found are skipped (unless they are all in that case).
+# Raises RequestException(6) if no post could be obtained from any of the subreddits.
+async def get_random_post_from_any_subreddit_async(subreddits, fanout):
+	candidates = [sub for sub in subreddits if not is_known_unavailable(sub)]
+	if len(candidates) == 0:
+		candidates = list(subreddits)
+	else:
+		custom_info_log('Skipping %s subreddits known to be unavailable', len(subreddits) - len(candidates))
+	shuffle(candidates)
+
+	pending = {}
+	try:
+		while len(candidates) > 0 or len(pending) > 0:
+			while len(candidates) > 0 and len(pending) < fanout:
+				sub = candidates.pop()
+				custom_info_log('Subreddit %s was chosen', sub)
+				pending[asyncio.ensure_future(get_random_post_from_subreddit_async(sub))] = sub
+
+			done, _ = await asyncio.wait(pending.keys(), return_when = asyncio.FIRST_COMPLETED)
+			for task in done:
+				sub = pending.pop(task)
+				try:
+					post = task.result()
+					if len(post.subreddit) == 0:
+						post.subreddit = sub
+					return post
+				except RequestException as e:
+					custom_info_log('Request to %s failed with code %s, trying another subreddit...', sub, e.code)
+	finally:
+		# only the requests still waiting for a slot are really cancelled
+		for task in pending.keys():
+			task.cancel()
+
+	raise RequestException(6)
+
+async def get_top_post_from_subreddit_async(subreddit, number, timespan, seen = None):
+	return await run_blocking(get_top_post_from_subreddit, subreddit, number, timespan, seen)
+
+async def sample_top_posts_from_subreddit_async(subreddit, number, timespan, k, seen = None):
+	return await run_blocking(sample_top_posts_from_subreddit, subreddit, number, timespan, k, seen)
+
+async def get_new_posts_async(subreddits, before = None, limit = 100):
+	return await run_blocking(get_new_posts, subreddits, before, limit, priority = PRIORITY_BACKGROUND)
+
 
 global ACCESS_TOKEN
 ACCESS_TOKEN = {'AT': '', 'EXPIRES': int(time())}
 load_dotenv()
+
+TOKEN_LOCK = threading.Lock()
+TOKEN_RENEWAL_TIMER = None
+TOKEN_STATS = {'refreshes': 0, 'failures': 0, 'coalesced': 0, 'renewals': 0, 'replays': 0, 'shared': 0}
+TOKEN_REFRESH_LATENCY = LatencyRecorder('token_refresh')
+TOKEN_MAX_RETRIES = int(os.getenv('REDDIT_TOKEN_MAX_RETRIES', '3'))
+TOKEN_RENEWAL_MARGIN = int(os.getenv('REDDIT_TOKEN_RENEWAL_MARGIN', '300'))
+TOKEN_EXPIRY_MARGIN = 30
+TOKEN_SHARED_WAIT = 10
+
+ACCESS_TOKEN_STAGE = METRICS.histogram('stage', stage = 'access_token')
+JSON_PARSE_STAGE = METRICS.histogram('stage', stage = 'json_parse')
+
+# Store shared by the workers of a sharded deployment for the token, subreddit and listing caches (None when running alone)
+SHARED_STORE = build_shared_store()
+
+# Base URLs can be overridden (e.g. to point the bot to a local fake Reddit server for benchmarks)
+REDDIT_WWW_URL = os.getenv('REDDIT_WWW_URL', 'https://www.reddit.com')
+REDDIT_OAUTH_URL = os.getenv('REDDIT_OAUTH_URL', 'https://oauth.reddit.com')
+
+MAX_REQUESTS_IN_FLIGHT = int(os.getenv('REDDIT_MAX_REQUESTS_IN_FLIGHT', '8'))
+REQUEST_EXECUTOR = ThreadPoolExecutor(max_workers = MAX_REQUESTS_IN_FLIGHT, thread_name_prefix = 'reddit')
+REQUEST_SEMAPHORE = None
+
+SUBREDDIT_CACHE_SIZE = int(os.getenv('SUBREDDIT_CACHE_SIZE', '4096'))
+SUBREDDIT_CACHE_TTL = int(os.getenv('SUBREDDIT_CACHE_TTL', '86400'))
+SUBREDDIT_CACHE_ERROR_TTL = int(os.getenv('SUBREDDIT_CACHE_ERROR_TTL', '900'))
+SUBREDDIT_CACHE_FILENAME = os.getenv('SUBREDDIT_CACHE_FILENAME', '')
+CACHED_ERROR_CODES = [1, 2, 3, 4]
+SUBREDDIT_INFO_CHUNK = int(os.getenv('SUBREDDIT_INFO_CHUNK', '100'))
+SUBREDDIT_NAME = re.compile('[A-Za-z0-9_]{2,21}')
+METADATA_STATS = {'lookups': 0, 'info_requests': 0, 'about_requests': 0}
+SUBREDDIT_CACHE = TTLCache('subreddits', SUBREDDIT_CACHE_SIZE, SUBREDDIT_CACHE_TTL)
+if SHARED_STORE is not None:
+	SUBREDDIT_CACHE.share(SHARED_STORE, 'subreddits')
+
+TIMESPAN_ALIASES = {'hours': 'hour', 'now': 'hour', 'days': 'day', 'today': 'day', 'weeks': 'week', 'months': 'month', 'years': 'year'}
+LISTING_CACHE_TTLS = {'hour': 120, 'day': 900, 'week': 3600, 'month': 3 * 3600, 'year': 12 * 3600, 'all': 24 * 3600}
+LISTING_CACHE_SIZE = int(os.getenv('LISTING_CACHE_SIZE', '1024'))
+LISTING_CACHE_MAX_BYTES = int(os.getenv('LISTING_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+LISTING_CACHE = MemoryBoundedTTLCache('listings', LISTING_CACHE_SIZE, LISTING_CACHE_TTLS['all'], LISTING_CACHE_MAX_BYTES)
+if SHARED_STORE is not None:
+	LISTING_CACHE.share(SHARED_STORE, 'listings', encode_posts, decode_posts)
+
+GOVERNOR = RateLimitGovernor(rate = float(os.getenv('REDDIT_RATE_LIMIT_RATE', '1')),
+	burst = int(os.getenv('REDDIT_RATE_LIMIT_BURST', '600')),
+	background_reserve = int(os.getenv('REDDIT_BACKGROUND_RESERVE', '100')),
+	max_wait = float(os.getenv('REDDIT_MAX_QUEUE_WAIT', '10')))
+MAX_RETRIES = int(os.getenv('REDDIT_MAX_RETRIES', '2'))
+RETRY_BASE_DELAY = 1
+
+SINGLE_FLIGHT = SingleFlight()
+RANDOM_LOCK = threading.Lock()
+RANDOM_IN_FLIGHT = set()
+RANDOM_RECENTLY_SERVED = {}
+RANDOM_STATS = {'requests': 0, 'shared': 0, 'seen': 0}
+RANDOM_SHARED_LISTING_SIZE = 100
+
+REQUEST_TIMEOUT = (float(os.getenv('REDDIT_CONNECT_TIMEOUT', '5')), float(os.getenv('REDDIT_READ_TIMEOUT', '15')))
+POOL_SIZE = int(os.getenv('REDDIT_POOL_SIZE', str(MAX_REQUESTS_IN_FLIGHT)))
+KEEP_ALIVE = os.getenv('REDDIT_KEEP_ALIVE', 'true').lower() != 'false'
+WWW_SESSION = build_session({'User-Agent' : os.getenv('REDDIT_USER_AGENT')})
+OAUTH_SESSION = build_session({'User-Agent' : os.getenv('REDDIT_USER_AGENT')})
@@ -0,0 +1,151 @@
+# Reddiator bot module file
+# Module name: utils-reservoir
+# Version: 1.0
+
+# Description: This module keeps small reservoirs of pre-fetched random posts for the most requested subreddits and categories
+
+import os, logging, asyncio
+
+from collections import deque
+
+from time import time
+
+from utils.reddit import RequestException, PRIORITY_BACKGROUND, get_random_post_from_subreddit_async
+from utils.logs import get_logger, INFO
+
+
+LOGGER = get_logger('utils.reservoir')
+
+def custom_info_log(msg, *args):
+	LOGGER.log(INFO, '\t' + msg, *args)
+
+
+# Commands pop posts from the reservoirs instantly, and fall back to a live request when the reservoir is empty.
+# A background task refills the reservoirs of the keys (subreddits or categories) that were requested at least
+# hot_threshold times, and forgets the keys that have not been requested for cold_after seconds.
+# Entries are Post records, keys are ('sub', name) or ('cat', name).
+class PostReservoir():
+
+	def __init__(self, pick, size = 5, refill_interval = 10, refill_rate = 10, hot_threshold = 3, cold_after = 1800, max_keys = 100):
+		# pick is a function drawing subreddits of a category (see utils.health): the posts of a category reservoir
+		# can be served in any channel, so they are only drawn from its live SFW subreddits
+		self.pick = pick
+		self.size = size
+		self.refill_interval = refill_interval
+		self.refill_rate = refill_rate
+		self.hot_threshold = hot_threshold
+		self.cold_after = cold_after
+		self.max_keys = max_keys
+		self.reservoirs = {}
+		self.demand = {}
+		self.last_requested = {}
+		self.hits = 0
+		self.misses = 0
+		self.task = None
+
+	def pop(self, kind, name):
+		key = (kind, name.lower())
+		self.demand[key] = self.demand.get(key, 0) + 1
+		self.last_requested[key] = time()
+
+		reservoir = self.reservoirs.get(key)
+		if reservoir:
+			self.hits = self.hits + 1
+			custom_info_log('Serving a pre-fetched post for %s %s (%s left)', kind, name, len(reservoir) - 1)
+			return reservoir.popleft()
+
+		self.misses = self.misses + 1
+		return None
+
+	def pop_subreddit(self, subreddit):
+		return self.pop('sub', subreddit)
+
+	def pop_category(self, category):
+		return self.pop('cat', category)
+
+	def hot_keys(self):
+		hot = [key for key, count in self.demand.items() if count >= self.hot_threshold]
+		hot.sort(key = lambda key: self.demand[key], reverse = True)
+		return hot[:self.max_keys]
+
+	def evict_cold_keys(self):
+		now = time()
+		for key in [key for key, last in self.last_requested.items() if now - last > self.cold_after]:
+			custom_info_log('Evicting cold reservoir for %s %s', key[0], key[1])
+			self.reservoirs.pop(key, None)
+			self.demand.pop(key, None)
+			self.last_requested.pop(key, None)
+
+	async def fetch(self, key):
+		kind, name = key
+		if kind == 'sub':
+			subreddit = name
+		else:
+			subreddits = self.pick(name)
+			if len(subreddits) == 0:
+				return None
+			subreddit = subreddits[0]
+
+		try:
+			post = await get_random_post_from_subreddit_async(subreddit, PRIORITY_BACKGROUND)
+		except RequestException as e:
+			custom_info_log('Failed to pre-fetch a post from %s for %s %s (code %s)', subreddit, kind, name, e.code)
+			return None
+		if len(post.subreddit) == 0:
+			post.subreddit = subreddit
+		return post
+
+	# One request at a time per key: concurrent /random requests for the same subreddit would be collapsed into
+	# draws from its top listing (see utils.reddit.get_random_post_from_subreddit), filling the reservoir with top posts
+	async def fill(self, key, count):
+		for _ in range(count):
+			entry = await self.fetch(key)
+			reservoir = self.reservoirs.get(key)
+			if entry is None or reservoir is None or len(reservoir) >= self.size:
+				return
+			reservoir.append(entry)
+
+	async def refill(self):
+		self.evict_cold_keys()
+
+		# at most refill_rate posts per round, the keys being refilled concurrently
+		budget = self.refill_rate
+		to_fill = []
+		for key in self.hot_keys():
+			reservoir = self.reservoirs.setdefault(key, deque())
+			count = min(self.size - len(reservoir), budget)
+			if count > 0:
+				to_fill.append((key, count))
+				budget = budget - count
+
+		if len(to_fill) > 0:
+			custom_info_log('Refilling %s reservoirs with %s posts', len(to_fill), self.refill_rate - budget)
+			await asyncio.gather(*[self.fill(key, count) for key, count in to_fill])
+
+	async def run(self):
+		while True:
+			try:
+				await self.refill()
+			except Exception:
+				logging.exception('Unexpected error while refilling the post reservoirs')
+			await asyncio.sleep(self.refill_interval)
+
+	def start(self):
+		if self.task is None:
+			self.task = asyncio.ensure_future(self.run())
+		return self.task
+
+	def stats(self):
+		served = self.hits + self.misses
+		return {'keys': len(self.reservoirs), 'posts': sum([len(r) for r in self.reservoirs.values()]),
+			'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / served if served > 0 else 0.0}
+
+
+def build_reservoir(pick):
+	return PostReservoir(pick,
+		size = int(os.getenv('RESERVOIR_SIZE', '5')),
+		refill_interval = float(os.getenv('RESERVOIR_REFILL_INTERVAL', '10')),
+		refill_rate = int(os.getenv('RESERVOIR_REFILL_RATE', '10')),
+		hot_threshold = int(os.getenv('RESERVOIR_HOT_THRESHOLD', '3')),
+		cold_after = int(os.getenv('RESERVOIR_COLD_AFTER', '1800')),
+		max_keys = int(os.getenv('RESERVOIR_MAX_KEYS', '100')))
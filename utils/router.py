@@ -0,0 +1,114 @@
+# Reddiator bot module file
+# Module name: utils-router
+# Version: 1.0
+
+# Description: This module maps the bot commands to their handlers, and parses their arguments
+
+PREFIX = 'r! '
+DURATION_UNITS = {'m': 60, 'h': 3600, 'd': 86400}
+
+
+# Cheap check run on every message the bot can see: most of them are not for us, so nothing is allocated here
+def is_command(content):
+	return content.startswith(PREFIX)
+
+
+class CommandError(Exception):
+
+	def __init__(self, command = None, reason = ''):
+		super().__init__(reason)
+		self.command = command
+		self.reason = reason
+
+
+# Optional argument of a command. kind is one of:
+# 'int' (digits, capped to maximum), 'choice' (one of choices, optionally case insensitive), 'string' (anything),
+# 'duration' (e.g. 30m, 6h, 1d, parsed in seconds) or 'time' (HH:MM, parsed in seconds since midnight)
+class Argument():
+
+	def __init__(self, name, kind, choices = (), maximum = None, ignore_case = False):
+		self.name = name
+		self.kind = kind
+		self.choices = frozenset(choices)
+		self.maximum = maximum
+		self.ignore_case = ignore_case
+
+	# Returns the parsed value, or None if the chunk is not a valid value for this argument
+	def parse(self, chunk):
+		if self.kind == 'int':
+			if not chunk.isdigit():
+				return None
+			value = int(chunk)
+			return min(value, self.maximum) if self.maximum is not None else value
+		elif self.kind == 'choice':
+			if self.ignore_case:
+				chunk = chunk.lower()
+			return chunk if chunk in self.choices else None
+		elif self.kind == 'duration':
+			if len(chunk) < 2 or not chunk[:-1].isdigit() or chunk[-1].lower() not in DURATION_UNITS:
+				return None
+			return int(chunk[:-1]) * DURATION_UNITS[chunk[-1].lower()]
+		elif self.kind == 'time':
+			hours, _, minutes = chunk.partition(':')
+			if not hours.isdigit() or not minutes.isdigit() or int(hours) > 23 or int(minutes) > 59:
+				return None
+			return int(hours) * 3600 + int(minutes) * 60
+		return chunk
+
+
+# A command has a handler (coroutine called with the message and the parsed arguments), an optional
+# required first argument (e.g. the subreddit), and optional arguments which must be given in order
+# but can each be omitted (e.g. [N] [period] [type]).
+# Without its required argument, the command answers with the help menu help_type.
+class Command():
+
+	def __init__(self, name, handler, aliases = (), required = None, optional = (), help_type = 'general'):
+		self.name = name
+		self.handler = handler
+		self.aliases = aliases
+		self.required = required
+		self.optional = optional
+		self.help_type = help_type
+
+	def parse(self, chunks):
+		kwargs = {}
+		if self.required is not None:
+			if len(chunks) == 0:
+				return None
+			kwargs[self.required] = chunks[0]
+			chunks = chunks[1:]
+
+		position = 0
+		for chunk in chunks:
+			while position < len(self.optional):
+				argument = self.optional[position]
+				position = position + 1
+				value = argument.parse(chunk)
+				if value is not None:
+					kwargs[argument.name] = value
+					break
+			else:
+				raise CommandError(self, f'unexpected argument {chunk}')
+		return kwargs
+
+
+class Router():
+
+	def __init__(self):
+		self.commands = {}
+
+	def register(self, command):
+		for name in (command.name,) + tuple(command.aliases):
+			self.commands[name] = command
+		return command
+
+	# Returns the command and its parsed arguments (None if the help menu of the command must be displayed instead).
+	# Raises CommandError if the command does not exist or its arguments are not valid.
+	def parse(self, content):
+		chunks = content.split(' ')
+		if len(chunks) < 2:
+			raise CommandError(None, 'no command')
+		command = self.commands.get(chunks[1].lower())
+		if command is None:
+			raise CommandError(None, f'unknown command {chunks[1]}')
+		return command, command.parse(chunks[2:])
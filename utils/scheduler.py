@@ -0,0 +1,257 @@
+# Reddiator bot module file
+# Module name: utils-scheduler
+# Version: 1.0
+
+# Description: This module runs the subscriptions of the channels, which get posts from a subreddit or a category on a schedule
+
+import heapq, logging, os, sqlite3, threading, asyncio
+
+from time import time
+
+from utils.logs import get_logger, INFO
+
+
+LOGGER = get_logger('utils.scheduler')
+
+def custom_info_log(msg, *args):
+	LOGGER.log(INFO, '\t' + msg, *args)
+
+
+# source is 'sub' or 'cat', listing is 'top' or 'rand' (timespan is only used by top).
+# A subscription runs at next_run, then every interval seconds.
+class Subscription():
+	__slots__ = ('id', 'channel_id', 'source', 'target', 'listing', 'timespan', 'interval', 'next_run')
+
+	def __init__(self, id, channel_id, source, target, listing, timespan, interval, next_run):
+		self.id = id
+		self.channel_id = channel_id
+		self.source = source
+		self.target = target
+		self.listing = listing
+		self.timespan = timespan
+		self.interval = interval
+		self.next_run = next_run
+
+	# Subscriptions running at the same time with the same key are served by a single fetch
+	def key(self):
+		return (self.source, self.target.lower(), self.listing, self.timespan)
+
+	def describe(self):
+		what = f'top of {self.timespan}' if self.listing == 'top' else 'random'
+		where = f'r/{self.target}' if self.source == 'sub' else f'category {self.target}'
+		return f'#{self.id}: {what} post from {where} every {format_duration(self.interval)}'
+
+	# First run after now, skipping the runs that were missed (e.g. while the bot was stopped)
+	def advance(self, now):
+		if self.next_run <= now:
+			self.next_run = self.next_run + ((now - self.next_run) // self.interval + 1) * self.interval
+
+
+def format_duration(seconds):
+	for unit, length in [('d', 86400), ('h', 3600), ('m', 60)]:
+		if seconds % length == 0:
+			return f'{seconds // length}{unit}'
+	return f'{seconds}s'
+
+
+# Subscriptions are persisted in SQLite (same setup as utils.shared_store: WAL, one connection per thread),
+# so that adding, removing or rescheduling one of tens of thousands of subscriptions doesn't rewrite them all.
+# The subreddits watched by the channels for new posts (see utils.watcher) are stored in the same file.
+class SubscriptionStore():
+
+	def __init__(self, filename, timeout = 5):
+		self.filename = filename
+		self.timeout = timeout
+		self.local = threading.local()
+		self.connection().execute("""CREATE TABLE IF NOT EXISTS subscriptions (id INTEGER PRIMARY KEY AUTOINCREMENT, channel_id INTEGER,
+			source TEXT, target TEXT, listing TEXT, timespan TEXT, interval INTEGER, next_run REAL)""")
+		self.connection().execute('CREATE TABLE IF NOT EXISTS watches (channel_id INTEGER, subreddit TEXT, PRIMARY KEY (channel_id, subreddit))')
+
+	def connection(self):
+		connection = getattr(self.local, 'connection', None)
+		if connection is None:
+			connection = sqlite3.connect(self.filename, timeout = self.timeout, isolation_level = None)
+			connection.execute('PRAGMA journal_mode=WAL')
+			connection.execute('PRAGMA synchronous=NORMAL')
+			self.local.connection = connection
+		return connection
+
+	def load(self):
+		rows = self.connection().execute('SELECT id, channel_id, source, target, listing, timespan, interval, next_run FROM subscriptions').fetchall()
+		return [Subscription(*row) for row in rows]
+
+	# Returns the id of the new subscription
+	def add(self, subscription):
+		return self.connection().execute('INSERT INTO subscriptions (channel_id, source, target, listing, timespan, interval, next_run) VALUES (?, ?, ?, ?, ?, ?, ?)',
+			(subscription.channel_id, subscription.source, subscription.target, subscription.listing, subscription.timespan, subscription.interval, subscription.next_run)).lastrowid
+
+	def delete(self, id):
+		self.connection().execute('DELETE FROM subscriptions WHERE id = ?', (id, ))
+
+	# The next runs of all the subscriptions fired together are saved in a single transaction
+	def reschedule(self, subscriptions):
+		connection = self.connection()
+		with connection:
+			connection.execute('BEGIN')
+			connection.executemany('UPDATE subscriptions SET next_run = ? WHERE id = ?', [(s.next_run, s.id) for s in subscriptions])
+
+	# Returns [(channel_id, subreddit)]
+	def load_watches(self):
+		return self.connection().execute('SELECT channel_id, subreddit FROM watches').fetchall()
+
+	def add_watch(self, channel_id, subreddit):
+		self.connection().execute('INSERT OR IGNORE INTO watches (channel_id, subreddit) VALUES (?, ?)', (channel_id, subreddit))
+
+	def delete_watch(self, channel_id, subreddit):
+		self.connection().execute('DELETE FROM watches WHERE channel_id = ? AND subreddit = ?', (channel_id, subreddit))
+
+
+# The subscriptions wait in a heap ordered by next run (removed or rescheduled ones are skipped when popped).
+# The due subscriptions are grouped by key and each group calls fetch(key, subscriptions) once, which returns
+# [(subscription, post)]. The posts are then delivered one by one, at most delivery_rate per second, by deliver(subscription, post).
+# Runs missed by more than max_late seconds (e.g. while the bot was stopped) are skipped rather than caught up,
+# and a subscription late by less than that runs once, however many runs it missed.
+class Scheduler():
+
+	def __init__(self, store, fetch, deliver, delivery_rate = 5, max_late = 600, max_per_channel = 10, min_interval = 600):
+		self.store = store
+		self.fetch = fetch
+		self.deliver = deliver
+		self.delivery_rate = delivery_rate
+		self.max_late = max_late
+		self.max_per_channel = max_per_channel
+		self.min_interval = min_interval
+		self.subscriptions = {}
+		self.heap = []
+		self.deliveries = None
+		self.wakeup = None
+		self.tasks = []
+		self.stats_counts = {'runs': 0, 'groups': 0, 'delivered': 0, 'missed': 0, 'failed': 0}
+
+	def load(self):
+		for subscription in self.store.load():
+			self.schedule(subscription)
+		custom_info_log('Loaded %s subscriptions from %s', len(self.subscriptions), self.store.filename)
+
+	def schedule(self, subscription):
+		self.subscriptions[subscription.id] = subscription
+		heapq.heappush(self.heap, (subscription.next_run, subscription.id))
+		if self.wakeup is not None:
+			self.wakeup.set()
+
+	def channel_subscriptions(self, channel_id):
+		return sorted([s for s in self.subscriptions.values() if s.channel_id == channel_id], key = lambda s: s.id)
+
+	# at (seconds since midnight UTC) makes a subscription start at the next such time, otherwise it starts after one interval
+	def subscribe(self, channel_id, source, target, listing, timespan, interval, at = None):
+		now = time()
+		interval = max(interval, self.min_interval)
+		if at is not None:
+			next_run = now - now % 86400 + at
+			if next_run <= now:
+				next_run = next_run + 86400
+		else:
+			next_run = now + interval
+		subscription = Subscription(None, channel_id, source, target, listing, timespan, interval, next_run)
+		subscription.id = self.store.add(subscription)
+		self.schedule(subscription)
+		custom_info_log('Channel %s subscribed to %s', channel_id, subscription.describe())
+		return subscription
+
+	# Returns False if the channel has no such subscription
+	def unsubscribe(self, channel_id, id):
+		subscription = self.subscriptions.get(id)
+		if subscription is None or subscription.channel_id != channel_id:
+			return False
+		del self.subscriptions[id]
+		self.store.delete(id)
+		custom_info_log('Channel %s unsubscribed from %s', channel_id, subscription.describe())
+		return True
+
+	def pop_due(self, now):
+		due = []
+		while len(self.heap) > 0 and self.heap[0][0] <= now:
+			next_run, id = heapq.heappop(self.heap)
+			subscription = self.subscriptions.get(id)
+			if subscription is not None and subscription.next_run == next_run:
+				due.append(subscription)
+		return due
+
+	async def run_due(self, now):
+		due = self.pop_due(now)
+		if len(due) == 0:
+			return
+		groups = {}
+		for subscription in due:
+			if now - subscription.next_run > self.max_late:
+				self.stats_counts['missed'] = self.stats_counts['missed'] + 1
+			else:
+				groups.setdefault(subscription.key(), []).append(subscription)
+			subscription.advance(now)
+			heapq.heappush(self.heap, (subscription.next_run, subscription.id))
+		await asyncio.get_event_loop().run_in_executor(None, self.store.reschedule, due)
+
+		custom_info_log('Running %s subscriptions in %s groups', sum([len(group) for group in groups.values()]), len(groups))
+		self.stats_counts['runs'] = self.stats_counts['runs'] + len(due)
+		self.stats_counts['groups'] = self.stats_counts['groups'] + len(groups)
+		for key, subscriptions in groups.items():
+			asyncio.ensure_future(self.run_group(key, subscriptions))
+
+	async def run_group(self, key, subscriptions):
+		try:
+			results = await self.fetch(key, subscriptions)
+		except Exception:
+			self.stats_counts['failed'] = self.stats_counts['failed'] + len(subscriptions)
+			logging.exception('Error fetching the posts of %s subscriptions to %s', len(subscriptions), key)
+			return
+		self.stats_counts['failed'] = self.stats_counts['failed'] + len(subscriptions) - len(results)
+		for result in results:
+			self.deliveries.put_nowait(result)
+
+	async def run_timer(self):
+		while True:
+			try:
+				await self.run_due(time())
+			except Exception:
+				logging.exception('Unexpected error while running the subscriptions')
+			self.wakeup.clear()
+			delay = self.heap[0][0] - time() if len(self.heap) > 0 else 3600
+			try:
+				await asyncio.wait_for(self.wakeup.wait(), timeout = min(max(delay, 0), 3600))
+			except asyncio.TimeoutError:
+				pass
+
+	# Deliveries are spread out: a group of subscriptions firing together doesn't turn into a burst of messages
+	async def run_deliveries(self):
+		while True:
+			subscription, post = await self.deliveries.get()
+			if subscription.id in self.subscriptions:
+				try:
+					await self.deliver(subscription, post)
+					self.stats_counts['delivered'] = self.stats_counts['delivered'] + 1
+				except Exception:
+					self.stats_counts['failed'] = self.stats_counts['failed'] + 1
+					logging.exception('Error delivering a post for subscription %s', subscription.id)
+			await asyncio.sleep(1 / self.delivery_rate)
+
+	def start(self):
+		if len(self.tasks) == 0:
+			self.wakeup = asyncio.Event()
+			self.deliveries = asyncio.Queue()
+			self.tasks = [asyncio.ensure_future(self.run_timer()), asyncio.ensure_future(self.run_deliveries())]
+		return self.tasks
+
+	def stats(self):
+		return dict(self.stats_counts, subscriptions = len(self.subscriptions), queued = self.deliveries.qsize() if self.deliveries is not None else 0)
+
+
+# The subscriptions are only enabled when SUBSCRIPTIONS_FILENAME is set
+def build_scheduler(fetch, deliver):
+	filename = os.getenv('SUBSCRIPTIONS_FILENAME', '')
+	if len(filename) == 0:
+		return None
+	return Scheduler(SubscriptionStore(filename), fetch, deliver,
+		delivery_rate = float(os.getenv('SUBSCRIPTIONS_DELIVERY_RATE', '5')),
+		max_late = int(os.getenv('SUBSCRIPTIONS_MAX_LATE', '600')),
+		max_per_channel = int(os.getenv('SUBSCRIPTIONS_PER_CHANNEL', '10')),
+		min_interval = int(os.getenv('SUBSCRIPTIONS_MIN_INTERVAL', '600')))
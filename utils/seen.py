@@ -0,0 +1,143 @@
+# Reddiator bot module file
+# Module name: utils-seen
+# Version: 1.0
+
+# Description: This module remembers which posts were already shown in each channel, to avoid showing them again
+
+import atexit, base64, hashlib, json, logging, math, os, threading
+
+from collections import OrderedDict
+
+from utils.logs import get_logger, INFO
+
+
+LOGGER = get_logger('utils.seen')
+
+def custom_info_log(msg, *args):
+	LOGGER.log(INFO, '\t' + msg, *args)
+
+
+# Bloom filter sized for capacity keys with the given false positive rate.
+# A false positive only means that a post is wrongly considered as already shown, which is harmless.
+class BloomFilter():
+
+	def __init__(self, capacity, error_rate, bits = None, count = 0):
+		self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+		self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+		self.bits = bits if bits is not None else bytearray((self.size + 7) // 8)
+		self.count = count
+
+	# Double hashing: the k positions are derived from the two halves of a single digest
+	def positions(self, key):
+		digest = hashlib.blake2b(key.encode(), digest_size = 16).digest()
+		h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+		return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+	def add(self, key):
+		for position in self.positions(key):
+			self.bits[position >> 3] |= 1 << (position & 7)
+		self.count = self.count + 1
+
+	def __contains__(self, key):
+		return all([self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key)])
+
+
+# Two generations of Bloom filters per channel: when the current one is full, it becomes the previous one
+# and the oldest is dropped. A channel remembers between capacity and 2 * capacity posts, in a fixed amount of memory.
+# The least recently active channels are forgotten beyond max_channels.
+class SeenPosts():
+
+	def __init__(self, capacity = 1000, error_rate = 0.01, max_channels = 10000):
+		self.capacity = capacity
+		self.error_rate = error_rate
+		self.max_channels = max_channels
+		self.channels = OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.rotations = 0
+		self.filename = None
+
+	def seen(self, channel, permalink):
+		with self.lock:
+			generations = self.channels.get(channel)
+			if generations is None:
+				return False
+			found = any([permalink in generation for generation in generations])
+		if found:
+			self.hits = self.hits + 1
+		return found
+
+	def add(self, channel, permalink):
+		with self.lock:
+			generations = self.channels.get(channel)
+			if generations is None:
+				generations = [BloomFilter(self.capacity, self.error_rate)]
+				self.channels[channel] = generations
+				while len(self.channels) > self.max_channels:
+					self.channels.popitem(last = False)
+			self.channels.move_to_end(channel)
+			if generations[0].count >= self.capacity:
+				generations.insert(0, BloomFilter(self.capacity, self.error_rate))
+				del generations[2:]
+				self.rotations = self.rotations + 1
+			generations[0].add(permalink)
+
+	# Returns a predicate telling whether a post was shown in the channel, for the sampling functions of utils.reddit
+	def predicate(self, channel):
+		return lambda post: self.seen(channel, post.permalink)
+
+	def stats(self):
+		with self.lock:
+			filters = sum([len(generations) for generations in self.channels.values()])
+		return {'channels': len(self.channels), 'bytes': filters * ((BloomFilter(self.capacity, self.error_rate).size + 7) // 8),
+			'hits': self.hits, 'rotations': self.rotations}
+
+	# Same as the caches, the snapshot is written next to the destination and renamed
+	def save(self, filename):
+		with self.lock:
+			channels = [[channel, [[base64.b64encode(bytes(generation.bits)).decode(), generation.count] for generation in generations]]
+				for channel, generations in self.channels.items()]
+		tmp_filename = filename + '.tmp'
+		with open(tmp_filename, 'w') as f:
+			json.dump({'capacity': self.capacity, 'error_rate': self.error_rate, 'channels': channels}, f)
+		os.replace(tmp_filename, filename)
+		custom_info_log('Saved the seen posts of %s channels to %s', len(channels), filename)
+
+	# Reloads the snapshot of the file given to build_seen_posts, if any, and saves it back at exit
+	def restore(self):
+		if self.filename is not None:
+			self.load(self.filename)
+			atexit.register(self.save, self.filename)
+
+	def load(self, filename):
+		try:
+			with open(filename, 'r') as f:
+				snapshot = json.load(f)
+		except FileNotFoundError:
+			custom_info_log('No seen posts found in %s, starting from scratch', filename)
+			return 0
+		except ValueError:
+			logging.warning('Seen posts file %s is corrupted, ignoring it', filename)
+			return 0
+
+		if snapshot['capacity'] != self.capacity or snapshot['error_rate'] != self.error_rate:
+			# the filters can't be resized, the posts shown so far are forgotten
+			logging.warning('Seen posts in %s were saved with other settings, ignoring them', filename)
+			return 0
+
+		with self.lock:
+			for channel, generations in snapshot['channels']:
+				self.channels[channel] = [BloomFilter(self.capacity, self.error_rate, bytearray(base64.b64decode(bits)), count) for bits, count in generations]
+		custom_info_log('Loaded the seen posts of %s channels from %s', len(snapshot["channels"]), filename)
+		return len(snapshot['channels'])
+
+
+def build_seen_posts():
+	seen_posts = SeenPosts(capacity = int(os.getenv('SEEN_POSTS_CAPACITY', '1000')),
+		error_rate = float(os.getenv('SEEN_POSTS_ERROR_RATE', '0.01')),
+		max_channels = int(os.getenv('SEEN_POSTS_MAX_CHANNELS', '10000')))
+	filename = os.getenv('SEEN_POSTS_FILENAME', '')
+	if len(filename) > 0:
+		# loaded by restore(), during the warm-up of the bot
+		seen_posts.filename = filename
+	return seen_posts
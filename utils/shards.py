@@ -0,0 +1,141 @@
+# Reddiator bot module file
+# Module name: utils-shards
+# Version: 1.0
+
+# Description: This module runs the bot as several worker processes, each one connected to a range of Discord shards
+
+import os, logging, signal, subprocess
+
+from time import time, sleep
+
+from utils.logs import get_logger, INFO
+
+
+LOGGER = get_logger('utils.shards')
+
+def custom_info_log(msg, *args):
+	LOGGER.log(INFO, '\t' + msg, *args)
+
+
+# Splits the shards in contiguous ranges, one per worker process
+def shard_ranges(shard_count, workers):
+	workers = max(1, min(workers, shard_count))
+	return [list(range(index * shard_count // workers, (index + 1) * shard_count // workers)) for index in range(workers)]
+
+# Shards served by this process, set by the supervisor in the environment of its workers.
+# Returns (None, None) when the bot runs alone (a single unsharded connection).
+def get_worker_shards():
+	shard_ids = os.getenv('REDDIATOR_SHARD_IDS', '')
+	if len(shard_ids) == 0:
+		return None, None
+	return [int(shard_id) for shard_id in shard_ids.split(',')], int(os.getenv('REDDIATOR_SHARD_COUNT'))
+
+
+class Worker():
+
+	def __init__(self, index, shard_ids):
+		self.index = index
+		self.shard_ids = shard_ids
+		self.process = None
+		self.started = 0
+		self.restarts = 0
+
+
+# The supervisor launches one worker process per shard range and restarts the workers that exit, or that stop
+# reporting their health in the shared store (a worker stuck on a dead gateway connection is killed and restarted).
+# Restarts are delayed with an exponential backoff, so that a worker failing at startup doesn't spin.
+class Supervisor():
+
+	def __init__(self, command, shard_count, workers, store, logfilename, health_interval = 30, stale_after = 120):
+		self.command = command
+		self.shard_count = shard_count
+		self.workers = [Worker(index, shard_ids) for index, shard_ids in enumerate(shard_ranges(shard_count, workers))]
+		self.store = store
+		self.logfilename = logfilename
+		self.health_interval = health_interval
+		self.stale_after = stale_after
+		self.running = False
+
+	def start_worker(self, worker):
+		env = dict(os.environ)
+		env['REDDIATOR_SHARD_IDS'] = ','.join([str(shard_id) for shard_id in worker.shard_ids])
+		env['REDDIATOR_SHARD_COUNT'] = str(self.shard_count)
+		env['SHARED_STORE_FILENAME'] = self.store.filename
+		worker.process = subprocess.Popen(self.command + ['-f', f'{self.logfilename}.worker{worker.index}'], env = env)
+		worker.started = time()
+		custom_info_log('Started worker %s (pid = %s) for shards %s', worker.index, worker.process.pid, worker.shard_ids)
+
+	def stop_worker(self, worker, timeout = 10):
+		if worker.process is None or worker.process.poll() is not None:
+			return
+		worker.process.terminate()
+		try:
+			worker.process.wait(timeout)
+		except subprocess.TimeoutExpired:
+			logging.warning('Worker %s did not stop in %s s, killing it', worker.index, timeout)
+			worker.process.kill()
+			worker.process.wait()
+
+	def restart_worker(self, worker, reason):
+		delay = min(2 ** worker.restarts, 300)
+		logging.warning('Restarting worker %s for shards %s in %s s: %s', worker.index, worker.shard_ids, delay, reason)
+		self.stop_worker(worker)
+		sleep(delay)
+		worker.restarts = worker.restarts + 1
+		self.start_worker(worker)
+
+	# Health of each shard as reported by its worker, and whether it's too old
+	def check_health(self):
+		health = self.store.get_health()
+		for worker in self.workers:
+			code = worker.process.poll()
+			if code is not None:
+				self.restart_worker(worker, f'exited with code {code}')
+				continue
+
+			ages = []
+			for shard_id in worker.shard_ids:
+				status, age = health.get(shard_id, ({}, None))
+				if age is not None and status.get('pid') == worker.process.pid:
+					ages.append(age)
+					custom_info_log('Shard %s (worker %s): %s (reported %.0f s ago)', shard_id, worker.index, status, age)
+				else:
+					custom_info_log('Shard %s (worker %s): no report yet', shard_id, worker.index)
+
+			# a worker gets stale_after seconds to connect and send its first report
+			last_report = min(ages) if len(ages) > 0 else time() - worker.started
+			if last_report > self.stale_after:
+				self.restart_worker(worker, f'no health report for {last_report:.0f} s')
+			elif worker.restarts > 0 and time() - worker.started > self.stale_after:
+				# the worker has been healthy for a while, back to the shortest restart delay
+				worker.restarts = 0
+		self.store.purge_expired()
+
+	def stop(self, *args):
+		self.running = False
+
+	def run(self):
+		custom_info_log('Supervising %s workers for %s shards', len(self.workers), self.shard_count)
+		signal.signal(signal.SIGTERM, self.stop)
+		signal.signal(signal.SIGINT, self.stop)
+		self.running = True
+		for worker in self.workers:
+			self.start_worker(worker)
+		try:
+			while self.running:
+				for _ in range(self.health_interval):
+					if not self.running:
+						break
+					sleep(1)
+				if self.running:
+					self.check_health()
+		finally:
+			custom_info_log('Stopping the workers')
+			for worker in self.workers:
+				self.stop_worker(worker)
+
+
+def build_supervisor(command, shard_count, workers, store, logfilename):
+	return Supervisor(command, shard_count, workers, store, logfilename,
+		health_interval = int(os.getenv('SHARD_HEALTH_INTERVAL', '30')),
+		stale_after = int(os.getenv('SHARD_STALE_AFTER', '120')))
@@ -0,0 +1,111 @@
+# Reddiator bot module file
+# Module name: utils-shared_store
+# Version: 1.0
+
+# Description: This module provides the local store (SQLite in WAL mode) shared by the worker processes of a sharded deployment
+
+import json, logging, os, sqlite3, threading
+
+from time import time
+
+from utils.logs import get_logger, INFO
+
+
+LOGGER = get_logger('utils.shared_store')
+
+def custom_info_log(msg, *args):
+	LOGGER.log(INFO, '\t' + msg, *args)
+
+
+# Key/value entries with an absolute expiry time, grouped by namespace (e.g. 'token', 'subreddits', 'listings'),
+# plus the short-lived locks used to make sure a single process refreshes a shared value, and the health of the shards.
+# In WAL mode readers never block the writer, so every process can read the store while another one writes to it.
+# SQLite connections can't be shared between threads: each thread (event loop, request threads) opens its own.
+class SharedStore():
+
+	def __init__(self, filename, timeout = 5):
+		self.filename = filename
+		self.timeout = timeout
+		self.local = threading.local()
+		self.owner = f'{os.getpid()}'
+		self.hits = 0
+		self.misses = 0
+		self.writes = 0
+		self.errors = 0
+		self.connection().executescript("""
+			CREATE TABLE IF NOT EXISTS entries (namespace TEXT, key TEXT, value TEXT, expires REAL, PRIMARY KEY (namespace, key));
+			CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, owner TEXT, expires REAL);
+			CREATE TABLE IF NOT EXISTS shards (shard_id INTEGER PRIMARY KEY, status TEXT, updated REAL);
+		""")
+
+	def connection(self):
+		connection = getattr(self.local, 'connection', None)
+		if connection is None:
+			# autocommit mode: each statement is its own (short) transaction
+			connection = sqlite3.connect(self.filename, timeout = self.timeout, isolation_level = None)
+			connection.execute('PRAGMA journal_mode=WAL')
+			connection.execute('PRAGMA synchronous=NORMAL')
+			self.local.connection = connection
+		return connection
+
+	# The store is an optimization: failures are logged and the callers behave as on a cache miss
+	def execute(self, query, parameters = ()):
+		try:
+			return self.connection().execute(query, parameters).fetchall()
+		except sqlite3.Error as e:
+			self.errors = self.errors + 1
+			logging.warning('Shared store %s query failed: %s', self.filename, e)
+			return None
+
+	# Returns (value, expires) or None if the entry doesn't exist or is expired
+	def get(self, namespace, key):
+		rows = self.execute('SELECT value, expires FROM entries WHERE namespace = ? AND key = ? AND expires > ?', (namespace, key, time()))
+		if not rows:
+			self.misses = self.misses + 1
+			return None
+		self.hits = self.hits + 1
+		return json.loads(rows[0][0]), rows[0][1]
+
+	def set(self, namespace, key, value, ttl):
+		self.writes = self.writes + 1
+		self.execute('INSERT OR REPLACE INTO entries (namespace, key, value, expires) VALUES (?, ?, ?, ?)', (namespace, key, json.dumps(value), time() + ttl))
+
+	def delete(self, namespace, key):
+		self.execute('DELETE FROM entries WHERE namespace = ? AND key = ?', (namespace, key))
+
+	def purge_expired(self):
+		now = time()
+		self.execute('DELETE FROM entries WHERE expires <= ?', (now, ))
+		self.execute('DELETE FROM locks WHERE expires <= ?', (now, ))
+
+	# Non-blocking lock, released automatically after ttl seconds if its owner dies while holding it
+	def try_lock(self, name, ttl):
+		now = time()
+		self.execute('DELETE FROM locks WHERE name = ? AND expires <= ?', (name, now))
+		self.execute('INSERT OR IGNORE INTO locks (name, owner, expires) VALUES (?, ?, ?)', (name, self.owner, now + ttl))
+		rows = self.execute('SELECT owner FROM locks WHERE name = ?', (name, ))
+		return bool(rows) and rows[0][0] == self.owner
+
+	def unlock(self, name):
+		self.execute('DELETE FROM locks WHERE name = ? AND owner = ?', (name, self.owner))
+
+	def report_health(self, shard_id, status):
+		self.execute('INSERT OR REPLACE INTO shards (shard_id, status, updated) VALUES (?, ?, ?)', (shard_id, json.dumps(status), time()))
+
+	# Returns {shard_id: (status, seconds since the last report)}
+	def get_health(self):
+		now = time()
+		return {shard_id: (json.loads(status), now - updated) for shard_id, status, updated in self.execute('SELECT shard_id, status, updated FROM shards') or []}
+
+	def stats(self):
+		lookups = self.hits + self.misses
+		return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups > 0 else 0.0, 'writes': self.writes, 'errors': self.errors}
+
+
+# The store is only used when SHARED_STORE_FILENAME is set (the supervisor of a sharded deployment sets it for its workers)
+def build_shared_store():
+	filename = os.getenv('SHARED_STORE_FILENAME', '')
+	if len(filename) == 0:
+		return None
+	custom_info_log('Using shared store %s', filename)
+	return SharedStore(filename)
@@ -0,0 +1,108 @@
+# Reddiator bot module file
+# Module name: utils-startup
+# Version: 1.0
+
+# Description: This module handles the startup of the bot: single instance control, and warm-up before connecting to Discord
+
+import os, sys, logging, fcntl, signal
+
+from concurrent.futures import ThreadPoolExecutor
+
+from time import sleep, perf_counter
+
+from utils.logs import get_logger, INFO
+
+
+LOGGER = get_logger('utils.startup')
+
+def custom_info_log(msg, *args):
+	LOGGER.log(INFO, '\t' + msg, *args)
+
+
+# Single instance control with a locked pidfile: the lock is held as long as the process lives (the kernel releases it
+# when the process dies, even if it crashes), so a stale pidfile never prevents the bot from starting.
+# When another instance holds the lock, it is asked to stop (SIGTERM, then SIGKILL after timeout seconds) and replaced,
+# as the bot always did. Deployments running side by side use different pidfiles.
+# If the holder of the lock never writes a pid (e.g. another program locking the file), the bot exits after timeout seconds.
+def acquire_instance_lock(filename, timeout = 10):
+	pidfile = open(filename, 'a+')
+	if not try_lock(pidfile):
+		pid = None
+		start = perf_counter()
+		while not try_lock(pidfile):
+			if pid is None:
+				# an instance that just started may not have written its pid yet
+				pid = read_pid(pidfile)
+				if pid is not None:
+					logging.warning('Stopping the instance already running with pid = %s', pid)
+					send_signal(pid, signal.SIGTERM)
+			if perf_counter() - start > timeout:
+				if pid is None:
+					logging.error('The instance lock %s is held by a process whose pid is unknown, exiting', filename)
+					sys.exit(1)
+				logging.warning('Instance with pid = %s did not stop in %s s, killing it', pid, timeout)
+				send_signal(pid, signal.SIGKILL)
+				fcntl.flock(pidfile, fcntl.LOCK_EX)
+				break
+			sleep(0.1)
+	pidfile.seek(0)
+	pidfile.truncate()
+	pidfile.write(str(os.getpid()))
+	pidfile.flush()
+	custom_info_log('Acquired the instance lock %s', filename)
+	# the file must stay open (and referenced) for the lock to be kept
+	return pidfile
+
+def try_lock(pidfile):
+	try:
+		fcntl.flock(pidfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		return True
+	except BlockingIOError:
+		return False
+
+def read_pid(pidfile):
+	pidfile.seek(0)
+	try:
+		return int(pidfile.read().strip())
+	except ValueError:
+		return None
+
+def send_signal(pid, sig):
+	try:
+		os.kill(pid, sig)
+	except ProcessLookupError:
+		pass
+
+
+# The warm-up tasks (name, function) run concurrently in threads, while the caller keeps going (e.g. importing discord).
+# A failed task is logged and doesn't prevent the bot from starting: what it should have prepared is done on demand.
+class WarmUp():
+
+	def __init__(self, tasks):
+		self.tasks = tasks
+		self.executor = ThreadPoolExecutor(max_workers = max(1, len(tasks)), thread_name_prefix = 'warm-up')
+		self.futures = {}
+		self.durations = {}
+
+	def run_task(self, name, func):
+		start = perf_counter()
+		try:
+			func()
+		finally:
+			self.durations[name] = perf_counter() - start
+
+	def start(self):
+		self.start_time = perf_counter()
+		self.futures = {name: self.executor.submit(self.run_task, name, func) for name, func in self.tasks}
+		return self
+
+	def wait(self):
+		for name, future in self.futures.items():
+			try:
+				future.result()
+				custom_info_log('Warm-up task %s completed in %.3f s', name, self.durations[name])
+			except Exception:
+				logging.exception('Warm-up task %s failed, it will be done on demand', name)
+		self.executor.shutdown()
+		custom_info_log('Warm-up completed in %.3f s', perf_counter() - self.start_time)
+		return self.durations
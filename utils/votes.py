@@ -0,0 +1,91 @@
+# Reddiator bot module file
+# Module name: utils-votes
+# Version: 1.0
+
+# Description: This module renders the vote command as a single message and counts the votes from reaction events
+
+import logging, asyncio
+
+from collections import OrderedDict
+
+from utils.logs import get_logger, INFO
+
+
+LOGGER = get_logger('utils.votes')
+
+def custom_info_log(msg, *args):
+	LOGGER.log(INFO, '\t' + msg, *args)
+
+
+# Keycap emojis 1 to 5, one per candidate
+NUMBER_EMOJIS = ['1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣']
+
+
+def render_vote(links, subreddit):
+	lines = [f'Here are {len(links)} links from /r/{subreddit}. Vote for your favourite!']
+	for emoji, link in zip(NUMBER_EMOJIS, links):
+		lines.append(f'{emoji} {link}')
+	return '\n'.join(lines)
+
+# Adds the reactions to the message one after the other, so that they show up in order, retrying when rate limited
+async def add_reactions(message, emojis, max_retries = 3):
+	for emoji in emojis:
+		for attempt in range(max_retries + 1):
+			try:
+				await message.add_reaction(emoji)
+				break
+			except Exception as e:
+				if getattr(e, 'status', None) == 429 and attempt < max_retries:
+					await asyncio.sleep(getattr(e, 'retry_after', None) or 0.5)
+				else:
+					logging.error('Error adding reaction %s to message %s: %r', emoji, message.id, e)
+					break
+
+def render_results(results):
+	lines = ['The vote is closed! Results:']
+	for link, votes in results:
+		lines.append(f'{votes} vote{"s" if votes != 1 else ""}: <{link}>')
+	return '\n'.join(lines)
+
+
+# Counts the votes of the polls from the reaction events, so that results never require fetching the messages.
+# Only the latest max_polls polls are tracked.
+class VoteTracker():
+
+	def __init__(self, max_polls = 1000):
+		self.max_polls = max_polls
+		self.polls = OrderedDict()
+
+	def track(self, message_id, links):
+		self.polls[message_id] = {'links': list(links), 'counts': [0] * len(links)}
+		while len(self.polls) > self.max_polls:
+			self.polls.popitem(last = False)
+
+	def update(self, message_id, emoji, delta):
+		poll = self.polls.get(message_id)
+		if poll is None or emoji not in NUMBER_EMOJIS:
+			return False
+		index = NUMBER_EMOJIS.index(emoji)
+		if index >= len(poll['counts']):
+			return False
+		poll['counts'][index] = max(poll['counts'][index] + delta, 0)
+		return True
+
+	def add_vote(self, message_id, emoji):
+		return self.update(message_id, emoji, 1)
+
+	def remove_vote(self, message_id, emoji):
+		return self.update(message_id, emoji, -1)
+
+	# Returns the (link, votes) pairs of the poll, most voted first
+	def results(self, message_id):
+		poll = self.polls.get(message_id)
+		if poll is None:
+			return None
+		return sorted(zip(poll['links'], poll['counts']), key = lambda result: result[1], reverse = True)
+
+	# Stops counting the votes of the poll and returns its results (None if it isn't tracked anymore)
+	def close(self, message_id):
+		results = self.results(message_id)
+		self.polls.pop(message_id, None)
+		return results
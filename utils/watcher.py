@@ -0,0 +1,339 @@
+# Reddiator bot module file
+# Module name: utils-watcher
+# Version: 1.0
+
+# Description: This module watches the new posts of subreddits, and dispatches them to the channels watching them
+
+import logging, os, asyncio
+
+from collections import deque
+
+from time import time
+
+from utils.reddit import RequestException, CACHED_ERROR_CODES, get_new_posts_async
+from utils.logs import get_logger, INFO
+
+
+LOGGER = get_logger('utils.watcher')
+
+def custom_info_log(msg, *args):
+	LOGGER.log(INFO, '\t' + msg, *args)
+
+
+class WatchedSubreddit():
+	__slots__ = ('name', 'channels', 'last_created', 'last_name', 'rate', 'last_poll', 'batch', 'suspended_until')
+
+	def __init__(self, name):
+		self.name = name
+		self.channels = set()
+		# creation time and fullname of the newest post seen (None until the first poll)
+		self.last_created = None
+		self.last_name = None
+		# estimated new posts per second
+		self.rate = 0.0
+		self.last_poll = None
+		self.batch = None
+		self.suspended_until = 0
+
+
+# Subreddits polled together, through one multireddit listing (/r/a+b+c/new).
+# cursor is the fullname of the newest post seen in the listing: the next poll only transfers the posts following it.
+class Batch():
+
+	def __init__(self, tier, next_poll):
+		self.tier = tier
+		self.members = []
+		self.cursor = None
+		self.cursor_created = None
+		self.cursor_subreddit = None
+		# the next poll starts from the newest posts, without cursor
+		self.fresh = False
+		self.empty_polls = 0
+		self.next_poll = next_poll
+
+	def set_cursor(self, name, created, subreddit):
+		self.cursor = name
+		self.cursor_created = created
+		self.cursor_subreddit = subreddit
+
+
+# Each subreddit is polled every tier seconds, the tier being picked from its activity (about target_posts new posts
+# per poll), and the subreddits of a tier are polled together in batches of at most batch_size.
+# A batch keeps its members when others join or leave it, so its cursor stays valid (it is moved back to the newest
+# post of a joining subreddit if that one is older, so that none of its posts is skipped). A batch without cursor
+# (new, or after its cursor subreddit left) starts from the oldest newest post of its members.
+# Posts are also filtered on the creation time of the newest post seen in each subreddit, so no post is dispatched twice.
+# A batch failing as if a subreddit was unavailable (banned, private...) is split in two until the culprit is isolated,
+# which is then suspended for error_backoff seconds.
+# A poll reads at most max_pages pages after the cursor: the posts following them are read by the next poll.
+# Every new post is dispatched by dispatch(channels, post), unless max_posts is set: only the newest max_posts new posts
+# per subreddit and per poll are then dispatched, the older ones being skipped (and counted as such).
+# serves(channel_id) tells whether the channel is served by this process: in a sharded deployment, each worker only
+# polls the subreddits watched by at least one of its channels (the others keep their cursor until one of theirs is).
+class Watcher():
+
+	def __init__(self, store, dispatch, serves = None, tiers = (60, 120, 300, 600, 1800, 3600), batch_size = 50, target_posts = 5,
+			page_size = 100, max_pages = 3, max_posts = 0, concurrency = 2, error_backoff = 3600, tick = 15):
+		self.store = store
+		self.dispatch = dispatch
+		self.serves = serves
+		self.tiers = sorted(tiers)
+		self.batch_size = batch_size
+		self.target_posts = target_posts
+		self.page_size = page_size
+		self.max_pages = max_pages
+		self.max_posts = max_posts
+		self.concurrency = concurrency
+		self.error_backoff = error_backoff
+		self.tick = tick
+		self.subreddits = {}
+		self.batches = []
+		# (time, members) of the requests sent in the last hour
+		self.recent_requests = deque()
+		self.stats_counts = {'polls': 0, 'requests': 0, 'posts': 0, 'dispatched': 0, 'skipped': 0, 'cursor_resets': 0, 'errors': 0}
+		self.task = None
+
+	def load(self):
+		watches = self.store.load_watches()
+		for channel_id, subreddit in watches:
+			self.add(channel_id, subreddit)
+		custom_info_log('Loaded %s watches of %s subreddits', len(watches), len(self.subreddits))
+
+	def add(self, channel_id, subreddit):
+		sub = self.subreddits.get(subreddit.lower())
+		if sub is None:
+			sub = WatchedSubreddit(subreddit)
+			self.subreddits[subreddit.lower()] = sub
+		sub.channels.add(channel_id)
+
+	def watch(self, channel_id, subreddit):
+		self.add(channel_id, subreddit)
+		self.store.add_watch(channel_id, subreddit.lower())
+		custom_info_log('Channel %s now watches the new posts of %s', channel_id, subreddit)
+
+	# Returns False if the channel doesn't watch the subreddit
+	def unwatch(self, channel_id, subreddit):
+		sub = self.subreddits.get(subreddit.lower())
+		if sub is None or channel_id not in sub.channels:
+			return False
+		sub.channels.discard(channel_id)
+		self.store.delete_watch(channel_id, subreddit.lower())
+		if len(sub.channels) == 0:
+			self.remove_from_batch(sub)
+			del self.subreddits[subreddit.lower()]
+		custom_info_log('Channel %s stopped watching the new posts of %s', channel_id, subreddit)
+		return True
+
+	def is_served(self, sub):
+		return self.serves is None or any([self.serves(channel_id) for channel_id in sub.channels])
+
+	def channel_watches(self, channel_id):
+		return sorted([sub.name for sub in self.subreddits.values() if channel_id in sub.channels], key = str.lower)
+
+	# Poll interval for the activity of the subreddit: the longest tier expected to bring at most target_posts posts
+	def get_tier(self, sub):
+		if sub.rate <= 0:
+			return self.tiers[-1]
+		interval = self.target_posts / sub.rate
+		return max([tier for tier in self.tiers if tier <= interval] or [self.tiers[0]])
+
+	def remove_from_batch(self, sub):
+		batch = sub.batch
+		if batch is None:
+			return
+		batch.members.remove(sub.name.lower())
+		sub.batch = None
+		if batch.cursor_subreddit == sub.name.lower():
+			batch.set_cursor(None, None, None)
+		if len(batch.members) == 0:
+			self.batches.remove(batch)
+
+	def place(self, sub, tier):
+		if sub.batch is not None and sub.batch.tier == tier:
+			return
+		self.remove_from_batch(sub)
+		batch = next((b for b in self.batches if b.tier == tier and len(b.members) < self.batch_size), None)
+		if batch is None:
+			batch = Batch(tier, time())
+			self.batches.append(batch)
+		batch.members.append(sub.name.lower())
+		sub.batch = batch
+		if batch.cursor is not None and sub.last_name is not None and sub.last_created < batch.cursor_created:
+			batch.set_cursor(sub.last_name, sub.last_created, sub.name.lower())
+
+	def record_request(self, members, now):
+		self.stats_counts['requests'] = self.stats_counts['requests'] + 1
+		self.recent_requests.append((now, members))
+		while now - self.recent_requests[0][0] > 3600:
+			self.recent_requests.popleft()
+
+	# Requests sent for each subreddit in the last hour: a request for a batch of n subreddits counts 1/n for each
+	def requests_per_hour(self):
+		requests = {}
+		for _, members in self.recent_requests:
+			for member in members:
+				requests[member] = requests.get(member, 0) + 1 / len(members)
+		return requests
+
+	async def fetch(self, batch, now):
+		members = list(batch.members)
+		cursor = batch.cursor
+		if cursor is None and not batch.fresh:
+			newest = [(self.subreddits[m].last_created, self.subreddits[m].last_name) for m in members if self.subreddits[m].last_name is not None]
+			if len(newest) > 0:
+				cursor = min(newest)[1]
+		batch.fresh = False
+		posts = []
+		for page in range(self.max_pages):
+			page_posts = await get_new_posts_async(members, cursor, self.page_size)
+			self.record_request(members, now)
+			posts.extend(page_posts)
+			# with a cursor, a full page means that there are more new posts after it
+			if cursor is None or len(page_posts) < self.page_size:
+				break
+			cursor = max(page_posts, key = lambda post: post.created).name
+		return members, posts
+
+	async def poll(self, batch):
+		now = time()
+		batch.next_poll = now + batch.tier
+		self.stats_counts['polls'] = self.stats_counts['polls'] + 1
+		try:
+			members, posts = await self.fetch(batch, now)
+		except RequestException as e:
+			self.stats_counts['errors'] = self.stats_counts['errors'] + 1
+			if e.code in CACHED_ERROR_CODES and batch in self.batches:
+				self.isolate(batch, e.code)
+			else:
+				custom_info_log('Polling the new posts of %s subreddits failed (code %s), will retry later', len(batch.members), e.code)
+			return
+
+		if len(posts) > 0:
+			newest = max(posts, key = lambda post: post.created)
+			# (unless its subreddit left the batch during the poll)
+			if newest.subreddit.lower() in batch.members:
+				batch.set_cursor(newest.name, newest.created, newest.subreddit.lower())
+			batch.empty_polls = 0
+		elif batch.cursor is not None:
+			batch.empty_polls = batch.empty_polls + 1
+			# the post of the cursor may have been deleted (Reddit then returns nothing after it): if the members should
+			# have posted something since, the next poll starts again from the newest posts
+			if batch.empty_polls >= 3 and sum([self.subreddits[m].rate for m in members if m in self.subreddits]) * batch.tier * batch.empty_polls >= 1:
+				custom_info_log('No new posts in %s polls of %s subreddits, resetting the cursor', batch.empty_polls, len(members))
+				self.stats_counts['cursor_resets'] = self.stats_counts['cursor_resets'] + 1
+				batch.set_cursor(None, None, None)
+				batch.fresh = True
+				batch.empty_polls = 0
+
+		by_subreddit = {}
+		for post in posts:
+			by_subreddit.setdefault(post.subreddit.lower(), []).append(post)
+		for member in members:
+			sub = self.subreddits.get(member)
+			if sub is not None:
+				self.update(sub, by_subreddit.get(member, []), now)
+				if sub.batch is not None:
+					self.place(sub, self.get_tier(sub))
+
+	def update(self, sub, posts, now):
+		if sub.last_created is None:
+			# first poll: the posts already there are not dispatched, they give a first estimate of the activity
+			if len(posts) >= 2:
+				created = [post.created for post in posts]
+				sub.rate = (len(posts) - 1) / max(max(created) - min(created), 1)
+			if len(posts) > 0:
+				newest = max(posts, key = lambda post: post.created)
+				sub.last_created, sub.last_name = newest.created, newest.name
+			else:
+				sub.last_created = now
+		else:
+			new_posts = sorted([post for post in posts if post.created > sub.last_created], key = lambda post: post.created)
+			elapsed = max(now - sub.last_poll, 1) if sub.last_poll is not None else 0
+			if elapsed > 0:
+				sub.rate = 0.7 * sub.rate + 0.3 * len(new_posts) / elapsed
+			if len(new_posts) > 0:
+				sub.last_created, sub.last_name = new_posts[-1].created, new_posts[-1].name
+				self.stats_counts['posts'] = self.stats_counts['posts'] + len(new_posts)
+				if self.max_posts > 0 and len(new_posts) > self.max_posts:
+					custom_info_log('%s new posts in subreddit %s, skipping the %s oldest ones', len(new_posts), sub.name, len(new_posts) - self.max_posts)
+					self.stats_counts['skipped'] = self.stats_counts['skipped'] + len(new_posts) - self.max_posts
+					new_posts = new_posts[-self.max_posts:]
+				for post in new_posts:
+					self.dispatch(sub.channels, post)
+					self.stats_counts['dispatched'] = self.stats_counts['dispatched'] + 1
+		sub.last_poll = now
+
+	def isolate(self, batch, code):
+		if len(batch.members) == 1:
+			sub = self.subreddits.get(batch.members[0])
+			logging.warning('Subreddit %s is unavailable (code %s), suspending its watch for %s s', batch.members[0], code, self.error_backoff)
+			if sub is not None:
+				self.remove_from_batch(sub)
+				sub.suspended_until = time() + self.error_backoff
+			return
+		custom_info_log('Polling the new posts of %s subreddits failed (code %s), splitting them', len(batch.members), code)
+		self.batches.remove(batch)
+		half = len(batch.members) // 2
+		for members in [batch.members[:half], batch.members[half:]]:
+			part = Batch(batch.tier, time())
+			part.members = members
+			self.batches.append(part)
+			for member in members:
+				self.subreddits[member].batch = part
+
+	async def run_round(self):
+		now = time()
+		for sub in self.subreddits.values():
+			served = self.is_served(sub)
+			if not served and sub.batch is not None:
+				custom_info_log('No channel of this process watches subreddit %s anymore, no longer polling it', sub.name)
+				self.remove_from_batch(sub)
+			elif served and sub.batch is None and sub.suspended_until <= now:
+				# a subreddit never polled is polled with the busiest ones until its activity is known
+				self.place(sub, self.get_tier(sub) if sub.last_poll is not None else self.tiers[0])
+		due = [batch for batch in self.batches if batch.next_poll <= now]
+		if len(due) > 0:
+			semaphore = asyncio.Semaphore(self.concurrency)
+			async def poll(batch):
+				async with semaphore:
+					await self.poll(batch)
+			await asyncio.gather(*[poll(batch) for batch in due])
+
+	async def run(self):
+		while True:
+			try:
+				await self.run_round()
+			except Exception:
+				logging.exception('Unexpected error while watching the new posts')
+			await asyncio.sleep(self.tick)
+
+	def start(self):
+		if self.task is None:
+			self.task = asyncio.ensure_future(self.run())
+		return self.task
+
+	def stats(self):
+		now = time()
+		requests_last_hour = len([1 for sent, _ in self.recent_requests if now - sent <= 3600])
+		polled = len([sub for sub in self.subreddits.values() if sub.batch is not None])
+		return dict(self.stats_counts, subreddits = len(self.subreddits), polled = polled, batches = len(self.batches),
+			tiers = {tier: len([b for b in self.batches if b.tier == tier]) for tier in self.tiers},
+			requests_last_hour = requests_last_hour,
+			requests_per_subreddit_hour = requests_last_hour / polled if polled > 0 else 0.0)
+
+	# Subreddits that cost the most requests in the last hour: [(subreddit, requests, poll interval)]
+	def busiest(self, count = 10):
+		requests = self.requests_per_hour()
+		busiest = sorted(requests.items(), key = lambda entry: entry[1], reverse = True)[:count]
+		return [(self.subreddits[sub].name, count, self.get_tier(self.subreddits[sub])) for sub, count in busiest if sub in self.subreddits]
+
+
+# The watches are stored with the subscriptions (see utils.scheduler), and disabled like them
+def build_watcher(store, dispatch, serves = None):
+	if store is None:
+		return None
+	return Watcher(store, dispatch, serves,
+		batch_size = int(os.getenv('WATCH_BATCH_SIZE', '50')),
+		target_posts = int(os.getenv('WATCH_TARGET_POSTS', '5')),
+		max_posts = int(os.getenv('WATCH_MAX_POSTS', '0')),
+		tiers = [int(tier) for tier in os.getenv('WATCH_INTERVALS', '60,120,300,600,1800,3600').split(',')])